@@ -1,38 +1,81 @@
-import boto3
 import os
 from datetime import datetime, timedelta
-from botocore.exceptions import ClientError
 
 # -----------------------------------------------------------------------------
 # 1) GLOBAL CONSTANTS AND SETUP
 # -----------------------------------------------------------------------------
 
-# Initialize the Cost Explorer client
-cost_explorer = boto3.client('ce')
-
 # For monthly cost reporting, define how many months back to report
 MONTHSBACK = 9  # e.g., 9 months back
 
-# Determine the first day of the current month
-today = datetime.now()
-first_of_this_month = today.replace(day=1)
-
-# The start date is "MONTHSBACK months ago," adjusted to the 1st of that month
-start_date = (first_of_this_month - timedelta(days=MONTHSBACK * 30)).replace(day=1)
-end_date = first_of_this_month  # i.e., 1st day of current month
-
-# Convert these to strings for Cost Explorer
-MONTHLY_START_DATE = start_date.strftime('%Y-%m-%d')
-MONTHLY_END_DATE = end_date.strftime('%Y-%m-%d')
-
-# Generate a list of monthly boundaries (the 1st) for the reporting window
+# The reporting window is computed on first use (see init_report_window)
+# rather than at import, and recomputed when the month changes under a
+# long-lived Lambda container.
+first_of_this_month = None
+MONTHLY_START_DATE = None
+MONTHLY_END_DATE = None
 MONTHLY_COST_DATES = []
-temp_date = start_date
-while temp_date < end_date:
-    MONTHLY_COST_DATES.append(temp_date.strftime('%Y-%m-%d'))
-    # Go to the next month by adding ~30 days, then forcing day=1
-    next_month = (temp_date + timedelta(days=32)).replace(day=1)
-    temp_date = next_month
+
+def init_report_window(now=None):
+    """
+    Computes the reporting window globals. Returns immediately if the window
+    for the current month has already been built.
+    """
+    global first_of_this_month, MONTHLY_START_DATE, MONTHLY_END_DATE, MONTHLY_COST_DATES
+
+    # Determine the first day of the current month
+    today = now or datetime.now()
+    first_of_month = today.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    if first_of_month == first_of_this_month:
+        return
+
+    # The start date is "MONTHSBACK months ago," adjusted to the 1st of that month
+    start_date = (first_of_month - timedelta(days=MONTHSBACK * 30)).replace(day=1)
+    end_date = first_of_month  # i.e., 1st day of current month
+
+    # Generate a list of monthly boundaries (the 1st) for the reporting window
+    cost_dates = []
+    temp_date = start_date
+    while temp_date < end_date:
+        cost_dates.append(temp_date.strftime('%Y-%m-%d'))
+        # Go to the next month by adding ~30 days, then forcing day=1
+        next_month = (temp_date + timedelta(days=32)).replace(day=1)
+        temp_date = next_month
+
+    # Convert these to strings for Cost Explorer
+    first_of_this_month = first_of_month
+    MONTHLY_START_DATE = start_date.strftime('%Y-%m-%d')
+    MONTHLY_END_DATE = end_date.strftime('%Y-%m-%d')
+    MONTHLY_COST_DATES = cost_dates
+
+# Clients are created on first use and reused across warm invocations;
+# boto3 itself is only imported then, which keeps module import cheap.
+cost_explorer = None
+ses_clients = {}
+
+def client_error():
+    """
+    botocore's ClientError, imported on first need. An except clause only
+    evaluates it once something was raised, so error-free runs never pay
+    for the import before boto3 itself is loaded.
+    """
+    from botocore.exceptions import ClientError
+    return ClientError
+
+def get_cost_explorer():
+    """Returns the Cost Explorer client, creating it on first use."""
+    global cost_explorer
+    if cost_explorer is None:
+        import boto3
+        cost_explorer = boto3.client('ce')
+    return cost_explorer
+
+def get_ses_client(region):
+    """Returns the SES client for region, creating it on first use."""
+    if region not in ses_clients:
+        import boto3
+        ses_clients[region] = boto3.client('ses', region_name=region)
+    return ses_clients[region]
 
 # These are the AWS accounts you want to track, with friendly names
 accountDict = {
@@ -64,38 +107,106 @@ BODY_HTML = '<h2>AWS Monthly Cost Report for Accounts - Summary</h2>'
 # 2) RETRIEVE COST INFO PER ACCOUNT (Summary)
 # -----------------------------------------------------------------------------
 
-def ce_get_costinfo_per_account(accountDict_input):
+# Maximum number of account IDs placed in a single LINKED_ACCOUNT filter.
+# The summary is fetched with one GroupBy LINKED_ACCOUNT query per chunk
+# instead of one query per account.
+CE_ACCOUNT_CHUNK_SIZE = 100
+
+def plan_account_queries(account_ids, chunk_size=CE_ACCOUNT_CHUNK_SIZE):
     """
-    For each account in accountDict_input, call Cost Explorer with Granularity=MONTHLY.
-    Return a dictionary keyed by account ID, containing the Cost Explorer response.
+    Splits the account list into the chunks that each become one
+    GroupBy LINKED_ACCOUNT query. A single chunk is returned unless the
+    filter value list is longer than chunk_size.
     """
-    accountCostDict = {}
+    account_ids = list(account_ids)
+    return [account_ids[i:i + chunk_size] for i in range(0, len(account_ids), chunk_size)]
 
-    for acct_id in accountDict_input:
-        response = cost_explorer.get_cost_and_usage(
-            TimePeriod={
-                'Start': MONTHLY_START_DATE,
-                'End': MONTHLY_END_DATE
-            },
+def get_grouped_account_costs(account_ids):
+    """
+    Runs one paginated get_cost_and_usage query grouped by LINKED_ACCOUNT
+    for the given accounts and returns every ResultsByTime entry it produced.
+    """
+    results = []
+    token = None
+
+    while True:
+        if token:
+            kwargs = {'NextPageToken': token}
+        else:
+            kwargs = {}
+
+        data = get_cost_explorer().get_cost_and_usage(
+            TimePeriod={'Start': MONTHLY_START_DATE, 'End': MONTHLY_END_DATE},
             Granularity='MONTHLY',
-            Filter={
-                'Dimensions': {
-                    'Key': 'LINKED_ACCOUNT',
-                    'Values': [acct_id]
-                }
-            },
-            Metrics=['UnblendedCost']
+            Metrics=['UnblendedCost'],
+            GroupBy=[{'Type': 'DIMENSION', 'Key': 'LINKED_ACCOUNT'}],
+            Filter={'Dimensions': {'Key': 'LINKED_ACCOUNT', 'Values': account_ids}},
+            **kwargs
         )
+        results += data['ResultsByTime']
+        token = data.get('NextPageToken')
+        if not token:
+            break
+
+    return results
 
-        # Sum up the total cost across all monthly buckets
-        period_cost = 0.0
-        for month_data in response['ResultsByTime']:
-            cost_val = float(month_data['Total']['UnblendedCost']['Amount'])
-            period_cost += cost_val
+def demux_account_results(results_by_time, account_ids):
+    """
+    Splits grouped ResultsByTime entries back into one response per account,
+    shaped like an ungrouped get_cost_and_usage response:
+      { account_id: { 'ResultsByTime': [ { 'TimePeriod', 'Total', 'Estimated' }, ... ] } }
+    A month can be spread over several pages, so entries are merged by start date.
+    Months with no group for an account get a zero Total.
+    """
+    periods = {}
+    for time_period in results_by_time:
+        start_str = time_period['TimePeriod']['Start']
+        if start_str not in periods:
+            periods[start_str] = {
+                'TimePeriod': time_period['TimePeriod'],
+                'Estimated': time_period.get('Estimated', False),
+                'Amounts': {}
+            }
+        for group in time_period.get('Groups', []):
+            cost = group['Metrics']['UnblendedCost']
+            periods[start_str]['Amounts'][group['Keys'][0]] = cost
+
+    demuxed = {}
+    for acct_id in account_ids:
+        acct_results = []
+        for period in periods.values():
+            cost = period['Amounts'].get(acct_id, {'Amount': '0', 'Unit': 'USD'})
+            acct_results.append({
+                'TimePeriod': period['TimePeriod'],
+                'Total': {'UnblendedCost': cost},
+                'Estimated': period['Estimated']
+            })
+        demuxed[acct_id] = {'ResultsByTime': acct_results}
+
+    return demuxed
 
-        # Only store if cost > 0 for that period
-        if period_cost > 0:
-            accountCostDict[acct_id] = response
+def ce_get_costinfo_per_account(accountDict_input):
+    """
+    Fetches the monthly cost of every account in accountDict_input with one
+    GroupBy LINKED_ACCOUNT query per chunk (see plan_account_queries), then
+    demultiplexes the result. Returns a dictionary keyed by account ID with
+    a Cost Explorer-shaped response for each account that had any cost.
+    """
+    accountCostDict = {}
+
+    for chunk in plan_account_queries(accountDict_input):
+        responses = demux_account_results(get_grouped_account_costs(chunk), chunk)
+
+        for acct_id, response in responses.items():
+            # Sum up the total cost across all monthly buckets
+            period_cost = 0.0
+            for month_data in response['ResultsByTime']:
+                cost_val = float(month_data['Total']['UnblendedCost']['Amount'])
+                period_cost += cost_val
+
+            # Only store if cost > 0 for that period
+            if period_cost > 0:
+                accountCostDict[acct_id] = response
 
     return accountCostDict
 
@@ -308,7 +419,7 @@ def get_linked_accounts(account_list):
         else:
             kwargs = {}
 
-        linked_accounts = cost_explorer.get_dimension_values(
+        linked_accounts = get_cost_explorer().get_dimension_values(
             TimePeriod={'Start': MONTHLY_START_DATE, 'End': MONTHLY_END_DATE},
             Dimension='LINKED_ACCOUNT',
             **kwargs
@@ -341,7 +452,7 @@ def get_cost_data(account_numbers):
         else:
             kwargs = {}
 
-        data = cost_explorer.get_cost_and_usage(
+        data = get_cost_explorer().get_cost_and_usage(
             TimePeriod={'Start': MONTHLY_START_DATE, 'End': MONTHLY_END_DATE},
             Granularity='MONTHLY',
             Metrics=['UnblendedCost'],
@@ -525,7 +636,7 @@ def send_report_email(BODY_HTML):
     SUBJECT = "AWS Monthly Cost Report for Selected Accounts"
     BODY_TEXT = "AWS Cost Report (HTML Email)."
 
-    client = boto3.client('ses', region_name=AWS_REGION)
+    client = get_ses_client(AWS_REGION)
 
     try:
         response = client.send_email(
@@ -540,7 +651,7 @@ def send_report_email(BODY_HTML):
             Source=SENDER
         )
         print("Email sent! Message ID:", response['MessageId'])
-    except ClientError as e:
+    except client_error() as e:
         print(e.response['Error']['Message'])
 
 # -----------------------------------------------------------------------------
@@ -548,6 +659,8 @@ def send_report_email(BODY_HTML):
 # -----------------------------------------------------------------------------
 
 def lambda_handler(event=None, context=None):
+    init_report_window()
+
     # 1) Get summary cost info (per account)
     mainCostDict = ce_get_costinfo_per_account(accountDict)
 
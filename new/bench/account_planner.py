@@ -0,0 +1,115 @@
+"""
+Compares the per-account summary loop with the grouped query planner.
+
+Both variants run against a stubbed Cost Explorer that sleeps for a fixed
+latency per request, so the numbers reflect round-trips rather than
+network noise.
+
+    python new/bench/account_planner.py --accounts 300 --latency-ms 50
+"""
+import argparse
+import time
+
+from common import load_report_module, make_account_ids
+
+class StubCostExplorer:
+    """
+    Minimal get_cost_and_usage stand-in. Costs are derived from the account
+    ID and month so both variants see identical data. Grouped responses are
+    paginated every page_size groups, like the real API.
+    """
+    def __init__(self, months, latency_s=0.05, page_size=500):
+        self.months = months
+        self.latency_s = latency_s
+        self.page_size = page_size
+        self.calls = 0
+
+    def _amount(self, acct_id, month_idx):
+        return f"{(int(acct_id) % 997) * 1.5 + month_idx:.2f}"
+
+    def get_cost_and_usage(self, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency_s)
+        accounts = kwargs['Filter']['Dimensions']['Values']
+        if not kwargs.get('GroupBy'):
+            results = []
+            for idx, (start, end) in enumerate(self.months):
+                results.append({
+                    'TimePeriod': {'Start': start, 'End': end},
+                    'Total': {'UnblendedCost': {'Amount': self._amount(accounts[0], idx), 'Unit': 'USD'}},
+                    'Groups': [],
+                    'Estimated': False
+                })
+            return {'ResultsByTime': results}
+
+        # Flatten (month, account) groups and cut the requested page out of them
+        cells = [(idx, acct_id) for idx in range(len(self.months)) for acct_id in accounts]
+        offset = int(kwargs.get('NextPageToken') or 0)
+        page = cells[offset:offset + self.page_size]
+        results = []
+        for idx, acct_id in page:
+            if not results or results[-1]['TimePeriod']['Start'] != self.months[idx][0]:
+                results.append({
+                    'TimePeriod': {'Start': self.months[idx][0], 'End': self.months[idx][1]},
+                    'Total': {},
+                    'Groups': [],
+                    'Estimated': False
+                })
+            results[-1]['Groups'].append({
+                'Keys': [acct_id],
+                'Metrics': {'UnblendedCost': {'Amount': self._amount(acct_id, idx), 'Unit': 'USD'}}
+            })
+        response = {'ResultsByTime': results}
+        if offset + self.page_size < len(cells):
+            response['NextPageToken'] = str(offset + self.page_size)
+        return response
+
+def legacy_costinfo_per_account(report, accountDict_input):
+    """The original one-query-per-account loop, kept here as the baseline."""
+    accountCostDict = {}
+    for acct_id in accountDict_input:
+        response = report.cost_explorer.get_cost_and_usage(
+            TimePeriod={'Start': report.MONTHLY_START_DATE, 'End': report.MONTHLY_END_DATE},
+            Granularity='MONTHLY',
+            Filter={'Dimensions': {'Key': 'LINKED_ACCOUNT', 'Values': [acct_id]}},
+            Metrics=['UnblendedCost']
+        )
+        period_cost = 0.0
+        for month_data in response['ResultsByTime']:
+            period_cost += float(month_data['Total']['UnblendedCost']['Amount'])
+        if period_cost > 0:
+            accountCostDict[acct_id] = response
+    return accountCostDict
+
+def run(report, stub, label, fn, accounts):
+    stub.calls = 0
+    started = time.perf_counter()
+    cost_dict = fn(accounts)
+    elapsed = time.perf_counter() - started
+    monthly = report.process_costchanges_per_month(cost_dict)
+    print(f"{label:<10} calls={stub.calls:<5} api_cost=${stub.calls * 0.01:<7.2f} wall={elapsed:8.3f}s")
+    return monthly
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--accounts', type=int, default=300)
+    parser.add_argument('--latency-ms', type=float, default=50.0)
+    parser.add_argument('--page-size', type=int, default=500)
+    args = parser.parse_args()
+
+    report = load_report_module()
+    report.init_report_window()
+    months = [(m, report.MONTHLY_COST_DATES[i + 1] if i + 1 < len(report.MONTHLY_COST_DATES) else report.MONTHLY_END_DATE)
+              for i, m in enumerate(report.MONTHLY_COST_DATES)]
+    stub = StubCostExplorer(months, latency_s=args.latency_ms / 1000.0, page_size=args.page_size)
+    report.cost_explorer = stub
+    # The benchmark only times the fetch, not the debug dumps
+    report.print = lambda *a, **k: None
+
+    accounts = {acct_id: acct_id for acct_id in make_account_ids(args.accounts)}
+    legacy = run(report, stub, 'legacy', lambda accts: legacy_costinfo_per_account(report, accts), accounts)
+    planned = run(report, stub, 'planner', report.ce_get_costinfo_per_account, accounts)
+    print("identical monthly dict:", legacy == planned)
+
+if __name__ == '__main__':
+    main()
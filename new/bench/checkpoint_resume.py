@@ -0,0 +1,123 @@
+"""
+Kills checkpointed report runs at random points and checks that resuming
+them produces the same email as an uninterrupted run.
+
+Every attempt is a child process running lambda_handler against the fake
+Cost Explorer with a fixed run id. The parent SIGKILLs the first --kills
+attempts of a trial after a random delay (up to the length of an
+uninterrupted run) and lets the next one finish. The finished report must
+match a reference run made without checkpoints.
+
+    python new/bench/checkpoint_resume.py --trials 5 --kills 3 --accounts 40 --latency-ms 30
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import load_report_module, make_account_ids
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+import fake_aws
+
+def run_report(args, run_id):
+    """Runs the report once in this process; returns its email and request counts."""
+    os.environ.update(CE_CACHE_ENABLED='false', CE_REQUESTS_PER_SECOND='100000', CE_REQUEST_BURST='100000',
+                      INCLUDE_SERVICE_BREAKDOWN='true', AWS_REGION='us-east-1', METRICS_SINK='off',
+                      REPORT_API_USAGE='false')
+    report = load_report_module()
+    report.print = lambda *a, **k: None
+
+    accounts = make_account_ids(args.accounts)
+    fake = fake_aws.FakeCostExplorer(
+        accounts=accounts, services=args.services, tag_key=report.TEAM_TAG_KEY, tag_values=['team-0', 'team-1'],
+        latency_ms=args.latency_ms, page_size=args.page_size, seed=args.seed
+    )
+    ses = fake_aws.FakeSES()
+    report.cost_explorer = fake
+    report.ses_clients['us-east-1'] = ses
+    report.accountDict = {acct_id: f"Account {acct_id[-4:]}" for acct_id in accounts}
+    report.displayListMonthly = accounts[:5] + ['monthTotal']
+    report.TEAM_TAG_VALUE = 'team-0'
+
+    report.lambda_handler({'run_id': run_id} if run_id else {}, None)
+    return {
+        'sha256': hashlib.sha256(ses.sent[0].encode('utf-8')).hexdigest(),
+        'ce_requests': report.ce_retry_stats['requests'],
+        'resumed_pages': report.ce_retry_stats['resumed_pages'],
+    }
+
+def child_command(args, run_id):
+    return [sys.executable, os.path.abspath(__file__), '--child', run_id,
+            '--accounts', str(args.accounts), '--services', str(args.services),
+            '--latency-ms', str(args.latency_ms), '--page-size', str(args.page_size), '--seed', str(args.seed)]
+
+def run_until_done(args, run_id, kill_window, rng):
+    """
+    Runs run_id, killing up to args.kills attempts at a random point, then
+    lets one attempt finish. Returns (attempts killed, final result).
+    """
+    killed = 0
+    while True:
+        child = subprocess.Popen(child_command(args, run_id), stdout=subprocess.PIPE, text=True)
+        try:
+            out, _ = child.communicate(timeout=rng.uniform(0, kill_window) if killed < args.kills else None)
+        except subprocess.TimeoutExpired:
+            child.kill()
+            child.communicate()
+            killed += 1
+            continue
+        if child.returncode != 0:
+            raise RuntimeError(f"{run_id} failed with exit code {child.returncode} after {killed} kills")
+        return killed, json.loads(out.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--trials', type=int, default=5)
+    parser.add_argument('--kills', type=int, default=3, help='attempts killed per trial')
+    parser.add_argument('--accounts', type=int, default=40)
+    parser.add_argument('--services', type=int, default=40)
+    parser.add_argument('--latency-ms', type=float, default=30.0)
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        # '-' is the reference run, without a run id
+        print(json.dumps(run_report(args, '' if args.child == '-' else args.child)))
+        return
+
+    checkpoint_dir = tempfile.mkdtemp(prefix='ce-checkpoints-')
+    os.environ['CHECKPOINT_DIR'] = checkpoint_dir
+    try:
+        started = time.perf_counter()
+        reference = json.loads(subprocess.run(child_command(args, '-'), check=True, capture_output=True,
+                                              text=True).stdout.strip().splitlines()[-1])
+        elapsed = time.perf_counter() - started
+        print(f"reference run: {elapsed:.1f}s, {reference['ce_requests']} Cost Explorer requests")
+
+        rng = random.Random(args.seed)
+        failures = 0
+        for trial in range(args.trials):
+            killed, result = run_until_done(args, f"trial-{trial}", elapsed, rng)
+            same = result['sha256'] == reference['sha256']
+            failures += not same
+            print(f"trial {trial}: killed {killed} times, the final attempt made {result['ce_requests']} requests and "
+                  f"resumed {result['resumed_pages']} pages, report {'identical' if same else 'DIFFERENT'}")
+    finally:
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+
+    if failures:
+        sys.exit(f"{failures} of {args.trials} resumed reports differ from the reference")
+    print("all resumed reports match the reference")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Measures the cold-start cost of the report Lambda, broken down into module
+import, boto3 import, client construction and config parsing.
+
+Each sample runs in a fresh interpreter so nothing is already cached. The
+Lambda "Init Duration" corresponds to the module import column; whatever
+is deferred shows up in the other columns and is paid once by the first
+invocation of a container instead.
+
+    python new/bench/cold_start.py --runs 10
+    git show <rev>:new/new-draft.py > /tmp/old.py
+    python new/bench/cold_start.py --compare /tmp/old.py
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from common import LAMBDA_PATH
+
+CHILD = r'''
+import importlib.util, json, os, sys, time
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+timings = {}
+
+started = time.perf_counter()
+spec = importlib.util.spec_from_file_location('cost_report', sys.argv[1])
+report = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(report)
+timings['module_import'] = time.perf_counter() - started
+
+started = time.perf_counter()
+import boto3
+timings['boto3_import'] = time.perf_counter() - started
+
+started = time.perf_counter()
+if hasattr(report, 'get_cost_explorer'):
+    report.get_cost_explorer()
+    report.get_ses_client(os.environ['AWS_DEFAULT_REGION'])
+else:
+    boto3.client('ses', region_name=os.environ['AWS_DEFAULT_REGION'])
+timings['client_construction'] = time.perf_counter() - started
+
+started = time.perf_counter()
+if hasattr(report, 'init_report_window'):
+    report.init_report_window()
+if hasattr(report, 'get_summary_header_html'):
+    report.get_summary_header_html()
+timings['config_parsing'] = time.perf_counter() - started
+
+print(json.dumps(timings))
+'''
+
+STAGES = ['module_import', 'boto3_import', 'client_construction', 'config_parsing']
+
+def sample(path, runs):
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, '-c', CHILD, path],
+            check=True, capture_output=True, text=True, env=dict(os.environ)
+        ).stdout
+        samples.append(json.loads(out.strip().splitlines()[-1]))
+    return {stage: statistics.median(s[stage] for s in samples) for stage in STAGES}
+
+def report_line(label, medians):
+    total = sum(medians.values())
+    cells = '  '.join(f"{stage}={medians[stage] * 1000:8.1f}ms" for stage in STAGES)
+    print(f"{label:<10} {cells}  total={total * 1000:8.1f}ms")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--compare', help='another version of the Lambda file to measure side by side')
+    args = parser.parse_args()
+
+    report_line('current', sample(LAMBDA_PATH, args.runs))
+    if args.compare:
+        report_line('compare', sample(args.compare, args.runs))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+"""
+Shared helpers for the cost report benchmarks.
+
+The Lambda lives in new/new-draft.py, which is not importable by name
+because of the dash, so the benchmarks load it from its file path.
+"""
+import importlib.util
+import os
+import sys
+
+LAMBDA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'new-draft.py')
+
+def load_report_module(path=LAMBDA_PATH, name='cost_report'):
+    """
+    Imports the report Lambda from its file and returns the module object.
+    A region is defaulted so client construction works on a plain dev box.
+    The module is registered under name, as a regular import would be, so
+    its functions can be pickled (the local shard workers need that).
+    """
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def make_account_ids(count):
+    """Returns count deterministic 12-digit account IDs."""
+    return [f"{100000000000 + i:012d}" for i in range(count)]
@@ -0,0 +1,66 @@
+"""
+Compares the memory footprint of the nested {'Cost': float} dict graph with
+the array-backed CostCube for a synthetic org.
+
+    python new/bench/cost_cube.py --accounts 1000 --services 250 --months 36
+
+The full-size run needs several GB for the dict variant; scale down with
+--accounts for a quick look (memory grows linearly with each axis).
+"""
+import argparse
+import time
+import tracemalloc
+
+from common import load_report_module, make_account_ids
+
+def month_list(count):
+    return [f"{2000 + i // 12:04d}-{i % 12 + 1:02d}-01" for i in range(count)]
+
+def build_dicts(accounts, services, months):
+    graph = {}
+    for a, acct_id in enumerate(accounts):
+        graph[acct_id] = {}
+        for s, service in enumerate(services):
+            graph[acct_id][service] = {
+                month: {'Cost': float(a + s + m)} for m, month in enumerate(months)
+            }
+    return graph
+
+def build_cube(report, accounts, services, months):
+    cube = report.CostCube(months)
+    for a, acct_id in enumerate(accounts):
+        for s, service in enumerate(services):
+            for m, month in enumerate(months):
+                cube.add(acct_id, service, month, float(a + s + m))
+    return cube
+
+def measure(label, fn):
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - started
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<6} build={elapsed:7.2f}s  retained={current / 2**20:9.1f} MiB  peak={peak / 2**20:9.1f} MiB")
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--accounts', type=int, default=100)
+    parser.add_argument('--services', type=int, default=250)
+    parser.add_argument('--months', type=int, default=36)
+    args = parser.parse_args()
+
+    report = load_report_module()
+    accounts = make_account_ids(args.accounts)
+    services = [f"Service {i:03d}" for i in range(args.services)]
+    months = month_list(args.months)
+
+    print(f"{args.accounts} accounts x {args.services} services x {args.months} months")
+    graph = measure('dicts', lambda: build_dicts(accounts, services, months))
+    del graph
+    cube = measure('cube', lambda: build_cube(report, accounts, services, months))
+    print(f"cube array data: {cube.nbytes() / 2**20:.1f} MiB")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+"""
+End-to-end benchmark of the report pipeline against the fake Cost Explorer.
+
+For each org size the summary stages (fetch -> monthly -> display ->
+percent -> summary HTML) are timed one by one, then the whole
+lambda_handler. A second, tracemalloc-instrumented pass records the
+allocations of every stage. Each size runs in its own interpreter so peak
+RSS is per size. Nothing leaves the machine: Cost Explorer and SES are
+the stand-ins from fake_aws.py and the response cache is off.
+
+    python new/bench/pipeline.py --sizes small,medium
+    python new/bench/pipeline.py --sizes huge --latency-ms 50
+    python new/bench/pipeline.py --compare new/bench/results/<earlier>.json
+
+Results are written as JSON to new/bench/results/ (or --out); --compare
+prints the change of every number against an earlier result file.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from common import LAMBDA_PATH, load_report_module, make_account_ids
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+import fake_aws
+
+ORG_SIZES = {
+    'small': {'accounts': 3, 'services': 20, 'tag_values': 3},
+    'medium': {'accounts': 100, 'services': 100, 'tag_values': 5},
+    'huge': {'accounts': 1000, 'services': 250, 'tag_values': 10},
+}
+
+# Summary columns shown for every size; the rest fold into Others
+DISPLAY_ACCOUNTS = 10
+
+STAGES = ['fetch', 'monthly', 'display', 'percent', 'summary_html', 'lambda_handler']
+
+def setup(size, latency_ms, page_size):
+    """Loads a fresh report module wired to fakes for one org size."""
+    os.environ.update(CE_CACHE_ENABLED='false', CE_REQUESTS_PER_SECOND='100000', CE_REQUEST_BURST='100000',
+                      METRICS_SINK='off')
+    report = load_report_module(LAMBDA_PATH, f"cost_report_{size}")
+    report.print = lambda *a, **k: None
+
+    config = ORG_SIZES[size]
+    accounts = make_account_ids(config['accounts'])
+    tag_values = [f"team-{i}" for i in range(config['tag_values'])]
+    fake = fake_aws.FakeCostExplorer(
+        accounts=accounts, services=config['services'], tag_key=report.TEAM_TAG_KEY,
+        tag_values=tag_values, latency_ms=latency_ms, page_size=page_size
+    )
+    report.cost_explorer = fake
+    report.ses_clients[os.environ.get('AWS_REGION', 'us-east-1')] = fake_aws.FakeSES()
+    report.accountDict = {acct_id: f"Account {acct_id[-4:]}" for acct_id in accounts}
+    report.displayListMonthly = accounts[:DISPLAY_ACCOUNTS] + ['monthTotal']
+    report.TEAM_TAG_VALUE = tag_values[0]
+    report.init_report_window()
+    return report, fake
+
+def stage_functions(report):
+    """Returns [(stage, fn(previous_result))] for the summary pipeline."""
+    return [
+        ('fetch', lambda _: report.ce_get_costinfo_per_account(report.accountDict)),
+        ('monthly', report.process_costchanges_per_month),
+        ('display', report.process_costchanges_for_display),
+        ('percent', report.process_percentchanges_per_month),
+        ('summary_html', lambda display: report.create_report_html(display, report.BODY_HTML)),
+        ('lambda_handler', lambda _: report.lambda_handler({}, None)),
+    ]
+
+def run_pass(report, trace):
+    """Runs every stage once; returns {stage: measurements}."""
+    results = {}
+    value = None
+    for stage, fn in stage_functions(report):
+        if trace:
+            tracemalloc.start()
+        started = time.perf_counter()
+        out = fn(value)
+        elapsed = time.perf_counter() - started
+        if stage != 'lambda_handler':
+            value = out
+        if trace:
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results[stage] = {'alloc_peak_bytes': peak, 'alloc_net_bytes': current}
+        else:
+            results[stage] = {'wall_s': elapsed}
+    return results
+
+def run_size(size, latency_ms, page_size, trace_alloc):
+    """Benchmarks one org size in this process and returns its result dict."""
+    report, fake = setup(size, latency_ms, page_size)
+
+    fake.reset_counters()
+    stages = run_pass(report, trace=False)
+    ce_calls = sum(fake.calls.values())
+    ce_pages = fake.pages
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    if trace_alloc:
+        for stage, allocs in run_pass(report, trace=True).items():
+            stages[stage].update(allocs)
+
+    return {
+        'org': ORG_SIZES[size],
+        'stages': stages,
+        'wall_s': sum(stages[stage]['wall_s'] for stage in STAGES if stage != 'lambda_handler'),
+        'lambda_handler_s': stages['lambda_handler']['wall_s'],
+        'peak_rss_kb': peak_rss_kb,
+        'ce_calls': ce_calls,
+        'ce_pages': ce_pages,
+    }
+
+def run_child(size, args):
+    command = [sys.executable, os.path.abspath(__file__), '--child', size,
+               '--latency-ms', str(args.latency_ms), '--page-size', str(args.page_size)]
+    if not args.trace_alloc:
+        command.append('--no-trace-alloc')
+    out = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR,
+                              check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_size(size, result):
+    print(f"\n{size}: {result['org']['accounts']} accounts x {result['org']['services']} services "
+          f"x {result['org']['tag_values']} tag values  ce_calls={result['ce_calls']} pages={result['ce_pages']} "
+          f"peak_rss={result['peak_rss_kb'] / 1024:.1f} MiB")
+    for stage in STAGES:
+        numbers = result['stages'][stage]
+        line = f"  {stage:<15} wall={numbers['wall_s'] * 1000:10.1f}ms"
+        if 'alloc_peak_bytes' in numbers:
+            line += (f"  alloc_peak={numbers['alloc_peak_bytes'] / 1024:10.1f} KiB"
+                     f"  alloc_net={numbers['alloc_net_bytes'] / 1024:10.1f} KiB")
+        print(line)
+
+def print_comparison(current, previous):
+    print(f"\nchange vs {previous.get('revision') or previous.get('timestamp')}:")
+    for size, result in current['sizes'].items():
+        before = previous.get('sizes', {}).get(size)
+        if not before:
+            continue
+        for stage in STAGES:
+            for metric, value in result['stages'][stage].items():
+                old = before['stages'].get(stage, {}).get(metric)
+                if old:
+                    print(f"  {size:<7} {stage:<15} {metric:<17} {(value - old) / old:+8.1%}")
+        old_rss = before.get('peak_rss_kb')
+        if old_rss:
+            print(f"  {size:<7} {'peak_rss_kb':<33} {(result['peak_rss_kb'] - old_rss) / old_rss:+8.1%}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', default='small,medium,huge', help=f"comma separated, from {', '.join(ORG_SIZES)}")
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='fake Cost Explorer latency per request')
+    parser.add_argument('--page-size', type=int, default=1000, help='fake Cost Explorer groups per page')
+    parser.add_argument('--no-trace-alloc', dest='trace_alloc', action='store_false',
+                        help='skip the tracemalloc pass (it is slow for the huge org)')
+    parser.add_argument('--out', help='result file (default: results/pipeline-<timestamp>.json)')
+    parser.add_argument('--compare', help='earlier result file to diff against')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_size(args.child, args.latency_ms, args.page_size, args.trace_alloc)))
+        return
+
+    timestamp = time.strftime('%Y%m%dT%H%M%S')
+    results = {
+        'timestamp': timestamp,
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'latency_ms': args.latency_ms,
+        'page_size': args.page_size,
+        'sizes': {},
+    }
+    for size in args.sizes.split(','):
+        results['sizes'][size] = run_child(size, args)
+        print_size(size, results['sizes'][size])
+
+    out = args.out or os.path.join(BENCH_DIR, 'results', f"pipeline-{timestamp}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {out}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(results, json.load(f))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,388 @@
+"""
+Regression checks for the report Lambda, run against the fakes in
+fake_aws.py. Every check loads a fresh module with its own environment,
+so they are independent of each other and of the order they run in.
+
+    python new/bench/regressions.py            # every check
+    python new/bench/regressions.py drill_down # checks whose name contains drill_down
+"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import traceback
+from datetime import datetime, timedelta
+
+from common import load_report_module, make_account_ids
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+import fake_aws
+
+BASE_ENV = {
+    'CE_CACHE_ENABLED': 'false', 'CE_REQUESTS_PER_SECOND': '100000', 'CE_REQUEST_BURST': '100000',
+    'AWS_REGION': 'us-east-1', 'METRICS_SINK': 'off',
+}
+
+# Cleared before every check, so one check's settings never leak into the next
+OPTIONAL_ENV = ['DRILL_DOWN', 'TIME_BUDGET_RESERVE_MS', 'CHECKPOINT_DIR', 'CE_GRANULARITY', 'CE_COALESCE',
+                'CE_REQUEST_BUDGET', 'TEAM_GROUPBY_TAG', 'CHECKPOINT_RUN_ID', 'CHECKPOINT_BUCKET', 'CE_INCREMENTAL',
+                'CE_CACHE_DIR', 'SHARD_SIZE', 'SHARD_EXECUTOR', 'SHARD_DIR',
+                'REPORT_API_USAGE', 'CE_WINDOW_MONTHS', 'SUMMARY_RESERVE_MS', 'REPORT_S3_BUCKET']
+
+def setup(env=None, accounts=40, services=30, **fake_options):
+    """
+    Loads the report with BASE_ENV plus env, wired to a fake Cost Explorer
+    and SES. Returns (report, fake Cost Explorer, fake SES). The fake
+    records the params of every get_cost_and_usage call in fake.queries.
+    """
+    for key in set(os.environ) & set(OPTIONAL_ENV):
+        del os.environ[key]
+    os.environ.update(BASE_ENV, **(env or {}))
+    report = load_report_module()
+    report.print = lambda *a, **k: None
+
+    account_ids = make_account_ids(accounts)
+    fake = fake_aws.FakeCostExplorer(accounts=account_ids, services=services, tag_key=report.TEAM_TAG_KEY,
+                                     tag_values=['team-0', 'team-1'], **fake_options)
+    fake.queries = []
+    get_cost_and_usage = fake.get_cost_and_usage
+
+    def recording(**params):
+        fake.queries.append(params)
+        return get_cost_and_usage(**params)
+    fake.get_cost_and_usage = recording
+
+    ses = fake_aws.FakeSES()
+    report.cost_explorer = fake
+    report.ses_clients['us-east-1'] = ses
+    report.accountDict = {acct_id: f"Account {acct_id[-4:]}" for acct_id in account_ids}
+    report.displayListMonthly = account_ids[:5] + ['monthTotal']
+    report.TEAM_TAG_VALUE = 'team-0'
+    report.init_report_window()
+    return report, fake, ses
+
+def filtered_accounts(params):
+    """Every LINKED_ACCOUNT value a query filters on."""
+    values = []
+    stack = [params.get('Filter') or {}]
+    while stack:
+        node = stack.pop()
+        stack += node.get('And', []) + node.get('Or', [])
+        dimensions = node.get('Dimensions') or {}
+        if dimensions.get('Key') == 'LINKED_ACCOUNT':
+            values += dimensions['Values']
+    return values
+
+def check_drill_down_skips_pseudo_accounts():
+    """'monthTotal' and 'Others' are summary rows, never drill-down accounts."""
+    report, fake, ses = setup({'DRILL_DOWN': 'true', 'INCLUDE_SERVICE_BREAKDOWN': 'true'})
+    report.DRILL_DOWN_PCT_THRESHOLD = 0.03
+    report.lambda_handler({}, None)
+
+    summary = report.process_costchanges_per_month(report.ce_get_costinfo_per_account(report.accountDict))
+    moved = report.moved_accounts(summary, 0.0, 0.0)
+    assert moved and set(moved) <= set(report.accountDict), moved
+    queried = {acct_id for params in fake.queries for acct_id in filtered_accounts(params)}
+    assert queried <= set(report.accountDict), queried - set(report.accountDict)
+    assert '(monthTotal)' not in ses.sent[0] and '(Others)' not in ses.sent[0]
+
+def summary_queries(fake):
+    return [params for params in fake.queries
+            if params.get('GroupBy') == [{'Type': 'DIMENSION', 'Key': 'LINKED_ACCOUNT'}]]
+
+def check_summary_fetched_first_under_deadline():
+    """With less than SUMMARY_RESERVE_MS left, the summary is fetched, not left to wait on the detail."""
+    report, fake, ses = setup({'INCLUDE_SERVICE_BREAKDOWN': 'true', 'TEAM_GROUPBY_TAG': 'true',
+                               'TIME_BUDGET_RESERVE_MS': '0'}, latency_ms=150)
+    rendered = []
+    render_report = report.render_report
+    report.render_report = lambda data, budget: rendered.append(data) or render_report(data, budget)
+    report.lambda_handler({}, fake_aws.FakeLambdaContext(remaining_ms=400))
+    assert summary_queries(fake) and report.ce_coalescer.stats['derived'] == 0
+    # Issued with the first batch of detail queries, not after all of them
+    assert fake.queries.index(summary_queries(fake)[0]) < report.CE_MAX_WORKERS, 'summary fetched last'
+    assert 'Incomplete report' in ses.sent[0], 'nothing was cut'
+    assert set(rendered[0]['summary']) == set(report.accountDict)
+
+def check_summary_derived_under_deadline():
+    """A Lambda deadline with time to spare still derives the summary from the detail."""
+    reference, _, reference_ses = setup({'INCLUDE_SERVICE_BREAKDOWN': 'true'})
+    reference.lambda_handler({}, None)
+
+    report, fake, ses = setup({'INCLUDE_SERVICE_BREAKDOWN': 'true'})
+    report.lambda_handler({}, fake_aws.FakeLambdaContext(remaining_ms=900000))
+    assert not summary_queries(fake) and report.ce_coalescer.stats['derived'] > 0
+    assert ses.sent[0] == reference_ses.sent[0]
+
+def check_summary_fetched_after_detail_cut():
+    """Detail cut by the deadline: the summary is fetched in the time held back for it."""
+    report, fake, ses = setup({'INCLUDE_SERVICE_BREAKDOWN': 'true', 'TEAM_GROUPBY_TAG': 'true',
+                               'TIME_BUDGET_RESERVE_MS': '0', 'SUMMARY_RESERVE_MS': '300'}, latency_ms=300)
+    rendered = []
+    render_report = report.render_report
+    report.render_report = lambda data, budget: rendered.append(data) or render_report(data, budget)
+    # The detail stops after about 1.7s of its 3s; the handler has as long to get there
+    report.lambda_handler({}, fake_aws.FakeLambdaContext(remaining_ms=2000))
+    assert summary_queries(fake) and report.ce_coalescer.stats['derived'] == 0
+    # Asked for once the detail stopped, not alongside it
+    assert fake.queries.index(summary_queries(fake)[0]) >= report.CE_MAX_WORKERS
+    assert 'Incomplete report' in ses.sent[0], 'nothing was cut'
+    assert set(rendered[0]['summary']) == set(report.accountDict)
+
+def check_summary_derived_only_from_complete_detail():
+    """Without a deadline the summary is derived, unless a detail stage was cut."""
+    report, fake, ses = setup({'INCLUDE_SERVICE_BREAKDOWN': 'true', 'CE_COALESCE': 'false'})
+    reference = report.ce_get_costinfo_per_account(report.accountDict)
+
+    report, fake, ses = setup({'INCLUDE_SERVICE_BREAKDOWN': 'true'})
+    report.lambda_handler({}, None)
+    assert not summary_queries(fake) and report.ce_coalescer.stats['derived'] > 0
+    data = report.process_costchanges_per_month(report.ce_get_costinfo_per_account(report.accountDict))
+    assert data.keys() == report.process_costchanges_per_month(reference).keys()
+
+    report, fake, ses = setup({'INCLUDE_SERVICE_BREAKDOWN': 'true', 'CE_REQUEST_BUDGET': '3'})
+    report.lambda_handler({}, None)
+    assert summary_queries(fake) and report.ce_coalescer.stats['derived'] == 0
+    assert 'request budget' in ses.sent[0]
+
+def check_rerun_after_completed_checkpointed_run():
+    """A completed run leaves no checkpoints behind; rerunning its id fetches fresh costs."""
+    root = tempfile.mkdtemp(prefix='regressions-')
+    try:
+        s3 = fake_aws.LocalS3(os.path.join(root, 's3'))
+        env = {'CHECKPOINT_RUN_ID': 'nightly', 'CHECKPOINT_BUCKET': 'reports', 'INCLUDE_SERVICE_BREAKDOWN': 'true'}
+
+        def run(container, services):
+            # Every run gets a fresh local directory, as a new Lambda container would
+            report, fake, ses = setup(dict(env, CHECKPOINT_DIR=os.path.join(root, container)), services=services)
+            report.s3_client = s3
+            report.lambda_handler({}, None)
+            return report, ses.sent[0]
+
+        report, first = run('first', services=30)
+        run_id = report.checkpoint_run_id({})
+        assert run_id.startswith('nightly-'), run_id
+        stored = s3.list_objects_v2(Bucket='reports', Prefix=report.CHECKPOINT_PREFIX)['Contents']
+        assert [obj['Key'] for obj in stored] == [f"{report.CHECKPOINT_PREFIX}{run_id}-complete.json"], stored
+
+        # Same run id, changed costs: the rerun must not replay the first run's pages
+        report, rerun = run('second', services=25)
+        assert report.ce_retry_stats['resumed_pages'] == 0
+        reference, _, reference_ses = setup({'INCLUDE_SERVICE_BREAKDOWN': 'true'}, services=25)
+        reference.lambda_handler({}, None)
+        assert rerun != first and rerun == reference_ses.sent[0], 'rerun report differs from a fresh run'
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def check_api_usage_is_thread_safe():
+    """Concurrent charge / record / exhausted keep exact totals and never pass the budget."""
+    report = setup()[0]
+    usage = report.ApiUsage(request_budget=20000)
+    refused = []
+    errors = []
+
+    def worker(index):
+        try:
+            for n in range(4000):
+                # New stages keep growing the ledger while others read it
+                stage = f"stage-{index}-{n % 50}"
+                try:
+                    report.run_in_api_stage(stage, usage.charge, 'ce')
+                except report.RequestBudgetExceeded:
+                    refused.append(stage)
+                    continue
+                report.run_in_api_stage(stage, usage.record, 'ce', {}, 10)
+                usage.exhausted()
+                usage.requests('ce')
+        except Exception as e:
+            errors.append(e)
+
+    # Switch threads as often as possible, so unlocked reads meet the writes
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=worker, args=(index,)) for index in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert not errors, errors
+    assert usage.requests('ce') == 20000 and len(refused) == 8 * 4000 - 20000
+    assert sum(row[2] for row in usage.rows()) == 20000 and sum(row[3] for row in usage.rows()) == 20000
+
+def check_incremental_watermark_advances_for_hourly():
+    """HOURLY periods are timestamps; the watermark must still move past the final ones."""
+    root = tempfile.mkdtemp(prefix='regressions-')
+    try:
+        # Early in the month, so the days around the month start are within the HOURLY retention
+        report, fake, ses = setup({'CE_CACHE_ENABLED': 'true', 'CE_INCREMENTAL': 'true', 'CE_CACHE_DIR': root},
+                                  accounts=3, services=5, now=datetime.now().replace(day=3))
+        # Two closed days before the fake's Estimated month, and a window reaching into it
+        closed = {'Start': (fake.estimated_from - timedelta(days=2)).strftime('%Y-%m-%d'),
+                  'End': fake.estimated_from.strftime('%Y-%m-%d')}
+        current = dict(closed, End=(fake.estimated_from + timedelta(days=1)).strftime('%Y-%m-%d'))
+
+        params = {'Granularity': 'HOURLY', 'Metrics': ['UnblendedCost'],
+                  'GroupBy': [{'Type': 'DIMENSION', 'Key': 'SERVICE'}]}
+
+        def fetch(window):
+            return report._get_cost_and_usage_cached(dict(params, TimePeriod=window))
+
+        first = fetch(closed)
+        assert len(first) == 48 and len(fake.queries) == 1
+        # Every hour was final: the second run is served from the history alone
+        assert fetch(closed) == first and len(fake.queries) == 1
+
+        fetch(current)
+        assert fetch(current)[:48] == first
+        history = report.get_ce_cache().get(report.history_key(params, closed['Start']))
+        assert history['final_through'] == closed['End'] + 'T00:00:00Z', history['final_through']
+        # Only the Estimated day is requested again
+        assert fake.queries[-1]['TimePeriod'] == {'Start': closed['End'] + 'T00:00:00Z',
+                                                  'End': current['End'] + 'T00:00:00Z'}, fake.queries[-1]['TimePeriod']
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def check_hourly_outside_retention_is_refused():
+    """HOURLY is refused for a report window older than Cost Explorer keeps hourly data."""
+    try:
+        setup({'CE_GRANULARITY': 'HOURLY'})
+    except ValueError as e:
+        assert 'HOURLY' in str(e), e
+    else:
+        raise AssertionError('HOURLY report window accepted')
+
+    # The fake rejects such queries the way the service does
+    report, fake, ses = setup()
+    try:
+        report.fetch_cost_and_usage({'TimePeriod': {'Start': report.MONTHLY_START_DATE, 'End': report.MONTHLY_END_DATE},
+                                     'Granularity': 'HOURLY', 'Metrics': ['UnblendedCost']})
+    except fake_aws.ClientError as e:
+        assert e.response['Error']['Code'] == 'ValidationException', e.response
+    else:
+        raise AssertionError('HOURLY query past the retention served')
+
+def check_cube_nbytes_counts_every_plane():
+    """A cube's nbytes covers the planes of every metric, not just the first."""
+    report = setup()[0]
+    metrics = ['UnblendedCost', 'AmortizedCost', 'UsageQuantity']
+    single, multi = report.CostCube(['2024-01-01', '2024-02-01']), report.CostCube(['2024-01-01', '2024-02-01'], metrics)
+    for cube in (single, multi):
+        for acct_id in ('111111111111', '222222222222'):
+            cube.add_metrics(acct_id, 'Amazon EC2', '2024-02-01',
+                             {metric: {'Amount': '1.5', 'Unit': 'USD'} for metric in metrics})
+    assert multi.nbytes() == len(metrics) * single.nbytes() > 0, (multi.nbytes(), single.nbytes())
+
+def check_daily_cube_axis_laid_out_up_front():
+    """A DAILY fetch fills cubes whose period axis already holds every day of the window."""
+    report, fake, ses = setup({'CE_GRANULARITY': 'DAILY'})
+    periods = report.cube_periods()
+    assert periods[0] == report.MONTHLY_START_DATE and len(periods) == len(set(periods)) > len(report.MONTHLY_COST_DATES)
+    cube = report.CostCube(periods, report.CE_METRICS).add_results(report.iter_cost_data(list(report.accountDict), None))
+    # No period arrived that the axis did not already have, so no block was re-laid
+    assert cube.periods == periods, set(cube.periods) - set(periods)
+
+def check_incremental_runs_match_full_fetch():
+    """Repeated CE_INCREMENTAL runs over several sub-windows report what a plain fetch does."""
+    root = tempfile.mkdtemp(prefix='regressions-')
+    try:
+        env = {'INCLUDE_SERVICE_BREAKDOWN': 'true', 'REPORT_API_USAGE': 'false', 'CE_WINDOW_MONTHS': '1',
+               'CE_GRANULARITY': 'DAILY'}
+
+        def run(run_env):
+            report, fake, ses = setup(dict(env, **run_env), accounts=10, services=8)
+            # Four one-month windows, the last one still Estimated
+            report.MONTHSBACK = 4
+            report.first_of_this_month = None
+            report.init_report_window()
+            fake.estimated_from = datetime.strptime(report.MONTHLY_COST_DATES[-1], '%Y-%m-%d').date()
+            report.lambda_handler({}, None)
+            return report, fake, ses.sent[0]
+
+        reference = run({'CE_CACHE_ENABLED': 'false'})[2]
+        queries = []
+        for _ in range(3):
+            report, fake, sent = run({'CE_CACHE_ENABLED': 'true', 'CE_INCREMENTAL': 'true', 'CE_CACHE_DIR': root})
+            assert sent == reference, 'incremental report differs from a full fetch'
+            queries.append(len(fake.queries))
+        # Later runs only refetch the Estimated month, once per query shape
+        assert queries[1] == queries[2] < queries[0], queries
+        assert all(params['TimePeriod']['Start'] >= report.MONTHLY_COST_DATES[-1] for params in fake.queries)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def check_s3_copy_rendered_once():
+    """With REPORT_S3_BUCKET the report is rendered once, for both the S3 copy and the email."""
+    root = tempfile.mkdtemp(prefix='regressions-')
+    try:
+        report, fake, ses = setup({'INCLUDE_SERVICE_BREAKDOWN': 'true', 'REPORT_S3_BUCKET': 'reports'})
+        s3 = report.s3_client = fake_aws.LocalS3(root)
+        passes = []
+        render_report = report.render_report
+
+        def counting_render(data, budget):
+            fragments = render_report(data, budget)
+
+            def counted():
+                passes.append(1)
+                return fragments()
+            return counted
+        report.render_report = counting_render
+        report.lambda_handler({}, None)
+        key = report.REPORT_S3_KEY.format(date=report.MONTHLY_END_DATE)
+        assert len(passes) == 1, passes
+        assert s3.get_object(Bucket='reports', Key=key)['Body'].read().decode('utf-8') == ses.sent[0]
+
+        # An upload failing part way still leaves the email complete
+        reference = ses.sent[0]
+        upload_fileobj = s3.upload_fileobj
+
+        def failing_upload(Fileobj, Bucket, Key, **kwargs):
+            Fileobj.read(1000)
+            raise fake_aws._ce_error('InternalError', 'upload failed', 'PutObject')
+        s3.upload_fileobj = failing_upload
+        report.lambda_handler({}, None)
+        s3.upload_fileobj = upload_fileobj
+        assert ses.sent[-1] == reference and len(passes) == 2
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def check_sharded_run_deletes_partials():
+    """A sharded run merges its shard partials, then deletes them."""
+    root = tempfile.mkdtemp(prefix='regressions-')
+    try:
+        # Shards make more requests than one run: compare without the API usage footer
+        env = {'INCLUDE_SERVICE_BREAKDOWN': 'true', 'REPORT_API_USAGE': 'false'}
+        report, fake, ses = setup(dict(env, SHARD_SIZE='15', SHARD_EXECUTOR='process', SHARD_DIR=root))
+        report.lambda_handler({}, None)
+        assert not os.listdir(root), os.listdir(root)
+
+        reference, _, reference_ses = setup(env)
+        reference.lambda_handler({}, None)
+        assert ses.sent[0] == reference_ses.sent[0], 'sharded report differs from an unsharded run'
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def main():
+    pattern = sys.argv[1] if len(sys.argv) > 1 else ''
+    checks = [(name, fn) for name, fn in sorted(globals().items())
+              if name.startswith('check_') and pattern in name]
+    failures = 0
+    for name, fn in checks:
+        try:
+            fn()
+            print(f"ok    {name}")
+        except Exception:
+            failures += 1
+            print(f"FAIL  {name}")
+            traceback.print_exc()
+    if failures:
+        sys.exit(f"{failures} of {len(checks)} checks failed")
+    print(f"all {len(checks)} checks passed")
+
+if __name__ == '__main__':
+    main()
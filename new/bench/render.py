@@ -0,0 +1,142 @@
+"""
+Compares the string-concatenating HTML renderers with the fragment
+generators for a large per-service breakdown.
+
+Both variants render the same CostCube; the legacy ones are the `+=`
+implementations the report used before the renderers were turned into
+generators. Peak memory is measured with tracemalloc around each render.
+
+    python new/bench/render.py --rows 50000 --accounts 200
+"""
+import argparse
+import time
+import tracemalloc
+
+from common import load_report_module, make_account_ids
+
+def legacy_generate_html_table(report, cost_cube, display_cost_data_dict, deltas):
+    sorted_months = sorted(cost_cube.periods)
+    num_periods = len(sorted_months)
+    columns = (num_periods * 1) + (num_periods - 1)
+
+    def row_color(i_row):
+        return "<tr style='background-color: WhiteSmoke;'>" if (i_row % 2) == 0 else "<tr>"
+
+    emailHTML = "<h2>AWS Monthly Cost Report - Per Service Breakdown</h2>"
+    emailHTML += '<table border="1" style="border-collapse:collapse; font-family:Arial,sans-serif;">'
+
+    for acct_id, services in display_cost_data_dict.items():
+        acct_name = report.accountDict.get(acct_id, acct_id)
+        emailHTML += f'<tr style="background-color:SteelBlue;"><td colspan="{columns}" style="text-align:center; font-weight:bold;">'
+        emailHTML += f'{acct_name} ({acct_id})</td></tr>'
+
+        emailHTML += '<tr style="background-color:LightSteelBlue;">'
+        emailHTML += '<td style="text-align:center; font-weight:bold;">Service Name</td>'
+        for idx, m in enumerate(sorted_months):
+            if idx > 0:
+                emailHTML += '<td style="text-align:center;">Δ%</td>'
+            emailHTML += f'<td style="text-align:center; font-weight:bold;">{m}</td>'
+        emailHTML += '</tr>'
+
+        i_row = 0
+        for svc, monthly_data in services.items():
+            rsrcrowHTML = ''
+            rsrcrowHTML += row_color(i_row)
+            rsrcrowHTML += f'<td style="text-align:left;">{svc}</td>'
+            for idx, m in enumerate(sorted_months):
+                curr_cost = monthly_data.get(m, 0.0)
+                if idx > 0:
+                    rsrcrowHTML += report.change_cell_html(deltas.percent(acct_id, svc, m))
+                rsrcrowHTML += f'<td style="text-align:right; padding:4px;">$ {curr_cost:,.2f}</td>'
+            rsrcrowHTML += '</tr>'
+            emailHTML += rsrcrowHTML
+            i_row += 1
+
+    emailHTML += '</table>'
+    return emailHTML
+
+def legacy_generate_html_table_with_team(report, final_info, acct_no, team_name=None):
+    team_label = f"Team {team_name}" if team_name else "Team"
+    html = report.TEAM_HEADING(team_label, acct_no)
+    for svc in sorted(final_info.keys()):
+        row = final_info[svc]
+        html += "<tr>"
+        html += f"<td style='padding:4px;'>{svc}</td>"
+        html += f"<td style='text-align:right; padding:4px;'>$ {row['overallCurr']:,.2f}</td>"
+        for pct in (row["overallDeltaPct"], row["teamDeltaPct"]):
+            if pct is not None:
+                html += f"<td style='text-align:right; padding:4px;'>{report.change_span_html(pct)}</td>"
+            else:
+                html += "<td>&nbsp;</td>"
+        html += f"<td style='text-align:right; padding:4px;'>$ {row['teamDeltaDollar']:,.2f}</td>"
+        html += "</tr>"
+    html += "</table>"
+    return html
+
+def build_cube(report, accounts, services_per_account, months):
+    cube = report.CostCube(months)
+    for a, acct_id in enumerate(accounts):
+        for s in range(services_per_account):
+            service = f"Service {s:04d}"
+            for m, month in enumerate(months):
+                cube.add(acct_id, service, month, float((a * 7 + s * 13 + m * 101) % 5000) + 0.25)
+    return cube
+
+def measure(label, fn):
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    size = result if isinstance(result, int) else len(result)
+    print(f"{label:<24} render={elapsed:7.3f}s  peak={peak / 2**20:8.1f} MiB  output={size / 2**20:7.1f} MiB")
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, default=50000, help='service rows in total')
+    parser.add_argument('--accounts', type=int, default=200)
+    parser.add_argument('--months', type=int, default=3)
+    args = parser.parse_args()
+
+    report = load_report_module()
+    report.print = lambda *a, **k: None
+    report.init_report_window()
+
+    months = report.MONTHLY_COST_DATES[-args.months:]
+    accounts = make_account_ids(args.accounts)
+    cube = build_cube(report, accounts, max(1, args.rows // args.accounts), months)
+    display_dict = cube.to_service_dict(accounts)
+    deltas = report.CostDeltas(cube, 1)
+    merged = [(acct_id, report.merge_team_deltas(acct_id, cube, cube, deltas, deltas)) for acct_id in accounts]
+
+    print(f"{args.accounts} accounts x {args.rows // args.accounts} services x {len(months)} months")
+    old = measure('legacy breakdown', lambda: legacy_generate_html_table(report, cube, display_dict, deltas))
+    new = measure('streamed breakdown', lambda: report.generate_html_table(cube, display_dict, deltas))
+    assert old == new, 'breakdown renderers disagree'
+    del old, new
+
+    old = measure('legacy team tables', lambda: ''.join(
+        legacy_generate_html_table_with_team(report, info, acct_id) + '<br><br>' for acct_id, info in merged))
+    new = measure('streamed team tables', lambda: ''.join(
+        report.generate_html_table_with_team(info, acct_id) + '<br><br>' for acct_id, info in merged))
+    assert old == new, 'team renderers disagree'
+    del old, new
+
+    # Consuming the generator chunk by chunk (as the S3 upload does) never
+    # materialises the whole document.
+    measure('streamed breakdown read', lambda: drain(report.FragmentReader(
+        report.iter_html_table(cube, display_dict, deltas))))
+
+def drain(reader):
+    """Reads reader to the end in 1 MiB chunks and returns the byte count."""
+    total = 0
+    while True:
+        chunk = reader.read(1024 * 1024)
+        if not chunk:
+            return total
+        total += len(chunk)
+
+if __name__ == '__main__':
+    main()
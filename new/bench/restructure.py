@@ -0,0 +1,99 @@
+"""
+Compares the original two-pass restructure_cost_data with the current
+single-pass, interned version on a synthetic (LINKED_ACCOUNT, SERVICE)
+response set.
+
+The responses go through a JSON round trip, like real API responses, so
+every service name and date is a separate string object.
+
+    python new/bench/restructure.py --accounts 500 --services 300 --months 12
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+from common import load_report_module, make_account_ids
+
+def legacy_restructure_cost_data(cost_data_dict, account_numbers):
+    """The original implementation, kept here as the baseline."""
+    display_cost_data_dict = {}
+
+    for acct in account_numbers:
+        display_cost_data_dict[acct] = {}
+
+    for time_period in cost_data_dict:
+        for group in time_period['Groups']:
+            acct_no = group['Keys'][0]
+            service_name = group['Keys'][1]
+            if acct_no in display_cost_data_dict:
+                display_cost_data_dict[acct_no][service_name] = {}
+
+    for time_period in cost_data_dict:
+        date = time_period['TimePeriod']['Start']
+        for group in time_period['Groups']:
+            acct_no = group['Keys'][0]
+            service_name = group['Keys'][1]
+            amount = float(group['Metrics']['UnblendedCost']['Amount'])
+            if acct_no in display_cost_data_dict and service_name in display_cost_data_dict[acct_no]:
+                display_cost_data_dict[acct_no][service_name][date] = amount
+
+    sorted_dict = {}
+    for acct_no, services in display_cost_data_dict.items():
+        sorted_services = dict(sorted(services.items()))
+        sorted_dict[acct_no] = sorted_services
+
+    return sorted_dict
+
+def make_results(accounts, services, months):
+    results = []
+    for m, month in enumerate(months):
+        groups = [
+            {'Keys': [acct_id, service],
+             'Metrics': {'UnblendedCost': {'Amount': f"{(a * 31 + s * 7 + m) % 997 + 0.5:.10f}", 'Unit': 'USD'}}}
+            for a, acct_id in enumerate(accounts)
+            for s, service in enumerate(services)
+            # Not every account uses every service
+            if (a + s) % 5
+        ]
+        results.append({'TimePeriod': {'Start': month, 'End': month}, 'Total': {}, 'Groups': groups, 'Estimated': False})
+    return json.loads(json.dumps(results))
+
+def measure(label, fn, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    result = fn()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<8} best={best:7.3f}s  retained={retained / 2**20:7.1f} MiB  peak={peak / 2**20:7.1f} MiB")
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--accounts', type=int, default=500)
+    parser.add_argument('--services', type=int, default=300)
+    parser.add_argument('--months', type=int, default=12)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    report = load_report_module()
+    report.print = lambda *a, **k: None
+
+    accounts = make_account_ids(args.accounts)
+    services = [f"Amazon Service {i:03d}" for i in range(args.services)]
+    months = [f"{2000 + i // 12:04d}-{i % 12 + 1:02d}-01" for i in range(args.months)]
+    results = make_results(accounts, services, months)
+    print(f"{args.accounts} accounts x {args.services} services x {args.months} months "
+          f"({sum(len(r['Groups']) for r in results)} groups)")
+
+    old_time, old = measure('legacy', lambda: legacy_restructure_cost_data(results, accounts), args.repeat)
+    new_time, new = measure('current', lambda: report.restructure_cost_data(results, accounts), args.repeat)
+    print(f"speedup: {old_time / new_time:.2f}x  identical output: {old == new and list(map(list, old.values())) == list(map(list, new.values()))}")
+
+if __name__ == '__main__':
+    main()
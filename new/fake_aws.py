@@ -0,0 +1,544 @@
+"""
+Local stand-ins for the AWS services the cost report Lambda talks to.
+
+Nothing here is used in the deployed Lambda; it exists so the report can be
+exercised offline, e.g.:
+
+    report.ce_cache = report.CostResponseCache(
+        '/tmp/ce-cache', LocalS3('/tmp/fake-s3'), bucket='reports', prefix='ce-cache/')
+    report.cost_explorer = FakeCostExplorer(accounts=500, services=200, latency_ms=80)
+    report.organizations_client = FakeOrganizations(accounts=report.cost_explorer.accounts, ous=5)
+    report.lambda_handler({}, FakeLambdaContext(remaining_ms=60000))
+
+or, against the HTTP endpoint with a real boto3 client:
+
+    python new/fake_aws.py --accounts 500 --throttle-rate 0.05 --port 8787
+
+and CE_ENDPOINT_URL=http://127.0.0.1:8787 set for the report (any dummy
+credentials will do).
+"""
+import argparse
+import io
+import json
+import os
+import random
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from botocore.exceptions import ClientError
+
+class LocalS3:
+    """
+    Directory-backed stand-in for the subset of the S3 client used by the
+    report (get_object / put_object / upload_fileobj / list_objects_v2 /
+    delete_objects). Objects live at root/bucket/key.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+
+    def get_object(self, Bucket, Key, **kwargs):
+        path = self._path(Bucket, Key)
+        if not os.path.exists(path):
+            raise ClientError(
+                {'Error': {'Code': 'NoSuchKey', 'Message': 'The specified key does not exist.'}},
+                'GetObject'
+            )
+        with open(path, 'rb') as f:
+            return {'Body': io.BytesIO(f.read()), 'ContentLength': os.path.getsize(path)}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        elif hasattr(Body, 'read'):
+            Body = Body.read()
+        with open(path, 'wb') as f:
+            f.write(Body)
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix='', ContinuationToken=None, MaxKeys=1000, **kwargs):
+        bucket_root = os.path.join(self.root, Bucket)
+        keys = []
+        for directory, _, names in os.walk(bucket_root):
+            for name in names:
+                key = os.path.relpath(os.path.join(directory, name), bucket_root).replace(os.sep, '/')
+                if key.startswith(Prefix):
+                    keys.append(key)
+        keys.sort()
+        start = int(ContinuationToken or 0)
+        response = {'Contents': [{'Key': key} for key in keys[start:start + MaxKeys]], 'KeyCount': len(keys[start:start + MaxKeys])}
+        if start + MaxKeys < len(keys):
+            response['NextContinuationToken'] = str(start + MaxKeys)
+        return response
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        for obj in Delete['Objects']:
+            path = self._path(Bucket, obj['Key'])
+            if os.path.exists(path):
+                os.remove(path)
+        return {}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, **kwargs):
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            while True:
+                chunk = Fileobj.read(8 * 1024 * 1024)
+                if not chunk:
+                    break
+                f.write(chunk)
+
+
+class FakeSES:
+    """Records send_email calls instead of sending; sent holds the HTML bodies."""
+    def __init__(self):
+        self.sent = []
+
+    def send_email(self, **kwargs):
+        self.sent.append(kwargs['Message']['Body']['Html']['Data'])
+        return {'MessageId': f"fake-{len(self.sent)}"}
+
+class FakeLambdaContext:
+    """
+    Stand-in for the Lambda context object: get_remaining_time_in_millis()
+    counts down from remaining_ms (default: a 15 minute timeout) from the
+    moment it is created.
+    """
+    def __init__(self, remaining_ms=900000, function_name='cost-report', memory_limit_in_mb=512):
+        self.deadline = time.monotonic() + remaining_ms / 1000
+        self.function_name = function_name
+        self.memory_limit_in_mb = memory_limit_in_mb
+        self.aws_request_id = f"fake-{random.getrandbits(32):08x}"
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - time.monotonic()) * 1000))
+
+# -----------------------------------------------------------------------------
+# Cost Explorer
+# -----------------------------------------------------------------------------
+
+def _month_start(day):
+    return day.replace(day=1)
+
+def _next_month(day):
+    return (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+def _crc(text):
+    return zlib.crc32(text.encode('utf-8'))
+
+def _ce_error(code, message, operation):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+# Cost Explorer keeps HOURLY data for this many days only
+HOURLY_DAYS = 14
+
+# Per-metric scale applied to the synthesized UnblendedCost
+METRIC_SCALE = {
+    'UnblendedCost': 1.0,
+    'BlendedCost': 1.0,
+    'AmortizedCost': 0.96,
+    'NetAmortizedCost': 0.91,
+    'NetUnblendedCost': 0.95,
+    'UsageQuantity': 7.5,
+}
+METRIC_UNIT = {'UsageQuantity': 'N/A'}
+
+class FakeCostExplorer:
+    """
+    In-process stand-in for the Cost Explorer client. It synthesizes
+    deterministic get_cost_and_usage / get_dimension_values / get_tags pages
+    for an org of `accounts` x `services` x `tag_values` with `months` of
+    history ending in the current (estimated) month.
+
+    Every account uses roughly `density` of the services; each account and
+    service cost is split across the tag values plus an untagged share.
+    Responses honour TimePeriod, MONTHLY / DAILY / HOURLY granularity, Dimensions /
+    Tags / And filters, up to two GroupBy keys and any of METRIC_SCALE's
+    metrics, and are paginated every `page_size` groups. Like the service,
+    HOURLY queries starting more than HOURLY_DAYS before `now` are rejected.
+
+    latency_ms (+ up to jitter_ms) is slept before every request, and a
+    ThrottlingException ClientError is raised for a `throttle_rate` fraction
+    of them. `calls`, `pages` and `throttled` count what was served.
+    """
+    def __init__(self, accounts=3, services=20, tag_key='Project', tag_values=('core', 'web', 'data'),
+                 months=12, density=0.6, latency_ms=0.0, jitter_ms=0.0, page_size=1000,
+                 throttle_rate=0.0, seed=0, now=None):
+        if isinstance(accounts, int):
+            accounts = [f"{100000000000 + i:012d}" for i in range(accounts)]
+        if isinstance(services, int):
+            services = [f"Amazon Service {i:03d}" for i in range(services)]
+        self.accounts = list(accounts)
+        self.services = list(services)
+        self.tag_key = tag_key
+        self.tag_values = list(tag_values)
+        self.density = density
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.page_size = page_size
+        self.throttle_rate = throttle_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.pages = 0
+        self.throttled = 0
+
+        today = (now or datetime.now()).date()
+        self.estimated_from = _month_start(today)
+        self.history_start = self.estimated_from
+        for _ in range(max(months, 1) - 1):
+            self.history_start = _month_start(self.history_start - timedelta(days=1))
+        self.end = _next_month(today)
+        self.hourly_from = datetime.combine(today - timedelta(days=HOURLY_DAYS), datetime.min.time())
+
+        # Weights are derived from the names, so two fakes with the same
+        # configuration return the same numbers.
+        self.account_weight = {a: 0.5 + (_crc(a) % 1000) / 400.0 for a in self.accounts}
+        self.service_weight = {s: 1.0 + (_crc(s) % 5000) / 10.0 for s in self.services}
+        shares = [1.0 + _crc(t) % 7 for t in self.tag_values] + [2.0]
+        total = sum(shares)
+        self.tag_share = {t: w / total for t, w in zip(self.tag_values + [''], shares)}
+        self._responses = {}
+
+    def reset_counters(self):
+        with self.lock:
+            self.calls = {}
+            self.pages = 0
+            self.throttled = 0
+
+    def uses(self, account, service):
+        return (_crc(account + '|' + service) % 1000) < self.density * 1000
+
+    def monthly_cost(self, account, service, month):
+        """UnblendedCost of one account and service for the month starting at month (a date)."""
+        if not (self.history_start <= month < self.end) or not self.uses(account, service):
+            return 0.0
+        trend = 1.0 + ((_crc(f"{account}|{service}|{month}") % 41) - 20) / 100.0
+        return round(self.account_weight[account] * self.service_weight[service] * trend, 4)
+
+    # -------------------------------------------------------------------------
+
+    def _begin(self, operation):
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            delay = self.latency_ms + self.rng.random() * self.jitter_ms
+            throttle = self.throttle_rate and self.rng.random() < self.throttle_rate
+            if throttle:
+                self.throttled += 1
+        if delay:
+            time.sleep(delay / 1000.0)
+        if throttle:
+            raise _ce_error('ThrottlingException', 'Rate exceeded', operation)
+
+    def _periods(self, time_period, granularity):
+        """Returns (start, end, month, share of the month) per period; start / end are strings."""
+        hourly = granularity == 'HOURLY'
+        fmt = '%Y-%m-%dT%H:%M:%SZ' if hourly else '%Y-%m-%d'
+        try:
+            start = datetime.strptime(time_period['Start'], fmt)
+            end = datetime.strptime(time_period['End'], fmt)
+        except ValueError:
+            raise _ce_error('ValidationException', f"TimePeriod must use {fmt} for {granularity}", 'GetCostAndUsage')
+        if start >= end:
+            raise _ce_error('ValidationException', 'Start date must be before end date', 'GetCostAndUsage')
+        if hourly and start < self.hourly_from:
+            raise _ce_error('ValidationException', f"HOURLY granularity is only available for the last {HOURLY_DAYS} days",
+                            'GetCostAndUsage')
+        periods = []
+        moment = start
+        while moment < end:
+            if hourly:
+                nxt = moment + timedelta(hours=1)
+            elif granularity == 'DAILY':
+                nxt = moment + timedelta(days=1)
+            else:
+                nxt = min(datetime.combine(_next_month(moment.date()), datetime.min.time()), end)
+            month = _month_start(moment.date())
+            # Share of the month this period covers
+            share = (nxt - moment).total_seconds() / ((_next_month(month) - month).days * 86400)
+            periods.append((moment.strftime(fmt), nxt.strftime(fmt), month, share))
+            moment = nxt
+        return periods
+
+    def _matches(self, query_filter):
+        """Returns (accounts, services, tags) allowed by a Dimensions / Tags / And filter."""
+        accounts, services, tags = self.accounts, self.services, self.tag_values + ['']
+        if not query_filter:
+            return accounts, services, tags
+        for part in query_filter.get('And', [query_filter]):
+            if 'Dimensions' in part:
+                values = set(part['Dimensions']['Values'])
+                if part['Dimensions']['Key'] == 'LINKED_ACCOUNT':
+                    accounts = [a for a in accounts if a in values]
+                elif part['Dimensions']['Key'] == 'SERVICE':
+                    services = [s for s in services if s in values]
+            elif 'Tags' in part and part['Tags']['Key'] == self.tag_key:
+                values = set(part['Tags'].get('Values') or [])
+                if 'ABSENT' in part['Tags'].get('MatchOptions', []):
+                    values.add('')
+                tags = [t for t in tags if t in values]
+            elif 'Tags' in part:
+                tags = ['']
+        return accounts, services, tags
+
+    def _group_key(self, group_by, account, service, tag):
+        keys = []
+        for group in group_by:
+            if group['Type'] == 'TAG':
+                keys.append(f"{group['Key']}${tag if group['Key'] == self.tag_key else ''}")
+            elif group['Key'] == 'LINKED_ACCOUNT':
+                keys.append(account)
+            elif group['Key'] == 'SERVICE':
+                keys.append(service)
+            else:
+                keys.append('NoUsageType')
+        return tuple(keys)
+
+    def _metrics(self, metrics, amount):
+        return {m: {'Amount': f"{amount * METRIC_SCALE.get(m, 1.0):.10f}", 'Unit': METRIC_UNIT.get(m, 'USD')}
+                for m in metrics}
+
+    def _cost_and_usage(self, params):
+        """Builds the full (unpaginated) ResultsByTime for a query."""
+        granularity = params.get('Granularity', 'MONTHLY')
+        group_by = params.get('GroupBy') or []
+        if len(group_by) > 2:
+            raise _ce_error('ValidationException', 'GroupBy supports at most two keys', 'GetCostAndUsage')
+        accounts, services, tags = self._matches(params.get('Filter'))
+
+        results = []
+        for start, end, month, share in self._periods(params['TimePeriod'], granularity):
+            totals = {}
+            for account in accounts:
+                for service in services:
+                    cost = self.monthly_cost(account, service, month) * share
+                    if not cost:
+                        continue
+                    for tag in tags:
+                        key = self._group_key(group_by, account, service, tag)
+                        totals[key] = totals.get(key, 0.0) + cost * self.tag_share[tag]
+            result = {
+                'TimePeriod': {'Start': start, 'End': end},
+                'Total': {},
+                'Groups': [],
+                'Estimated': month >= self.estimated_from,
+            }
+            if group_by:
+                result['Groups'] = [
+                    {'Keys': list(key), 'Metrics': self._metrics(params['Metrics'], amount)}
+                    for key, amount in sorted(totals.items())
+                ]
+            else:
+                result['Total'] = self._metrics(params['Metrics'], totals.get((), 0.0))
+            results.append(result)
+        return results
+
+    def get_cost_and_usage(self, **params):
+        self._begin('GetCostAndUsage')
+        query = json.dumps({k: v for k, v in params.items() if k != 'NextPageToken'}, sort_keys=True)
+        offset = int(params.get('NextPageToken') or 0)
+        with self.lock:
+            slots = self._responses.pop(query, None) if offset else None
+        if slots is None:
+            # One slot per group (or per empty period), so pages can be cut by offset
+            slots = [(result, group) for result in self._cost_and_usage(params)
+                     for group in (result['Groups'] or [None])]
+
+        page = []
+        for result, group in slots[offset:offset + self.page_size]:
+            if not page or page[-1]['TimePeriod'] is not result['TimePeriod']:
+                page.append(dict(result, Groups=[]))
+            if group is not None:
+                page[-1]['Groups'].append(group)
+
+        response = {'ResultsByTime': page, 'DimensionValueAttributes': []}
+        with self.lock:
+            self.pages += 1
+            if offset + self.page_size < len(slots):
+                response['NextPageToken'] = str(offset + self.page_size)
+                self._responses[query] = slots
+        return response
+
+    def _paginate(self, values, params, field):
+        offset = int(params.get('NextPageToken') or 0)
+        size = min(params.get('MaxResults') or self.page_size, self.page_size)
+        response = {field: values[offset:offset + size], 'ReturnSize': len(values[offset:offset + size]),
+                    'TotalSize': len(values)}
+        if offset + size < len(values):
+            response['NextPageToken'] = str(offset + size)
+        with self.lock:
+            self.pages += 1
+        return response
+
+    def get_dimension_values(self, **params):
+        self._begin('GetDimensionValues')
+        dimension = params.get('Dimension', 'LINKED_ACCOUNT')
+        if dimension == 'LINKED_ACCOUNT':
+            values = [{'Value': a, 'Attributes': {'description': f"Account {a}"}} for a in self.accounts]
+        elif dimension == 'SERVICE':
+            values = [{'Value': s, 'Attributes': {}} for s in self.services]
+        else:
+            values = []
+        search = params.get('SearchString')
+        if search:
+            values = [v for v in values if search.lower() in v['Value'].lower()]
+        return self._paginate(values, params, 'DimensionValues')
+
+    def get_tags(self, **params):
+        self._begin('GetTags')
+        tags = self.tag_values if params.get('TagKey') == self.tag_key else [self.tag_key]
+        return self._paginate(list(tags), params, 'Tags')
+
+# -----------------------------------------------------------------------------
+# Organizations
+# -----------------------------------------------------------------------------
+
+class FakeOrganizations:
+    """
+    Deterministic stand-in for the Organizations calls used by account
+    discovery (list_roots, list_organizational_units_for_parent,
+    list_accounts_for_parent, list_accounts). `accounts` (ids, or a count)
+    are spread round-robin over `ous` OUs under the root, each with
+    `child_ous` nested OUs; the last `suspended` accounts are SUSPENDED.
+    Every list is paginated every `page_size` items and `calls` counts the
+    requests per operation.
+    """
+    def __init__(self, accounts=3, ous=2, child_ous=1, suspended=0, page_size=20, latency_ms=0.0):
+        if isinstance(accounts, int):
+            accounts = [f"{100000000000 + i:012d}" for i in range(accounts)]
+        self.page_size = page_size
+        self.latency_ms = latency_ms
+        self.lock = threading.Lock()
+        self.calls = {}
+
+        self.root = {'Id': 'r-fake', 'Name': 'Root'}
+        self.children = {self.root['Id']: []}
+        parents = []
+        for i in range(ous):
+            ou = {'Id': f"ou-fake-{i:04d}", 'Name': f"OU {i}"}
+            self.children[self.root['Id']].append(ou)
+            self.children[ou['Id']] = []
+            parents.append(ou['Id'])
+            for j in range(child_ous):
+                child = {'Id': f"ou-fake-{i:04d}-{j:02d}", 'Name': f"OU {i}.{j}"}
+                self.children[ou['Id']].append(child)
+                self.children[child['Id']] = []
+                parents.append(child['Id'])
+        parents = parents or [self.root['Id']]
+
+        self.accounts_by_parent = {parent: [] for parent in self.children}
+        for n, acct_id in enumerate(accounts):
+            self.accounts_by_parent[parents[n % len(parents)]].append({
+                'Id': acct_id,
+                'Arn': f"arn:aws:organizations::000000000000:account/o-fake/{acct_id}",
+                'Name': f"Account {acct_id[-4:]}",
+                'Email': f"owner+{acct_id}@example.com",
+                'Status': 'SUSPENDED' if n >= len(accounts) - suspended else 'ACTIVE',
+            })
+
+    def _page(self, operation, items, field, params):
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000.0)
+        offset = int(params.get('NextToken') or 0)
+        size = min(params.get('MaxResults') or self.page_size, self.page_size)
+        response = {field: items[offset:offset + size]}
+        if offset + size < len(items):
+            response['NextToken'] = str(offset + size)
+        return response
+
+    def list_roots(self, **params):
+        return self._page('ListRoots', [self.root], 'Roots', params)
+
+    def list_organizational_units_for_parent(self, ParentId, **params):
+        return self._page('ListOrganizationalUnitsForParent', self.children[ParentId],
+                          'OrganizationalUnits', params)
+
+    def list_accounts_for_parent(self, ParentId, **params):
+        return self._page('ListAccountsForParent', self.accounts_by_parent[ParentId], 'Accounts', params)
+
+    def list_accounts(self, **params):
+        accounts = [account for parent in self.children for account in self.accounts_by_parent[parent]]
+        return self._page('ListAccounts', accounts, 'Accounts', params)
+
+# -----------------------------------------------------------------------------
+# Cost Explorer over HTTP
+# -----------------------------------------------------------------------------
+
+# X-Amz-Target operation names (JSON 1.1 protocol) -> FakeCostExplorer methods
+CE_TARGETS = {
+    'AWSInsightsIndexService.GetCostAndUsage': 'get_cost_and_usage',
+    'AWSInsightsIndexService.GetDimensionValues': 'get_dimension_values',
+    'AWSInsightsIndexService.GetTags': 'get_tags',
+}
+
+def serve_cost_explorer(fake, host='127.0.0.1', port=0):
+    """
+    Serves fake over the Cost Explorer JSON protocol so a real boto3 client
+    can talk to it (boto3.client('ce', endpoint_url=...), or CE_ENDPOINT_URL
+    for the report). Returns the server; its thread is already running and
+    server.server_address holds the bound port.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            method = CE_TARGETS.get(self.headers.get('X-Amz-Target', ''))
+            try:
+                if method is None:
+                    raise _ce_error('UnknownOperationException', 'Unknown operation', 'Unknown')
+                status, payload = 200, getattr(fake, method)(**json.loads(body or b'{}'))
+            except ClientError as e:
+                status = 400
+                payload = {'__type': e.response['Error']['Code'], 'message': e.response['Error']['Message']}
+            data = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/x-amz-json-1.1')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a fake Cost Explorer over HTTP.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8787)
+    parser.add_argument('--accounts', type=int, default=3)
+    parser.add_argument('--services', type=int, default=20)
+    parser.add_argument('--tag-values', default='core,web,data')
+    parser.add_argument('--months', type=int, default=12)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    fake = FakeCostExplorer(
+        accounts=args.accounts, services=args.services,
+        tag_values=[v for v in args.tag_values.split(',') if v], months=args.months,
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, page_size=args.page_size,
+        throttle_rate=args.throttle_rate
+    )
+    server = serve_cost_explorer(fake, args.host, args.port)
+    print(f"Fake Cost Explorer on http://{args.host}:{server.server_address[1]} "
+          f"({len(fake.accounts)} accounts, {len(fake.services)} services)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
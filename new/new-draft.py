@@ -1,34 +1,133 @@
-import boto3
+import hashlib
+import heapq
+import itertools
+import json
 import os
+import queue
+import random
+import sys
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from botocore.exceptions import ClientError
+from math import nan
 
 # -----------------------------------------------------------------------------
 # 1) GLOBAL CONSTANTS AND SETUP
 # -----------------------------------------------------------------------------
 
-cost_explorer = boto3.client('ce')
+# Nothing expensive happens at import time: boto3 and botocore are imported
+# and clients are built on first use, then reused by every warm invocation.
+# The reporting window is computed on first use too, and recomputed when the
+# month changes under a long-lived container.
 
 MONTHSBACK = 2  # We compare exactly 2 months
-today = datetime.now()
-first_of_this_month = today.replace(day=1)
-
-start_date = (first_of_this_month - timedelta(days=MONTHSBACK * 30)).replace(day=1)
-end_date = first_of_this_month
-
-MONTHLY_START_DATE = start_date.strftime('%Y-%m-%d')
-MONTHLY_END_DATE = end_date.strftime('%Y-%m-%d')
-
-print(f"Monthly reporting range: {MONTHLY_START_DATE} to {MONTHLY_END_DATE}")
 
+first_of_this_month = None
+MONTHLY_START_DATE = None
+MONTHLY_END_DATE = None
 MONTHLY_COST_DATES = []
-temp_date = start_date
-while temp_date < end_date:
-    MONTHLY_COST_DATES.append(temp_date.strftime('%Y-%m-%d'))
-    next_month = (temp_date + timedelta(days=32)).replace(day=1)
-    temp_date = next_month
 
-print("MONTHLY_COST_DATES:", MONTHLY_COST_DATES)
+def init_report_window(now=None):
+    """
+    Computes the reporting window globals (MONTHLY_START_DATE,
+    MONTHLY_END_DATE, MONTHLY_COST_DATES). Returns immediately if the
+    window for the current month has already been built. Raises ValueError
+    for an HOURLY window Cost Explorer keeps no data for.
+    """
+    global first_of_this_month, MONTHLY_START_DATE, MONTHLY_END_DATE, MONTHLY_COST_DATES
+
+    today = now or datetime.now()
+    first_of_month = today.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    if first_of_month == first_of_this_month:
+        return
+
+    start_date = (first_of_month - timedelta(days=MONTHSBACK * 30)).replace(day=1)
+    end_date = first_of_month
+    if CE_GRANULARITY == 'HOURLY' and start_date < today - timedelta(days=HOURLY_DATA_DAYS):
+        raise ValueError(f"CE_GRANULARITY=HOURLY needs a report window within the last {HOURLY_DATA_DAYS} days; "
+                         f"this one starts {start_date.strftime('%Y-%m-%d')}. Use DAILY instead.")
+
+    cost_dates = []
+    temp_date = start_date
+    while temp_date < end_date:
+        cost_dates.append(temp_date.strftime('%Y-%m-%d'))
+        next_month = (temp_date + timedelta(days=32)).replace(day=1)
+        temp_date = next_month
+
+    first_of_this_month = first_of_month
+    MONTHLY_START_DATE = start_date.strftime('%Y-%m-%d')
+    MONTHLY_END_DATE = end_date.strftime('%Y-%m-%d')
+    MONTHLY_COST_DATES = cost_dates
+
+    print(f"Monthly reporting range: {MONTHLY_START_DATE} to {MONTHLY_END_DATE}")
+    print("MONTHLY_COST_DATES:", MONTHLY_COST_DATES)
+
+cost_explorer = None
+ses_clients = {}
+s3_client = None
+lambda_client = None
+organizations_client = None
+
+# Points the Cost Explorer client at another endpoint, e.g. the fake server
+# in fake_aws.py for load tests. Empty means the real service.
+CE_ENDPOINT_URL = os.environ.get('CE_ENDPOINT_URL', '')
+
+def client_error():
+    """
+    botocore's ClientError, imported on first need. An except clause only
+    evaluates it once something was raised, so error-free runs never pay
+    for the import before boto3 itself is loaded.
+    """
+    from botocore.exceptions import ClientError
+    return ClientError
+
+def get_cost_explorer():
+    """Creates the Cost Explorer client on first use; warm invocations reuse it."""
+    global cost_explorer
+    if cost_explorer is None:
+        import boto3
+        from botocore.config import Config
+        # Retries are handled by ce_request so throttles feed the adaptive rate
+        cost_explorer = boto3.client(
+            'ce', endpoint_url=CE_ENDPOINT_URL or None,
+            config=Config(retries={'mode': 'standard', 'max_attempts': 1})
+        )
+    return cost_explorer
+
+def get_s3_client():
+    """Creates the S3 client on first use; warm invocations reuse it."""
+    global s3_client
+    if s3_client is None:
+        import boto3
+        s3_client = boto3.client('s3')
+    return s3_client
+
+def get_lambda_client():
+    """Creates the Lambda client (for shard invocations) on first use."""
+    global lambda_client
+    if lambda_client is None:
+        import boto3
+        from botocore.config import Config
+        # A shard runs synchronously for up to the 15 minute Lambda limit
+        lambda_client = boto3.client('lambda', config=Config(read_timeout=900, connect_timeout=10))
+    return lambda_client
+
+def get_organizations_client():
+    """Creates the Organizations client (account discovery) on first use."""
+    global organizations_client
+    if organizations_client is None:
+        import boto3
+        organizations_client = boto3.client('organizations')
+    return organizations_client
+
+def get_ses_client(region):
+    """Returns the SES client for region, creating it on first use."""
+    if region not in ses_clients:
+        import boto3
+        ses_clients[region] = boto3.client('ses', region_name=region)
+    return ses_clients[region]
 
 accountDict = {
     '384352530920': 'AWS-Workloads-Dev',
@@ -59,33 +158,1489 @@ BODY_HTML = '<h2>AWS Monthly Cost Report for Accounts - Summary</h2>'
 TEAM_TAG_KEY = "Project"
 TEAM_TAG_VALUE = "core" ##"id3-datapipeline"
 
+# With TEAM_GROUPBY_TAG on, the team breakdown comes from one
+# GroupBy (TAG:TEAM_TAG_KEY, SERVICE) query per account instead of a separate
+# tag-filtered query per team, and a report is rendered for every tag value
+# in TEAM_TAG_VALUES (comma separated; empty means every value found).
+TEAM_GROUPBY_TAG = os.environ.get('TEAM_GROUPBY_TAG', 'false').lower() == 'true'
+TEAM_TAG_VALUES = [v for v in os.environ.get('TEAM_TAG_VALUES', '').split(',') if v]
+
+# -----------------------------------------------------------------------------
+# 1b) SHARED FETCH EXECUTOR (THREAD POOL + RATE LIMITER)
+# -----------------------------------------------------------------------------
+
+# Independent Cost Explorer queries (per account chunk, per sub-window, per
+# tag) run on a shared thread pool. The token bucket keeps the combined
+# request rate under the Cost Explorer quota no matter how many workers run.
+CE_MAX_WORKERS = int(os.environ.get('CE_MAX_WORKERS', '4'))
+CE_REQUESTS_PER_SECOND = float(os.environ.get('CE_REQUESTS_PER_SECOND', '5'))
+CE_REQUEST_BURST = int(os.environ.get('CE_REQUEST_BURST', '5'))
+
+# Number of months per sub-window query; 0 fetches the whole window at once
+CE_WINDOW_MONTHS = int(os.environ.get('CE_WINDOW_MONTHS', '0'))
+
+# Metrics requested by every cost query (comma separated), e.g.
+# UnblendedCost,AmortizedCost,NetAmortizedCost,UsageQuantity. Each one is kept
+# as a plane of the cost cubes. REPORT_METRIC (default: the first) drives the
+# summary, team and per-service tables; with more than one metric the report
+# adds a side-by-side comparison of all of them.
+REPORT_METRIC = os.environ.get('REPORT_METRIC', '') or os.environ.get('CE_METRICS', 'UnblendedCost').split(',')[0]
+CE_METRICS = [REPORT_METRIC] + [
+    m for m in os.environ.get('CE_METRICS', 'UnblendedCost').split(',') if m and m != REPORT_METRIC
+]
+
+# Granularity of every cost query: MONTHLY, DAILY or HOURLY. Finer data is
+# rolled up locally to the report periods (see rollup_for_report), so the
+# report layout does not change. Cost Explorer only keeps HOURLY data for
+# the last HOURLY_DATA_DAYS days, and only when hourly granularity is
+# enabled for the org: init_report_window refuses HOURLY for a report
+# window that starts earlier (as a window of whole past months does)
+# rather than letting every query fail.
+CE_GRANULARITY = os.environ.get('CE_GRANULARITY', 'MONTHLY').upper()
+HOURLY_DATA_DAYS = 14
+
+# Throttled requests are retried with full-jitter exponential backoff, and
+# the bucket's rate adapts: it is cut by CE_RATE_DECREASE on every throttle
+# (down to CE_MIN_REQUESTS_PER_SECOND) and grows back by CE_RATE_INCREASE per
+# successful request (up to CE_REQUESTS_PER_SECOND).
+CE_MAX_RETRIES = int(os.environ.get('CE_MAX_RETRIES', '8'))
+CE_BACKOFF_BASE = float(os.environ.get('CE_BACKOFF_BASE', '0.5'))
+CE_BACKOFF_MAX = float(os.environ.get('CE_BACKOFF_MAX', '20'))
+CE_MIN_REQUESTS_PER_SECOND = float(os.environ.get('CE_MIN_REQUESTS_PER_SECOND', '0.2'))
+CE_RATE_DECREASE = float(os.environ.get('CE_RATE_DECREASE', '0.5'))
+CE_RATE_INCREASE = float(os.environ.get('CE_RATE_INCREASE', '0.1'))
+
+CE_THROTTLE_ERRORS = {'ThrottlingException', 'LimitExceededException', 'TooManyRequestsException', 'RequestLimitExceeded'}
+CE_TRANSIENT_ERRORS = {'InternalServerError', 'InternalFailure', 'ServiceUnavailable', 'ServiceUnavailableException'}
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. acquire() blocks until a token is available,
+    refilling at `rate` tokens per second up to `capacity`. throttled() and
+    succeeded() adjust the rate between min_rate and the initial rate
+    (multiplicative decrease, additive increase).
+    """
+    def __init__(self, rate, capacity, min_rate=None):
+        self.rate = rate
+        self.max_rate = rate
+        self.min_rate = min(min_rate if min_rate is not None else rate, rate)
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate * CE_RATE_DECREASE)
+            # Drop any saved-up burst so the slower rate applies right away
+            self.tokens = min(self.tokens, 0.0)
+
+    def succeeded(self):
+        if self.rate < self.max_rate:
+            with self.lock:
+                self.rate = min(self.max_rate, self.rate + CE_RATE_INCREASE)
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+ce_rate_limiter = TokenBucket(CE_REQUESTS_PER_SECOND, CE_REQUEST_BURST, CE_MIN_REQUESTS_PER_SECOND)
+
+# Retry counters for the current invocation (reset by lambda_handler)
+ce_retry_stats = {'requests': 0, 'retries': 0, 'throttles': 0, 'backoff_seconds': 0.0, 'resumed_pages': 0}
+_retry_stats_lock = threading.Lock()
+
+def reset_ce_retry_stats():
+    with _retry_stats_lock:
+        ce_retry_stats.update(requests=0, retries=0, throttles=0, backoff_seconds=0.0, resumed_pages=0)
+
+def _count_retry(key, amount=1):
+    with _retry_stats_lock:
+        ce_retry_stats[key] += amount
+
+_fetch_pool = None
+_fetch_local = threading.local()
+
+def _mark_fetch_worker():
+    _fetch_local.in_pool = True
+
+def get_fetch_pool():
+    """Creates the shared thread pool on first use; warm invocations reuse it."""
+    global _fetch_pool
+    if _fetch_pool is None:
+        _fetch_pool = ThreadPoolExecutor(
+            max_workers=CE_MAX_WORKERS,
+            thread_name_prefix='ce-fetch',
+            initializer=_mark_fetch_worker
+        )
+    return _fetch_pool
+
+def run_fetch_tasks(tasks):
+    """
+    Runs a list of (function, args) tasks and returns their results in the
+    same order as the tasks, so merging is deterministic. Tasks started from
+    inside a pool worker run inline to avoid waiting on the pool we occupy.
+    """
+    if len(tasks) <= 1 or CE_MAX_WORKERS <= 1 or getattr(_fetch_local, 'in_pool', False):
+        return [fn(*args) for fn, args in tasks]
+
+    pool = get_fetch_pool()
+    stage = current_api_stage()
+    futures = [pool.submit(run_in_api_stage, stage, fn, *args) for fn, args in tasks]
+    return [future.result() for future in futures]
+
+def run_fetch_stages(stages):
+    """
+    Runs whole fetchers, given as (function, args), side by side and returns
+    their results in order. Stages only wait on the shared pool, so they get
+    their own short-lived threads rather than occupying pool workers.
+    """
+    if len(stages) <= 1 or CE_MAX_WORKERS <= 1:
+        return [fn(*args) for fn, args in stages]
+
+    with ThreadPoolExecutor(max_workers=len(stages), thread_name_prefix='ce-stage') as stage_pool:
+        futures = [stage_pool.submit(fn, *args) for fn, args in stages]
+        return [future.result() for future in futures]
+
+def backoff_delay(attempt):
+    """Full-jitter exponential backoff: uniform in [0, min(max, base * 2^attempt)]."""
+    return random.uniform(0, min(CE_BACKOFF_MAX, CE_BACKOFF_BASE * (2 ** attempt)))
+
+def ce_request(operation, **kwargs):
+    """
+    Issues one rate-limited Cost Explorer API call, e.g.
+    ce_request('get_cost_and_usage', ...). Throttling and transient server
+    errors are retried up to CE_MAX_RETRIES times with jittered backoff.
+    Every attempt is charged to api_usage, which raises
+    RequestBudgetExceeded once the run's CE_REQUEST_BUDGET is spent.
+    Every paginated loop calls this once per page, so a retry repeats only
+    the failed page (same NextPageToken), never the pages before it.
+    """
+    attempt = 0
+    while True:
+        ce_rate_limiter.acquire()
+        api_usage.charge('ce')
+        _count_retry('requests')
+        started = time.perf_counter()
+        try:
+            response = getattr(get_cost_explorer(), operation)(**kwargs)
+        except client_error() as e:
+            run_metrics.observe(METRIC_NAMES['ce'], (time.perf_counter() - started) * 1000)
+            code = e.response['Error']['Code']
+            if code not in CE_THROTTLE_ERRORS and code not in CE_TRANSIENT_ERRORS:
+                raise
+            if code in CE_THROTTLE_ERRORS:
+                _count_retry('throttles')
+                ce_rate_limiter.throttled()
+            if attempt >= CE_MAX_RETRIES:
+                print(f"{operation} failed after {attempt} retries: {code}")
+                raise
+            delay = backoff_delay(attempt)
+            attempt += 1
+            _count_retry('retries')
+            _count_retry('backoff_seconds', delay)
+            print(f"{operation} {code}; retry {attempt}/{CE_MAX_RETRIES} in {delay:.2f}s "
+                  f"(rate now {ce_rate_limiter.rate:.2f}/s)")
+            time.sleep(delay)
+            continue
+        run_metrics.observe(METRIC_NAMES['ce'], (time.perf_counter() - started) * 1000)
+        ce_rate_limiter.succeeded()
+        api_usage.record('ce', response)
+        return response
+
+def iter_cost_and_usage_pages(params):
+    """
+    Runs one get_cost_and_usage query, following NextPageToken, and yields
+    each page's ResultsByTime list as it arrives. A period whose groups span
+    several pages shows up once per page.
+
+    While a run is checkpointed (see FetchCheckpoint), every page is stored
+    as it arrives; a resumed run replays the stored pages and continues from
+    the last NextPageToken.
+    """
+    token = None
+    if params['Granularity'] == 'HOURLY':
+        # HOURLY queries take timestamps rather than dates
+        params = dict(params, TimePeriod={
+            'Start': params['TimePeriod']['Start'] + 'T00:00:00Z',
+            'End': params['TimePeriod']['End'] + 'T00:00:00Z'
+        })
+
+    checkpoint = fetch_checkpoint
+    skip = 0
+    if checkpoint is not None:
+        key = checkpoint.query_key(params)
+        progress = checkpoint.progress(key)
+        replayed = 0
+        for page in checkpoint.replay(key, progress['pages']):
+            yield page
+            replayed += 1
+        if replayed < progress['pages']:
+            # A stored page is gone: run the query again, past the replayed pages
+            skip = replayed
+            progress = {'pages': replayed, 'token': None, 'done': False}
+        elif progress['done']:
+            return
+        else:
+            token = progress['token']
+
+    while True:
+        kwargs = {'NextPageToken': token} if token else {}
+        try:
+            data = ce_request('get_cost_and_usage', **params, **kwargs)
+        except client_error() as e:
+            if not (checkpoint is not None and token and progress['pages']
+                    and e.response['Error']['Code'] == 'ValidationException'):
+                raise
+            # The checkpointed NextPageToken is no longer accepted
+            print(f"Checkpoint: page token rejected, refetching past {progress['pages']} stored pages")
+            token, skip = None, progress['pages']
+            continue
+        token = data.get('NextPageToken')
+        if skip:
+            skip -= 1
+        else:
+            if checkpoint is not None:
+                progress = checkpoint.record_page(key, progress, data['ResultsByTime'], token)
+            yield data['ResultsByTime']
+        if not token:
+            break
+
+    if checkpoint is not None and not progress['done']:
+        checkpoint.record_done(key, progress)
+
+def fetch_cost_and_usage(params):
+    """
+    Runs one get_cost_and_usage query, following NextPageToken, and returns
+    every ResultsByTime entry in page order.
+    """
+    results = []
+    for page in iter_cost_and_usage_pages(params):
+        results += page
+    return results
+
+# Marks a finished task in iter_fetch_pages' queue
+_TASK_DONE = object()
+
+def iter_fetch_pages(tasks, deadline=None):
+    """
+    Streaming counterpart of run_fetch_tasks for page iterators: tasks are
+    (function, args) whose function returns an iterable of pages, and
+    (task_index, page) pairs are yielded as pages arrive from any task.
+    Workers hand pages over through a small bounded queue, so at most a few
+    pages are held at once whatever the size of the whole response set.
+    deadline (a time.monotonic() value, see TimeBudget) raises
+    BudgetExceeded once passed, and the tasks not yet started are dropped.
+    """
+    if len(tasks) <= 1 or CE_MAX_WORKERS <= 1 or getattr(_fetch_local, 'in_pool', False):
+        for index, (fn, args) in enumerate(tasks):
+            for page in fn(*args):
+                if deadline is not None and time.monotonic() > deadline:
+                    raise BudgetExceeded()
+                yield index, page
+        return
+
+    pages = queue.Queue(maxsize=CE_MAX_WORKERS * 2)
+    stop = threading.Event()
+
+    def hand_over(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce(index, fn, args):
+        if stop.is_set():
+            return
+        try:
+            for page in fn(*args):
+                if not hand_over((index, page)):
+                    return
+            hand_over((index, _TASK_DONE))
+        except Exception as e:
+            hand_over((index, e))
+
+    pool = get_fetch_pool()
+    stage = current_api_stage()
+    for index, (fn, args) in enumerate(tasks):
+        pool.submit(run_in_api_stage, stage, produce, index, fn, args)
+
+    remaining = len(tasks)
+    try:
+        while remaining:
+            try:
+                index, page = pages.get(timeout=None if deadline is None else max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                raise BudgetExceeded()
+            if page is _TASK_DONE:
+                remaining -= 1
+            elif isinstance(page, Exception):
+                raise page
+            else:
+                yield index, page
+    finally:
+        # Lets the workers go if the consumer stops early or a task failed
+        stop.set()
+
+def plan_time_windows(months_per_window=None):
+    """
+    Splits the reporting window into sub-windows of months_per_window months
+    (defaults to CE_WINDOW_MONTHS). Returns a list of TimePeriod dicts.
+    """
+    if months_per_window is None:
+        months_per_window = CE_WINDOW_MONTHS
+    if months_per_window <= 0:
+        return [{'Start': MONTHLY_START_DATE, 'End': MONTHLY_END_DATE}]
+
+    windows = []
+    for i in range(0, len(MONTHLY_COST_DATES), months_per_window):
+        window_start = MONTHLY_COST_DATES[i]
+        if i + months_per_window < len(MONTHLY_COST_DATES):
+            window_end = MONTHLY_COST_DATES[i + months_per_window]
+        else:
+            window_end = MONTHLY_END_DATE
+        windows.append({'Start': window_start, 'End': window_end})
+    return windows
+
+def merge_results_by_time(result_lists):
+    """
+    Merges ResultsByTime lists from several tasks (or pages) into a single
+    entry per period, ordered by start date. Groups are concatenated in task
+    order, so the merged result is the same whatever order tasks finish in.
+    """
+    merged = {}
+    for results in result_lists:
+        for time_period in results:
+            start_str = time_period['TimePeriod']['Start']
+            if start_str not in merged:
+                merged[start_str] = {
+                    'TimePeriod': time_period['TimePeriod'],
+                    'Total': time_period.get('Total', {}),
+                    'Groups': [],
+                    'Estimated': time_period.get('Estimated', False)
+                }
+            else:
+                merged[start_str]['Estimated'] = merged[start_str]['Estimated'] or time_period.get('Estimated', False)
+            merged[start_str]['Groups'] += time_period.get('Groups', [])
+
+    return [merged[start_str] for start_str in sorted(merged)]
+
+# -----------------------------------------------------------------------------
+# 1c) PERSISTENT COST-RESPONSE CACHE (CLOSED MONTHS)
+# -----------------------------------------------------------------------------
+
+# Closed months never change once Cost Explorer stops marking them Estimated,
+# so their results are cached per (metric, granularity, filter, group-by,
+# month) in a local directory (kept by warm containers) and, if a bucket is
+# configured, under an S3 prefix (shared by cold containers).
+CE_CACHE_ENABLED = os.environ.get('CE_CACHE_ENABLED', 'true').lower() == 'true'
+CE_CACHE_DIR = os.environ.get('CE_CACHE_DIR', '/tmp/ce-cache')
+CE_CACHE_BUCKET = os.environ.get('CE_CACHE_BUCKET', '')
+CE_CACHE_PREFIX = os.environ.get('CE_CACHE_PREFIX', 'ce-cache/')
+
+# Incremental mode covers the months the closed-month cache cannot store yet
+# (Estimated or not over): each keeps a history record per query shape and
+# month with a watermark ('final_through'). Every period before it was final
+# at the last fetch, so only the periods from the watermark on (the
+# still-Estimated ones) are requested again and merged into the record.
+CE_INCREMENTAL = os.environ.get('CE_INCREMENTAL', 'false').lower() == 'true'
+
+class CostResponseCache:
+    """
+    Two-level JSON store: a local directory in front of an optional S3
+    prefix. Reads fall through to S3 and are copied locally; writes go to
+    both. s3_client can be any object with get_object/put_object, which is
+    how the local S3 stand-in in fake_aws.py is plugged in.
+    """
+    def __init__(self, local_dir, s3_client=None, bucket='', prefix=''):
+        self.local_dir = local_dir
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+        if local_dir:
+            os.makedirs(local_dir, exist_ok=True)
+
+    def _local_path(self, key):
+        return os.path.join(self.local_dir, key + '.json')
+
+    def get(self, key):
+        if self.local_dir and os.path.exists(self._local_path(key)):
+            with open(self._local_path(key)) as f:
+                return json.load(f)
+
+        if self.s3_client is None or not self.bucket:
+            return None
+        try:
+            obj = self.s3_client.get_object(Bucket=self.bucket, Key=self.prefix + key + '.json')
+        except client_error() as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                print("Cost cache S3 read error:", e.response['Error']['Message'])
+            return None
+
+        value = json.loads(obj['Body'].read())
+        self._write_local(key, value)
+        return value
+
+    def put(self, key, value):
+        self._write_local(key, value)
+        if self.s3_client is not None and self.bucket:
+            try:
+                self.s3_client.put_object(
+                    Bucket=self.bucket,
+                    Key=self.prefix + key + '.json',
+                    Body=json.dumps(value).encode('utf-8')
+                )
+            except client_error() as e:
+                print("Cost cache S3 write error:", e.response['Error']['Message'])
+
+    def delete_prefix(self, key_prefix, keep=()):
+        """Deletes every entry whose key starts with key_prefix, locally and in S3, except those in keep."""
+        keep_names = {key + '.json' for key in keep}
+        if self.local_dir:
+            for name in os.listdir(self.local_dir):
+                if name.startswith(key_prefix) and name.endswith('.json') and name not in keep_names:
+                    os.remove(os.path.join(self.local_dir, name))
+        if self.s3_client is None or not self.bucket:
+            return
+        keep_keys = {self.prefix + name for name in keep_names}
+        try:
+            token = None
+            while True:
+                kwargs = {'ContinuationToken': token} if token else {}
+                listing = self.s3_client.list_objects_v2(Bucket=self.bucket, Prefix=self.prefix + key_prefix, **kwargs)
+                keys = [obj['Key'] for obj in listing.get('Contents', []) if obj['Key'] not in keep_keys]
+                # delete_objects takes at most 1000 keys
+                for start in range(0, len(keys), 1000):
+                    self.s3_client.delete_objects(Bucket=self.bucket, Delete={
+                        'Objects': [{'Key': key} for key in keys[start:start + 1000]], 'Quiet': True})
+                token = listing.get('NextContinuationToken')
+                if not token:
+                    break
+        except client_error() as e:
+            print("Cost cache S3 delete error:", e.response['Error']['Message'])
+
+    def _write_local(self, key, value):
+        if not self.local_dir:
+            return
+        # Write then rename so a concurrent reader never sees a partial file
+        tmp_path = f"{self._local_path(key)}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(value, f)
+        os.replace(tmp_path, self._local_path(key))
+
+ce_cache = None
+
+def get_ce_cache():
+    """Creates the cost-response cache on first use; warm invocations reuse it."""
+    global ce_cache
+    if ce_cache is None:
+        s3_client = get_s3_client() if CE_CACHE_BUCKET else None
+        ce_cache = CostResponseCache(CE_CACHE_DIR, s3_client, CE_CACHE_BUCKET, CE_CACHE_PREFIX)
+    return ce_cache
+
+def cost_cache_key(params, month):
+    """Hashes the query shape (metric, granularity, filter, group-by) and month into a cache key."""
+    shape = {
+        'Metrics': params['Metrics'],
+        'Granularity': params['Granularity'],
+        'Filter': params.get('Filter'),
+        'GroupBy': params.get('GroupBy'),
+        'Month': month
+    }
+    return hashlib.sha256(json.dumps(shape, sort_keys=True).encode('utf-8')).hexdigest()
+
+def month_windows(time_period):
+    """
+    Splits a TimePeriod at month boundaries into (start, end) pairs. The
+    first and last pair are clipped to the period, so they may cover only
+    part of a month.
+    """
+    windows = []
+    start = datetime.strptime(time_period['Start'], '%Y-%m-%d')
+    end = datetime.strptime(time_period['End'], '%Y-%m-%d')
+    while start < end:
+        next_month = (start + timedelta(days=32)).replace(day=1)
+        windows.append((start.strftime('%Y-%m-%d'), min(next_month, end).strftime('%Y-%m-%d')))
+        start = next_month
+    return windows
+
+def is_closed_month(month_start, month_end):
+    """True for a whole calendar month that ended before the current month began."""
+    current_month = first_of_this_month.strftime('%Y-%m-%d')
+    return month_start.endswith('-01') and month_end.endswith('-01') and month_end <= current_month
+
+def iter_cost_and_usage_cached(params):
+    """
+    Page-by-page, cache-aware version of iter_cost_and_usage_pages (see
+    _iter_cost_and_usage_cached). Pages that sum to per-account totals are
+    tallied on the way through, and a query that runs to its end publishes
+    them to the run's QueryCoalescer.
+    """
+    accounts = account_totals_source(params) if CE_COALESCE else None
+    if accounts is None:
+        yield from _iter_cost_and_usage_cached(params)
+        return
+    tally = AccountTotals(accounts, params['GroupBy'][0]['Key'] == 'LINKED_ACCOUNT')
+    for page in _iter_cost_and_usage_cached(params):
+        tally.add(page)
+        yield page
+    ce_coalescer.publish(params, tally)
+
+def _iter_cost_and_usage_cached(params):
+    """
+    Page-by-page, cache-aware version of iter_cost_and_usage_pages. Closed
+    months found in the cache are yielded first, one page per month, then
+    (in CE_INCREMENTAL mode) the months with a history record; the
+    remaining months are fetched in contiguous runs (one query per run) and
+    streamed page by page. A fetched month that is closed and not Estimated
+    is buffered until its last page and then stored for every later
+    invocation; in CE_INCREMENTAL mode any other month is buffered too and
+    starts a history record. Only those months are held in memory.
+    """
+    if not CE_CACHE_ENABLED:
+        yield from iter_cost_and_usage_pages(params)
+        return
+
+    cache = get_ce_cache()
+
+    missing_runs = []
+    for month_start, month_end in month_windows(params['TimePeriod']):
+        entries = None
+        if is_closed_month(month_start, month_end):
+            entries = cache.get(cost_cache_key(params, month_start))
+        if entries is None and CE_INCREMENTAL:
+            entries = get_cost_and_usage_incremental(dict(params, TimePeriod={'Start': month_start, 'End': month_end}))
+
+        if entries is not None:
+            yield entries
+        elif missing_runs and missing_runs[-1]['End'] == month_start:
+            missing_runs[-1]['End'] = month_end
+        else:
+            missing_runs.append({'Start': month_start, 'End': month_end})
+
+    for window in missing_runs:
+        months = month_windows(window)
+        pending = {}
+
+        def store(month_start, month_end):
+            month_entries = merge_results_by_time([pending.pop(month_start)])
+            if is_closed_month(month_start, month_end) and not any(
+                    entry.get('Estimated', False) for entry in month_entries):
+                cache.put(cost_cache_key(params, month_start), month_entries)
+            elif CE_INCREMENTAL:
+                history = {'final_through': month_start,
+                           'entries': {entry['TimePeriod']['Start']: entry for entry in month_entries}}
+                advance_watermark(history)
+                cache.put(history_key(params, month_start), history)
+
+        for page in iter_cost_and_usage_pages(dict(params, TimePeriod=window)):
+            for entry in page:
+                start_str = entry['TimePeriod']['Start']
+                for month_start, month_end in months:
+                    if month_start <= start_str < month_end:
+                        if CE_INCREMENTAL or is_closed_month(month_start, month_end):
+                            pending.setdefault(month_start, []).append(entry)
+                        break
+            # Pages arrive in period order: a month before this page's first
+            # period is complete
+            if page:
+                first_start = page[0]['TimePeriod']['Start']
+                for month_start, month_end in months:
+                    if month_start in pending and month_end <= first_start:
+                        store(month_start, month_end)
+            yield page
+
+        for month_start, month_end in months:
+            if month_start in pending:
+                store(month_start, month_end)
+
+def get_cost_and_usage_cached(params):
+    """
+    Cache-aware version of fetch_cost_and_usage (see
+    iter_cost_and_usage_cached); returns one merged entry per period.
+    With CE_COALESCE the run's QueryCoalescer may answer it without a call.
+    """
+    if CE_COALESCE:
+        return ce_coalescer.fetch(params, _get_cost_and_usage_cached)
+    return _get_cost_and_usage_cached(params)
+
+def _get_cost_and_usage_cached(params):
+    results = []
+    for page in iter_cost_and_usage_cached(params):
+        results += page
+    return merge_results_by_time([results])
+
+def period_timestamp(period):
+    """'2024-03-17' -> '2024-03-17T00:00:00Z'; HOURLY timestamps are kept, so both forms compare in order."""
+    return period if 'T' in period else period + 'T00:00:00Z'
+
+def advance_watermark(history):
+    """
+    Moves history['final_through'] to the end of the longest run of
+    non-Estimated periods starting at the current watermark. The watermark
+    starts as a date and periods may be HOURLY timestamps, so boundaries
+    are compared as period_timestamp.
+    """
+    watermark = history['final_through']
+    for start_str in sorted(history['entries'], key=period_timestamp):
+        entry = history['entries'][start_str]
+        if period_timestamp(start_str) < period_timestamp(watermark):
+            continue
+        if period_timestamp(start_str) != period_timestamp(watermark) or entry.get('Estimated', False):
+            break
+        watermark = entry['TimePeriod']['End']
+    history['final_through'] = watermark
+
+def history_key(params, month_start):
+    """Cache key of the incremental history record of one query shape and month."""
+    return 'history-' + cost_cache_key(params, month_start)
+
+def get_cost_and_usage_incremental(params):
+    """
+    Watermark-driven fetch of one month (params['TimePeriod'] lies within
+    it) for CE_INCREMENTAL mode. Returns None if the month has no history
+    record yet. Otherwise periods before the stored watermark come from the
+    record and one query covers the rest of the month; fresh entries
+    replace stored ones and the watermark is advanced past newly final
+    periods. A closed month that is final throughout moves to the
+    closed-month cache and its record is deleted.
+    """
+    cache = get_ce_cache()
+    window = params['TimePeriod']
+    key = history_key(params, window['Start'])
+
+    history = cache.get(key)
+    if history is None:
+        return None
+
+    # Queries take dates: an HOURLY watermark is refetched from its day's start
+    fetch_start = max(window['Start'], history['final_through'][:10])
+    if fetch_start < window['End']:
+        print(f"Incremental fetch {fetch_start} to {window['End']} (final through {history['final_through']})")
+        results = merge_results_by_time([fetch_cost_and_usage(dict(params, TimePeriod={'Start': fetch_start, 'End': window['End']}))])
+        for entry in results:
+            history['entries'][entry['TimePeriod']['Start']] = entry
+    advance_watermark(history)
+
+    entries = [
+        history['entries'][start_str] for start_str in sorted(history['entries'])
+        if start_str < window['End']
+    ]
+    if is_closed_month(window['Start'], window['End']) and period_timestamp(history['final_through']) >= period_timestamp(window['End']):
+        cache.put(cost_cache_key(params, window['Start']), entries)
+        cache.delete_prefix(key)
+    else:
+        cache.put(key, history)
+    return entries
+
+# -----------------------------------------------------------------------------
+# 1c2) QUERY COALESCING (DERIVED ACCOUNT TOTALS)
+# -----------------------------------------------------------------------------
+
+# Within a run, the per-account totals of the summary are derived from any
+# finished query whose groups add up to them, e.g. a (LINKED_ACCOUNT, SERVICE)
+# query over the same accounts, window, granularity and metrics, instead of
+# being asked for again.
+CE_COALESCE = os.environ.get('CE_COALESCE', 'true').lower() == 'true'
+
+def totals_key(params):
+    """Queries with the same totals_key cover the same periods and metrics."""
+    return (params['TimePeriod']['Start'], params['TimePeriod']['End'], params['Granularity'],
+            tuple(sorted(params['Metrics'])))
+
+def account_totals_source(params):
+    """
+    Returns the accounts whose totals the query's groups add up to, or None.
+    That takes a filter on LINKED_ACCOUNT alone, and either LINKED_ACCOUNT as
+    the first group key or a single account in the filter.
+    """
+    query_filter = params.get('Filter') or {}
+    dimensions = query_filter.get('Dimensions')
+    if set(query_filter) != {'Dimensions'} or dimensions['Key'] != 'LINKED_ACCOUNT' or dimensions.get('MatchOptions'):
+        return None
+    group_keys = [group['Key'] for group in params.get('GroupBy') or []]
+    if group_keys[:1] == ['LINKED_ACCOUNT'] or (group_keys and len(dimensions['Values']) == 1):
+        return list(dimensions['Values'])
+    return None
+
+class AccountTotals:
+    """Per-account, per-period sums of every metric over a query's groups."""
+    def __init__(self, accounts, keyed_by_account):
+        self.accounts = accounts
+        self.keyed_by_account = keyed_by_account
+        self.periods = {}   # start: {'TimePeriod', 'Estimated'}
+        self.amounts = {}   # account: {start: {metric: amount}}
+        self.units = {}
+
+    def add(self, page):
+        for time_period in page:
+            start_str = time_period['TimePeriod']['Start']
+            period = self.periods.setdefault(start_str, {'TimePeriod': time_period['TimePeriod'], 'Estimated': False})
+            period['Estimated'] = period['Estimated'] or time_period.get('Estimated', False)
+            for group in time_period.get('Groups', []):
+                acct_id = group['Keys'][0] if self.keyed_by_account else self.accounts[0]
+                sums = self.amounts.setdefault(acct_id, {}).setdefault(start_str, {})
+                for metric, value in group['Metrics'].items():
+                    sums[metric] = sums.get(metric, 0.0) + float(value['Amount'])
+                    self.units.setdefault(metric, value.get('Unit', 'USD'))
+
+class QueryCoalescer:
+    """
+    Per-run coalescing of get_cost_and_usage_cached calls: while
+    derive_totals is set, a GroupBy LINKED_ACCOUNT query is answered from
+    the AccountTotals published by finished queries (the streaming fetches
+    of iter_cost_and_usage_cached) that covered all its accounts over the
+    same window, granularity and metrics. stats['derived'] counts the calls
+    served that way.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.derive_totals = True
+        self.totals = {}
+        self.stats = {'derived': 0}
+
+    def publish(self, params, tally):
+        with self.lock:
+            entry = self.totals.setdefault(totals_key(params), {'periods': {}, 'accounts': {}, 'units': {}})
+            entry['periods'].update(tally.periods)
+            entry['units'].update(tally.units)
+            for acct_id in tally.accounts:
+                entry['accounts'][acct_id] = tally.amounts.get(acct_id, {})
+
+    def derive(self, params):
+        """The query's result built from published totals, or None."""
+        if params.get('GroupBy') != [{'Type': 'DIMENSION', 'Key': 'LINKED_ACCOUNT'}]:
+            return None
+        accounts = account_totals_source(params)
+        with self.lock:
+            entry = self.totals.get(totals_key(params))
+            if accounts is None or entry is None or not all(acct_id in entry['accounts'] for acct_id in accounts):
+                return None
+            results = []
+            for start_str in sorted(entry['periods']):
+                groups = [
+                    {'Keys': [acct_id],
+                     'Metrics': {metric: {'Amount': repr(amount), 'Unit': entry['units'].get(metric, 'USD')}
+                                 for metric, amount in entry['accounts'][acct_id][start_str].items()}}
+                    for acct_id in accounts if start_str in entry['accounts'][acct_id]
+                ]
+                results.append({'TimePeriod': entry['periods'][start_str]['TimePeriod'], 'Total': {},
+                                'Groups': groups, 'Estimated': entry['periods'][start_str]['Estimated']})
+            return results
+
+    def fetch(self, params, fetch):
+        """Returns fetch(params), unless it can be derived from published totals."""
+        derived = self.derive(params) if self.derive_totals else None
+        if derived is None:
+            return fetch(params)
+        with self.lock:
+            self.stats['derived'] += 1
+        return derived
+
+ce_coalescer = QueryCoalescer()
+
+def reset_ce_coalescer():
+    """Starts a run with no totals published."""
+    global ce_coalescer
+    ce_coalescer = QueryCoalescer()
+
+# -----------------------------------------------------------------------------
+# 1d) TIME BUDGET (LAMBDA CONTEXT)
+# -----------------------------------------------------------------------------
+
+# Time kept back from the Lambda deadline for rendering and sending the email
+TIME_BUDGET_RESERVE_MS = int(os.environ.get('TIME_BUDGET_RESERVE_MS', '30000'))
+# Time the detail stages leave before the deadline for fetching the summary,
+# should they be cut short before its totals can be derived from them
+SUMMARY_RESERVE_MS = int(os.environ.get('SUMMARY_RESERVE_MS', '10000'))
+
+class BudgetExceeded(Exception):
+    """Raised by a fetch that runs past the TimeBudget deadline."""
+
+class TimeBudget:
+    """
+    Deadline for the optional parts of a run, derived from the Lambda
+    context: context.get_remaining_time_in_millis() minus reserve_ms. With
+    no context there is no deadline. Sections dropped for lack of time are
+    collected in skipped so the report can say what is missing.
+    """
+    def __init__(self, context=None, reserve_ms=None):
+        reserve_ms = TIME_BUDGET_RESERVE_MS if reserve_ms is None else reserve_ms
+        self.deadline = None
+        if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+            self.deadline = time.monotonic() + (context.get_remaining_time_in_millis() - reserve_ms) / 1000
+        self.skipped = []
+
+    def held_back(self, seconds):
+        """A budget whose deadline is seconds earlier than this one's; both record skipped sections together."""
+        budget = TimeBudget()
+        budget.deadline = None if self.deadline is None else self.deadline - seconds
+        budget.skipped = self.skipped
+        return budget
+
+    def remaining(self):
+        """Seconds left before the deadline (None without one)."""
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+    def expired(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def skip(self, section, reason):
+        print(f"Budget: skipping {section} ({reason})")
+        self.skipped.append((section, reason))
+
+    def run(self, section, fn, *args):
+        """
+        Runs fn(*args) for one optional report section, with its API calls
+        counted under section (see api_usage). Returns None, and records the
+        section as skipped, when the time or the request budget is already
+        spent or fn raises BudgetExceeded part way.
+        """
+        if self.expired():
+            self.skip(section, 'not started, out of time')
+            return None
+        if api_usage.exhausted():
+            self.skip(section, 'not started, Cost Explorer request budget used up')
+            return None
+        try:
+            return run_in_api_stage(section, fn, *args)
+        except RequestBudgetExceeded:
+            self.skip(section, 'data fetch stopped at the Cost Explorer request budget')
+            return None
+        except BudgetExceeded:
+            self.skip(section, 'data fetch did not finish in time')
+            return None
+
+    def available(self, section):
+        """True if there is time left to render section; records it as skipped otherwise."""
+        if self.expired():
+            self.skip(section, 'out of time')
+            return False
+        return True
+
+def skipped_sections_html(skipped):
+    """Note listing the sections a TimeBudget dropped, or '' if none."""
+    if not skipped:
+        return ''
+    items = ''.join(f"<li>{section}: {reason}</li>" for section, reason in skipped)
+    return f"<p><b>Incomplete report:</b> the run was short of time or requests, so these sections were left out:</p><ul>{items}</ul>"
+
+# -----------------------------------------------------------------------------
+# 1d2) API USAGE ACCOUNTING AND REQUEST BUDGET
+# -----------------------------------------------------------------------------
+
+# Cost Explorer bills every get_cost_and_usage / get_dimension_values request
+# ($0.01), SES every email ($0.10 per 1000). Throttled and failed attempts are
+# counted as requests too, so the cost is an upper estimate.
+CE_REQUEST_PRICE = float(os.environ.get('CE_REQUEST_PRICE', '0.01'))
+SES_EMAIL_PRICE = float(os.environ.get('SES_EMAIL_PRICE', '0.0001'))
+API_PRICES = {'ce': CE_REQUEST_PRICE, 'ses': SES_EMAIL_PRICE}
+API_NAMES = {'ce': 'Cost Explorer', 'ses': 'SES'}
+METRIC_NAMES = {'ce': 'CostExplorer', 'ses': 'SES'}
+
+# Cost Explorer requests one run may make, 0 for no limit. Past it the
+# optional sections still fetching are left out as on a short TimeBudget;
+# closed months keep coming from the response cache, and the summary is
+# always fetched (its requests count but are never refused).
+CE_REQUEST_BUDGET = int(os.environ.get('CE_REQUEST_BUDGET', '0'))
+SUMMARY_STAGE = 'Summary'
+
+# Show the per-stage request / cost table at the end of the report
+REPORT_API_USAGE = os.environ.get('REPORT_API_USAGE', 'true').lower() == 'true'
+
+class RequestBudgetExceeded(BudgetExceeded):
+    """Raised by ce_request once the run has made CE_REQUEST_BUDGET requests."""
+
+_api_local = threading.local()
+
+def current_api_stage():
+    """Report section the calling thread is fetching for ('Other' outside one)."""
+    return getattr(_api_local, 'stage', 'Other')
+
+def run_in_api_stage(stage, fn, *args):
+    """Runs fn(*args) with its API calls counted under stage."""
+    previous = getattr(_api_local, 'stage', None)
+    _api_local.stage = stage
+    try:
+        return fn(*args)
+    finally:
+        _api_local.stage = previous
+
+def response_bytes(response):
+    """Size of an API response: its Content-Length, or its JSON size without one."""
+    headers = (response.get('ResponseMetadata') or {}).get('HTTPHeaders') or {}
+    if 'content-length' in headers:
+        return int(headers['content-length'])
+    return len(json.dumps(response, default=str))
+
+class ApiUsage:
+    """
+    Per-run ledger of Cost Explorer and SES calls: requests, pages (answered
+    requests) and bytes per (service, stage), where the stage is the report
+    section the call was made for (see run_in_api_stage). charge() enforces
+    request_budget on Cost Explorer requests. Every method is safe to call
+    from the fetch threads: stages and the per-service request totals are
+    only touched under lock.
+    """
+    def __init__(self, request_budget=0):
+        self.lock = threading.Lock()
+        self.request_budget = request_budget
+        self.stages = {}
+        self.total_requests = {}
+
+    def _counts(self, service, stage):
+        return self.stages.setdefault((service, stage), {'requests': 0, 'pages': 0, 'bytes': 0})
+
+    def _add_requests(self, service, stage, requests):
+        self._counts(service, stage)['requests'] += requests
+        self.total_requests[service] = self.total_requests.get(service, 0) + requests
+
+    def _exhausted(self):
+        # Caller holds self.lock
+        return bool(self.request_budget) and self.total_requests.get('ce', 0) >= self.request_budget
+
+    def requests(self, service):
+        with self.lock:
+            return self.total_requests.get(service, 0)
+
+    def exhausted(self):
+        with self.lock:
+            return self._exhausted()
+
+    def charge(self, service):
+        """Counts one request about to be made; raises RequestBudgetExceeded past the budget."""
+        stage = current_api_stage()
+        with self.lock:
+            if service == 'ce' and stage != SUMMARY_STAGE and self._exhausted():
+                raise RequestBudgetExceeded(f"Cost Explorer request budget of {self.request_budget} used up")
+            self._add_requests(service, stage, 1)
+
+    def record(self, service, response, size=None):
+        """Counts one answered request and its size in bytes."""
+        size = response_bytes(response) if size is None else size
+        with self.lock:
+            counts = self._counts(service, current_api_stage())
+            counts['pages'] += 1
+            counts['bytes'] += size
+
+    def rows(self):
+        """[(service, stage, requests, pages, bytes, estimated cost)] in call order."""
+        with self.lock:
+            return [
+                (service, stage, counts['requests'], counts['pages'], counts['bytes'],
+                 counts['requests'] * API_PRICES[service])
+                for (service, stage), counts in self.stages.items()
+            ]
+
+    def cost(self):
+        return sum(row[5] for row in self.rows())
+
+    def to_partial(self):
+        """JSON-serialisable copy of the ledger, see merge."""
+        return [[service, stage, requests, pages, size] for service, stage, requests, pages, size, _ in self.rows()]
+
+    def merge(self, partial):
+        """Adds another ledger's to_partial() (e.g. a report shard's) to this one."""
+        with self.lock:
+            for service, stage, requests, pages, size in partial:
+                self._add_requests(service, stage, requests)
+                counts = self._counts(service, stage)
+                counts['pages'] += pages
+                counts['bytes'] += size
+        return self
+
+    def log(self):
+        for service, stage, requests, pages, size, cost in self.rows():
+            print(f"API usage: {API_NAMES[service]} / {stage}: {requests} requests, {pages} pages, "
+                  f"{size / 1024:,.1f} KiB, ${cost:,.2f}")
+        print(f"API usage: estimated cost of this run ${self.cost():,.2f}")
+
+api_usage = ApiUsage(CE_REQUEST_BUDGET)
+
+def reset_api_usage(request_budget=None):
+    """Starts a run with an empty ledger (and CE_REQUEST_BUDGET unless given)."""
+    global api_usage
+    api_usage = ApiUsage(CE_REQUEST_BUDGET if request_budget is None else request_budget)
+
+def api_usage_html(usage):
+    """Per-stage table of the API calls behind the report."""
+    rows = ''.join(
+        f"<tr><td style='padding:4px;'>{API_NAMES[service]}</td><td style='padding:4px;'>{stage}</td>"
+        f"<td style='text-align:right; padding:4px;'>{requests:,}</td>"
+        f"<td style='text-align:right; padding:4px;'>{pages:,}</td>"
+        f"<td style='text-align:right; padding:4px;'>{size / 1024:,.1f}</td>"
+        f"<td style='text-align:right; padding:4px;'>$ {cost:,.2f}</td></tr>"
+        for service, stage, requests, pages, size, cost in usage.rows()
+    )
+    budget = f" of a budget of {usage.request_budget:,}" if usage.request_budget else ""
+    return (
+        "<h3>API calls for this report</h3>"
+        '<table border="1" style="border-collapse:collapse; font-family:Arial,sans-serif;">'
+        "<tr style='background-color:LightSteelBlue;'><th>API</th><th>Stage</th><th>Requests</th><th>Pages</th>"
+        "<th>KiB</th><th>Est. cost</th></tr>"
+        f"{rows}</table>"
+        f"<p>{usage.requests('ce'):,} Cost Explorer requests{budget}, estimated ${usage.cost():,.2f} "
+        f"(sending this email is not included).</p>"
+    )
+
+# -----------------------------------------------------------------------------
+# 1d3) DEBUG LOGGING AND METRICS (CLOUDWATCH EMBEDDED METRIC FORMAT)
+# -----------------------------------------------------------------------------
+
+# Whole return values are dumped only with LOG_LEVEL=DEBUG; otherwise they
+# are never formatted.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+
+def debug_dump(label, value):
+    """Prints value under a [DEBUG] label when LOG_LEVEL is DEBUG."""
+    if LOG_LEVEL == 'DEBUG':
+        print(f"\n[DEBUG] {label}:")
+        print(value)
+
+# Run metrics go out as CloudWatch Embedded Metric Format (EMF) JSON lines.
+# METRICS_SINK is 'stdout' (Lambda ships stdout to CloudWatch Logs, which
+# turns EMF lines into metrics), a local file the lines are appended to, or
+# 'off'. Tests can point metrics_sink at any callable taking one line.
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'CostReport')
+METRICS_SINK = os.environ.get('METRICS_SINK', 'stdout')
+
+# EMF takes at most 100 values per metric and line
+EMF_MAX_VALUES = 100
+
+def _append_line(path):
+    def write(line):
+        with open(path, 'a') as f:
+            f.write(line + '\n')
+    return write
+
+if METRICS_SINK == 'off':
+    metrics_sink = None
+elif METRICS_SINK == 'stdout':
+    metrics_sink = print
+else:
+    metrics_sink = _append_line(METRICS_SINK)
+
+class RunMetrics:
+    """
+    Metrics of one run: stage timers (milliseconds per lambda_handler
+    stage), counters, and latency histograms (one value per API call, per
+    service). emf_lines() renders them as EMF documents.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timers = {}
+        self.counters = {}
+        self.histograms = {}
+
+    def time(self, stage, fn, *args):
+        """Runs fn(*args) and records its wall time under stage."""
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            with self.lock:
+                self.timers[stage] = self.timers.get(stage, 0.0) + elapsed_ms
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, service, value_ms):
+        """Adds one call latency to service's histogram."""
+        with self.lock:
+            self.histograms.setdefault(service, []).append(round(value_ms, 3))
+
+    def emf_lines(self, namespace=None, timestamp_ms=None):
+        namespace = namespace or METRICS_NAMESPACE
+        timestamp_ms = int(time.time() * 1000) if timestamp_ms is None else timestamp_ms
+
+        def document(dimensions, metrics, values):
+            return json.dumps(dict(values, _aws={
+                'Timestamp': timestamp_ms,
+                'CloudWatchMetrics': [{
+                    'Namespace': namespace,
+                    'Dimensions': [dimensions],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, unit in metrics],
+                }],
+            }))
+
+        with self.lock:
+            lines = [
+                document(['Stage'], [('Duration', 'Milliseconds')], {'Stage': stage, 'Duration': round(elapsed_ms, 3)})
+                for stage, elapsed_ms in self.timers.items()
+            ]
+            if self.counters:
+                lines.append(document([], [(name, 'Count') for name in self.counters], self.counters))
+            for service, latencies in self.histograms.items():
+                for start in range(0, len(latencies), EMF_MAX_VALUES):
+                    lines.append(document(['Service'], [('Latency', 'Milliseconds')],
+                                          {'Service': service, 'Latency': latencies[start:start + EMF_MAX_VALUES]}))
+        return lines
+
+    def emit(self, sink=None):
+        """Writes every EMF line to sink (default: metrics_sink)."""
+        sink = sink or metrics_sink
+        if sink is None:
+            return
+        for line in self.emf_lines():
+            sink(line)
+
+run_metrics = RunMetrics()
+
+def reset_run_metrics():
+    global run_metrics
+    run_metrics = RunMetrics()
+    return run_metrics
+
+def count_run_totals(metrics, budget):
+    """Copies the run's request, coalescing and budget totals into metrics' counters."""
+    for service, stage, requests, pages, size, cost in api_usage.rows():
+        metrics.count(f"{METRIC_NAMES[service]}Requests", requests)
+        metrics.count(f"{METRIC_NAMES[service]}Pages", pages)
+        metrics.count(f"{METRIC_NAMES[service]}Bytes", size)
+    metrics.count('CostExplorerRetries', ce_retry_stats['retries'])
+    metrics.count('CostExplorerThrottles', ce_retry_stats['throttles'])
+    metrics.count('CheckpointPagesResumed', ce_retry_stats['resumed_pages'])
+    metrics.count('QueriesDerived', ce_coalescer.stats['derived'])
+    metrics.count('SectionsSkipped', len(budget.skipped))
+
+# -----------------------------------------------------------------------------
+# 1e) FETCH CHECKPOINTS (RESUMING AN INTERRUPTED RUN)
+# -----------------------------------------------------------------------------
+
+# With a run id (see checkpoint_run_id), every Cost Explorer page is
+# checkpointed as it arrives, in a local directory and, if a bucket is
+# configured, under an S3 prefix. Invoking the handler again with the same
+# run id replays the finished queries and pages and continues every
+# unfinished query from its last NextPageToken. The cubes and summaries are
+# rebuilt from the replayed pages, so the report comes out as if the run had
+# never stopped. Once the report is sent the run is marked complete and its
+# checkpoints are deleted; a later run with the same id starts afresh.
+CHECKPOINT_RUN_ID = os.environ.get('CHECKPOINT_RUN_ID', '')
+CHECKPOINT_DIR = os.environ.get('CHECKPOINT_DIR', '/tmp/ce-checkpoints')
+CHECKPOINT_BUCKET = os.environ.get('CHECKPOINT_BUCKET', '')
+CHECKPOINT_PREFIX = os.environ.get('CHECKPOINT_PREFIX', 'ce-checkpoints/')
+
+class FetchCheckpoint:
+    """
+    Fetch progress of one run in a CostResponseCache store. Every query
+    (keyed by its full parameters) has a progress record
+      { 'pages': <pages stored>, 'token': <NextPageToken or None>, 'done': bool }
+    and one object per page. A page is written before the progress record
+    that counts it, so a run killed in between only fetches that page again.
+    """
+    def __init__(self, run_id, store):
+        self.run_id = ''.join(c if c.isalnum() or c in '-_' else '_' for c in run_id)
+        self.store = store
+
+    def query_key(self, params):
+        digest = hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+        return f"{self.run_id}-{digest}"
+
+    def progress(self, key):
+        return self.store.get(key) or {'pages': 0, 'token': None, 'done': False}
+
+    def replay(self, key, pages):
+        """Yields the first `pages` stored pages of a query, stopping at a missing one."""
+        for n in range(pages):
+            page = self.store.get(f"{key}-{n}")
+            if page is None:
+                return
+            _count_retry('resumed_pages')
+            yield page
+
+    def record_page(self, key, progress, page, token):
+        self.store.put(f"{key}-{progress['pages']}", page)
+        progress = {'pages': progress['pages'] + 1, 'token': token, 'done': not token}
+        self.store.put(key, progress)
+        return progress
+
+    def record_done(self, key, progress):
+        self.store.put(key, dict(progress, token=None, done=True))
+
+    def marker_key(self):
+        return f"{self.run_id}-complete"
+
+    def completed(self):
+        return self.store.get(self.marker_key()) is not None
+
+    def complete(self):
+        """
+        Marks the run complete once its report went out, then deletes its
+        checkpoints, locally and in S3. The marker goes first, so a run
+        interrupted while deleting is still never resumed.
+        """
+        self.store.put(self.marker_key(), {'completed': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())})
+        self.store.delete_prefix(self.run_id + '-', keep=(self.marker_key(),))
+
+    def clear(self):
+        """Deletes everything stored for the run, the completion marker included."""
+        self.store.delete_prefix(self.run_id + '-')
+
+fetch_checkpoint = None
+
+def checkpoint_run_id(event, context=None):
+    """
+    Run id the fetches are checkpointed under: event['run_id'] as given
+    (shard workers get their coordinator's), else CHECKPOINT_RUN_ID
+    qualified by the invocation, i.e. context.aws_request_id (which Lambda
+    keeps across the retries of an async invocation) or, without a context,
+    today's date. '' turns checkpointing off.
+    """
+    if event.get('run_id'):
+        return event['run_id']
+    if not CHECKPOINT_RUN_ID:
+        return ''
+    invocation = getattr(context, 'aws_request_id', '') or time.strftime('%Y-%m-%d', time.gmtime())
+    return f"{CHECKPOINT_RUN_ID}-{invocation}"
+
+def start_checkpoint(run_id):
+    """
+    Checkpoints (and resumes) the fetches of run_id; an empty run id turns
+    checkpointing off. A run id that already completed starts afresh.
+    """
+    global fetch_checkpoint
+    fetch_checkpoint = None
+    if run_id:
+        s3_client = get_s3_client() if CHECKPOINT_BUCKET else None
+        store = CostResponseCache(CHECKPOINT_DIR, s3_client, CHECKPOINT_BUCKET, CHECKPOINT_PREFIX)
+        fetch_checkpoint = FetchCheckpoint(run_id, store)
+        if fetch_checkpoint.completed():
+            print(f"Run {run_id} already completed; fetching afresh")
+            fetch_checkpoint.clear()
+        print(f"Checkpointing fetches for run {run_id}")
+    return fetch_checkpoint
+
+# -----------------------------------------------------------------------------
+# 1f) ACCOUNT DISCOVERY (AWS ORGANIZATIONS)
+# -----------------------------------------------------------------------------
+
+# ACCOUNT_SOURCE=organizations replaces the accountDict / accountMailDict /
+# displayListMonthly literals with the ACTIVE accounts listed by AWS
+# Organizations, optionally only those under ORG_OU_IDS (nested OUs
+# included). The account tree is cached for ORG_CACHE_TTL_SECONDS in memory
+# (warm invocations), in a local directory and, if a bucket is configured,
+# under an S3 prefix (cold invocations).
+ACCOUNT_SOURCE = os.environ.get('ACCOUNT_SOURCE', 'static')
+ORG_OU_IDS = [v for v in os.environ.get('ORG_OU_IDS', '').split(',') if v]
+ORG_CACHE_TTL_SECONDS = int(os.environ.get('ORG_CACHE_TTL_SECONDS', '3600'))
+ORG_CACHE_DIR = os.environ.get('ORG_CACHE_DIR', '/tmp/org-cache')
+ORG_CACHE_BUCKET = os.environ.get('ORG_CACHE_BUCKET', '')
+ORG_CACHE_PREFIX = os.environ.get('ORG_CACHE_PREFIX', 'org-cache/')
+# Accounts with their own summary column (comma separated ids). Default:
+# the first DISPLAY_ACCOUNT_LIMIT accounts by name.
+DISPLAY_ACCOUNTS = [v for v in os.environ.get('DISPLAY_ACCOUNTS', '').split(',') if v]
+DISPLAY_ACCOUNT_LIMIT = int(os.environ.get('DISPLAY_ACCOUNT_LIMIT', '10'))
+
+def iter_org_pages(operation, field, **params):
+    """Yields every item of a paginated (NextToken) Organizations list call."""
+    client = get_organizations_client()
+    token = None
+    while True:
+        kwargs = {'NextToken': token} if token else {}
+        response = getattr(client, operation)(**params, **kwargs)
+        yield from response[field]
+        token = response.get('NextToken')
+        if not token:
+            break
+
+def list_organization_tree():
+    """
+    Walks the organization from its roots and returns a JSON-ready tree:
+      { 'fetched_at': <epoch seconds>,
+        'ous': { ou_or_root_id: {'Name', 'Parent'} },
+        'accounts': [ {'Id', 'Name', 'Email', 'Parent'}, ... ] }
+    Only ACTIVE accounts are kept.
+    """
+    tree = {'fetched_at': time.time(), 'ous': {}, 'accounts': []}
+    parents = []
+    for root in iter_org_pages('list_roots', 'Roots'):
+        tree['ous'][root['Id']] = {'Name': root['Name'], 'Parent': None}
+        parents.append(root['Id'])
+
+    while parents:
+        parent_id = parents.pop()
+        for ou in iter_org_pages('list_organizational_units_for_parent', 'OrganizationalUnits', ParentId=parent_id):
+            tree['ous'][ou['Id']] = {'Name': ou['Name'], 'Parent': parent_id}
+            parents.append(ou['Id'])
+        for account in iter_org_pages('list_accounts_for_parent', 'Accounts', ParentId=parent_id):
+            if account.get('Status', 'ACTIVE') == 'ACTIVE':
+                tree['accounts'].append({'Id': account['Id'], 'Name': account['Name'],
+                                         'Email': account.get('Email', ''), 'Parent': parent_id})
+
+    print(f"Organizations: {len(tree['accounts'])} active accounts in {len(tree['ous'])} roots / OUs")
+    return tree
+
+class AccountDirectory:
+    """
+    Indexes over an organization tree (see list_organization_tree):
+      names:       { account_id: name }
+      emails:      { account_id: owner email }
+      account_ou:  { account_id: id of the OU (or root) holding it }
+      ou_paths:    { ou_id: 'Root/Workloads/Prod' }
+      ou_accounts: { ou_id: set of account ids in it or any nested OU }
+      ids:         set of every account id
+    """
+    def __init__(self, tree):
+        self.tree = tree
+        self.fetched_at = tree['fetched_at']
+        self.names = {account['Id']: account['Name'] for account in tree['accounts']}
+        self.emails = {account['Id']: account['Email'] for account in tree['accounts']}
+        self.account_ou = {account['Id']: account['Parent'] for account in tree['accounts']}
+        self.ids = set(self.names)
+
+        ous = tree['ous']
+        self.ou_paths = {}
+        for ou_id in ous:
+            names = []
+            node = ou_id
+            while node is not None:
+                names.append(ous[node]['Name'])
+                node = ous[node]['Parent']
+            self.ou_paths[ou_id] = '/'.join(reversed(names))
+
+        self.ou_accounts = {ou_id: set() for ou_id in ous}
+        for acct_id, ou_id in self.account_ou.items():
+            while ou_id is not None:
+                self.ou_accounts[ou_id].add(acct_id)
+                ou_id = ous[ou_id]['Parent']
+
+    def accounts_under(self, ou_ids):
+        """Ids of the accounts in any of ou_ids (nested OUs included)."""
+        return set().union(*(self.ou_accounts.get(ou_id, ()) for ou_id in ou_ids))
+
+account_directory = None
+
+def get_account_directory():
+    """
+    Returns the AccountDirectory, listing the organization only when neither
+    the in-memory copy nor the stored tree is younger than
+    ORG_CACHE_TTL_SECONDS.
+    """
+    global account_directory
+    now = time.time()
+    if account_directory is not None and now - account_directory.fetched_at < ORG_CACHE_TTL_SECONDS:
+        return account_directory
+
+    s3_client = get_s3_client() if ORG_CACHE_BUCKET else None
+    store = CostResponseCache(ORG_CACHE_DIR, s3_client, ORG_CACHE_BUCKET, ORG_CACHE_PREFIX)
+    tree = store.get('organization-tree')
+    if tree is None or now - tree['fetched_at'] >= ORG_CACHE_TTL_SECONDS:
+        tree = list_organization_tree()
+        store.put('organization-tree', tree)
+    account_directory = AccountDirectory(tree)
+    return account_directory
+
+def use_account_directory(directory):
+    """Points accountDict, accountMailDict and displayListMonthly at the discovered accounts."""
+    global accountDict, accountMailDict, displayListMonthly
+    ids = directory.accounts_under(ORG_OU_IDS) if ORG_OU_IDS else directory.ids
+    ordered = sorted(ids, key=lambda acct_id: (directory.names[acct_id], acct_id))
+    accountDict = {acct_id: directory.names[acct_id] for acct_id in ordered}
+    accountMailDict = {acct_id: directory.emails[acct_id] for acct_id in ordered}
+    display = [acct_id for acct_id in DISPLAY_ACCOUNTS if acct_id in accountDict] or ordered[:DISPLAY_ACCOUNT_LIMIT]
+    displayListMonthly = display + ['monthTotal']
+    print(f"Reporting on {len(accountDict)} discovered accounts")
+
 # -----------------------------------------------------------------------------
 # 2) RETRIEVE COST INFO PER ACCOUNT (Summary Table)
 # -----------------------------------------------------------------------------
 
+# Maximum number of account IDs placed in a single LINKED_ACCOUNT filter.
+# The summary is fetched with one GroupBy LINKED_ACCOUNT query per chunk
+# instead of one query per account.
+CE_ACCOUNT_CHUNK_SIZE = 100
+
+def plan_account_queries(account_ids, chunk_size=CE_ACCOUNT_CHUNK_SIZE):
+    """
+    Splits the account list into the chunks that each become one
+    GroupBy LINKED_ACCOUNT query. A single chunk is returned unless the
+    filter value list is longer than chunk_size.
+    """
+    account_ids = list(account_ids)
+    return [account_ids[i:i + chunk_size] for i in range(0, len(account_ids), chunk_size)]
+
+def get_grouped_account_costs(account_ids, time_period=None):
+    """
+    Runs one paginated get_cost_and_usage query grouped by LINKED_ACCOUNT
+    for the given accounts and returns every ResultsByTime entry it produced.
+    time_period defaults to the whole reporting window.
+    """
+    if time_period is None:
+        time_period = {'Start': MONTHLY_START_DATE, 'End': MONTHLY_END_DATE}
+
+    return get_cost_and_usage_cached({
+        'TimePeriod': time_period,
+        'Granularity': CE_GRANULARITY,
+        'Metrics': CE_METRICS,
+        'GroupBy': [{'Type': 'DIMENSION', 'Key': 'LINKED_ACCOUNT'}],
+        'Filter': {'Dimensions': {'Key': 'LINKED_ACCOUNT', 'Values': account_ids}}
+    })
+
+def demux_account_results(results_by_time, account_ids):
+    """
+    Splits grouped ResultsByTime entries back into one response per account,
+    shaped like an ungrouped get_cost_and_usage response:
+      { account_id: { 'ResultsByTime': [ { 'TimePeriod', 'Total', 'Estimated' }, ... ] } }
+    A month can be spread over several pages, so entries are merged by start date.
+    Months with no group for an account get a zero Total. Total carries
+    every requested metric.
+    """
+    periods = {}
+    for time_period in results_by_time:
+        start_str = time_period['TimePeriod']['Start']
+        if start_str not in periods:
+            periods[start_str] = {
+                'TimePeriod': time_period['TimePeriod'],
+                'Estimated': time_period.get('Estimated', False),
+                'Amounts': {}
+            }
+        for group in time_period.get('Groups', []):
+            periods[start_str]['Amounts'][group['Keys'][0]] = group['Metrics']
+
+    zero = {metric: {'Amount': '0', 'Unit': 'USD'} for metric in CE_METRICS}
+    demuxed = {}
+    for acct_id in account_ids:
+        acct_results = []
+        for period in periods.values():
+            acct_results.append({
+                'TimePeriod': period['TimePeriod'],
+                'Total': period['Amounts'].get(acct_id, zero),
+                'Estimated': period['Estimated']
+            })
+        demuxed[acct_id] = {'ResultsByTime': acct_results}
+
+    return demuxed
+
 def ce_get_costinfo_per_account(accountDict_input):
     accountCostDict = {}
 
-    for acct_id in accountDict_input:
-        print(f"Querying cost data for account: {acct_id}")
-        response = cost_explorer.get_cost_and_usage(
-            TimePeriod={
-                'Start': MONTHLY_START_DATE,
-                'End': MONTHLY_END_DATE
-            },
-            Granularity='MONTHLY',
-            Filter={
-                'Dimensions': {
-                    'Key': 'LINKED_ACCOUNT',
-                    'Values': [acct_id]
-                }
-            },
-            Metrics=['UnblendedCost']
-        )
-
+    account_ids = list(accountDict_input)
+    tasks = [
+        (get_grouped_account_costs, (chunk, window))
+        for chunk in plan_account_queries(account_ids)
+        for window in plan_time_windows()
+    ]
+    print(f"Querying cost data for {len(account_ids)} accounts in {len(tasks)} grouped queries")
+    results = merge_results_by_time(run_fetch_tasks(tasks))
+    responses = demux_account_results(results, account_ids)
+
+    for acct_id, response in responses.items():
         period_cost = 0.0
         for month_data in response['ResultsByTime']:
-            cost_val = float(month_data['Total']['UnblendedCost']['Amount'])
+            cost_val = float(month_data['Total'][REPORT_METRIC]['Amount'])
             period_cost += cost_val
 
         print(f"Cost of account {acct_id} for the period {MONTHLY_START_DATE} to {MONTHLY_END_DATE} is: {period_cost}")
@@ -95,8 +1650,7 @@ def ce_get_costinfo_per_account(accountDict_input):
 
     print("Completed ce_get_costinfo_per_account. accountCostDict keys:", list(accountCostDict.keys()))
 
-    print("\n[DEBUG] ce_get_costinfo_per_account() return value:")
-    print(accountCostDict)
+    debug_dump("ce_get_costinfo_per_account() return value", accountCostDict)
 
     return accountCostDict
 
@@ -104,31 +1658,18 @@ def ce_get_costinfo_per_account(accountDict_input):
 # 3) CREATE A MONTHLY-KEYED DICTIONARY OF COSTS
 # -----------------------------------------------------------------------------
 
-def process_costchanges_per_month(accountCostDict_input):
-    reportCostDict = {}
-
-    for date_str in MONTHLY_COST_DATES:
-        reportCostDict[date_str] = {}
-
+def process_costchanges_per_month(accountCostDict_input, metric=None):
+    # Accumulate into a cost cube (one 'Total' service per account), roll
+    # DAILY / HOURLY data up to the report periods and read the monthly
+    # dict of `metric` (default REPORT_METRIC) back out of it
+    summary_cube = CostCube(cube_periods(), [metric or REPORT_METRIC])
     for acct_id, response_data in accountCostDict_input.items():
-        for month_data in response_data['ResultsByTime']:
-            start_str = month_data['TimePeriod']['Start']
-            if start_str not in reportCostDict:
-                reportCostDict[start_str] = {}
-            reportCostDict[start_str][acct_id] = {
-                'Cost': float(month_data['Total']['UnblendedCost']['Amount'])
-            }
-
-    for date_str in reportCostDict:
-        month_total = 0.0
-        for acct_id in reportCostDict[date_str]:
-            month_total += reportCostDict[date_str][acct_id]['Cost']
-        reportCostDict[date_str]['monthTotal'] = {'Cost': month_total}
+        summary_cube.add_results(response_data['ResultsByTime'], account=acct_id, service='Total')
+    reportCostDict = rollup_for_report(summary_cube).to_monthly_dict(report_periods())
 
     print("Completed process_costchanges_per_month. Keys in reportCostDict:", list(reportCostDict.keys()))
 
-    print("\n[DEBUG] process_costchanges_per_month() return value:")
-    print(reportCostDict)
+    debug_dump("process_costchanges_per_month() return value", reportCostDict)
 
     return reportCostDict
 
@@ -142,19 +1683,20 @@ def process_costchanges_for_display(reportCostDict_input):
     for date_str in reportCostDict_input:
         displayReportCostDict[date_str] = {}
         others_cost = 0.0
+        others_estimated = False
 
         for acct_id, cost_obj in reportCostDict_input[date_str].items():
             if acct_id in displayListMonthly:
                 displayReportCostDict[date_str][acct_id] = cost_obj
             else:
                 others_cost += cost_obj['Cost']
+                others_estimated = others_estimated or cost_obj.get('Estimated', False)
 
-        displayReportCostDict[date_str]['Others'] = {'Cost': others_cost}
+        displayReportCostDict[date_str]['Others'] = {'Cost': others_cost, 'Estimated': others_estimated}
 
     print("Completed process_costchanges_for_display.")
 
-    print("\n[DEBUG] process_costchanges_for_display() return value:")
-    print(displayReportCostDict)
+    debug_dump("process_costchanges_for_display() return value", displayReportCostDict)
 
     return displayReportCostDict
 
@@ -162,34 +1704,25 @@ def process_costchanges_for_display(reportCostDict_input):
 # 5) CALCULATE PERCENT CHANGES MONTH-TO-MONTH
 # -----------------------------------------------------------------------------
 
-def process_percentchanges_per_month(reportCostDict_input):
+def process_percentchanges_per_month(reportCostDict_input, deltas=None):
+    """
+    Stores 'percentDelta' on every cell from the delta engine. deltas is a
+    CostDeltas over the same data; by default one is built here for the
+    configured comparison (DELTA_COMPARISON).
+    """
     sorted_months = sorted(reportCostDict_input.keys())
     print("Calculating percent changes across months:", sorted_months)
 
-    for i in range(len(sorted_months)):
-        curr_month = sorted_months[i]
-        if i == 0:
-            for acct_id in reportCostDict_input[curr_month]:
-                reportCostDict_input[curr_month][acct_id]['percentDelta'] = None
-        else:
-            prev_month = sorted_months[i - 1]
-            for acct_id, cost_data in reportCostDict_input[curr_month].items():
-                curr_cost = cost_data['Cost']
-                if acct_id in reportCostDict_input[prev_month]:
-                    prev_cost = reportCostDict_input[prev_month][acct_id]['Cost']
-                else:
-                    prev_cost = 0.0
-
-                if prev_cost == 0 or curr_cost == 0:
-                    reportCostDict_input[curr_month][acct_id]['percentDelta'] = None
-                else:
-                    delta = (curr_cost / prev_cost) - 1
-                    reportCostDict_input[curr_month][acct_id]['percentDelta'] = delta
+    if deltas is None:
+        deltas = CostDeltas(CostCube.from_monthly_dict(reportCostDict_input), DELTA_OFFSETS[DELTA_COMPARISON])
+
+    for month in sorted_months:
+        for acct_id, cost_data in reportCostDict_input[month].items():
+            cost_data['percentDelta'] = deltas.percent(acct_id, 'Total', month)
 
     print("Completed process_percentchanges_per_month.")
 
-    print("\n[DEBUG] process_percentchanges_per_month() return value:")
-    print(reportCostDict_input)
+    debug_dump("process_percentchanges_per_month() return value", reportCostDict_input)
 
     return reportCostDict_input
 
@@ -197,86 +1730,199 @@ def process_percentchanges_per_month(reportCostDict_input):
 # 6) CREATE SUMMARY HTML REPORT
 # -----------------------------------------------------------------------------
 
-def create_report_html(emailDisplayDict_input, BODY_HTML):
-    print("Generating summary HTML report...")
-
-    def evaluate_change(value):
-        if value is None:
-            return "<td>&nbsp;</td>"
-        elif value < -0.15:
-            return f"<td style='text-align:right; color:Navy; font-weight:bold;'>{value:.2%}</td>"
-        elif -0.15 <= value < -0.10:
-            return f"<td style='text-align:right; color:Blue; font-weight:bold;'>{value:.2%}</td>"
-        elif -0.10 <= value < -0.05:
-            return f"<td style='text-align:right; color:DodgerBlue; font-weight:bold;'>{value:.2%}</td>"
-        elif -0.05 <= value < -0.02:
-            return f"<td style='text-align:right; color:DeepSkyBlue; font-weight:bold;'>{value:.2%}</td>"
-        elif -0.02 <= value <= 0.02:
-            return f"<td style='text-align:right;'>{value:.2%}</td>"
-        elif 0.02 < value <= 0.05:
-            return f"<td style='text-align:right; color:Orange; font-weight:bold;'>{value:.2%}</td>"
-        elif 0.05 < value <= 0.10:
-            return f"<td style='text-align:right; color:DarkOrange; font-weight:bold;'>{value:.2%}</td>"
-        elif 0.10 < value <= 0.15:
-            return f"<td style='text-align:right; color:OrangeRed; font-weight:bold;'>{value:.2%}</td>"
-        elif value > 0.15:
-            return f"<td style='text-align:right; color:Red; font-weight:bold;'>{value:.2%}</td>"
-        else:
-            return f"<td style='text-align:right;'>{value:.2%}</td>"
-
-    def row_color(i_row):
-        return "<tr style='background-color:WhiteSmoke;'>" if (i_row % 2) == 0 else "<tr>"
-
-    BODY_HTML += "<table border='1' style='border-collapse:collapse; font-family:Arial, sans-serif; font-size:12px;'>"
+# The summary table header only depends on the account configuration, so it
+# is built once and reused across warm invocations.
+_summary_header_cache = {}
+
+# Row fragments are precompiled str.format templates so the renderers below
+# only fill in values; every renderer yields fragments instead of growing one
+# string, and the caller joins (or streams) them once.
+COST_CELL = "<td style='text-align:right; padding:4px;'>$ {:,.2f}</td>".format
+SUMMARY_MONTH_CELL = "<td style='text-align:center;'>{}</td>".format
+TEAM_HEADING = """
+    <h3>{} vs. Overall Cost (Account {})</h3>
+    <table border="1" style="border-collapse: collapse; font-family: Arial, sans-serif;">
+      <tr style="background-color: SteelBlue; color: white;">
+        <th>Service Name</th>
+        <th>Overall Cost</th>
+        <th>Overall Δ%</th>
+        <th>Team Δ%</th>
+        <th>Team Δ$</th>
+      </tr>
+    """.format
+TEAM_SERVICE_CELL = "<tr><td style='padding:4px;'>{}</td>".format
+TEAM_DELTA_CELL = "<td style='text-align:right; padding:4px;'>{}</td>".format
+BREAKDOWN_ACCOUNT_ROW = '<tr style="background-color:SteelBlue;"><td colspan="{}" style="text-align:center; font-weight:bold;">{} ({})</td></tr>'.format
+BREAKDOWN_MONTH_HEADER = '<td style="text-align:center; font-weight:bold;">{}</td>'.format
+BREAKDOWN_SERVICE_CELL = '<td style="text-align:left;">{}</td>'.format
+BREAKDOWN_COST_CELL = '<td style="text-align:right; padding:4px;">$ {:,.2f}</td>'.format
+EMPTY_CELL = "<td>&nbsp;</td>"
+QUANTITY_CELL = "<td style='text-align:right; padding:4px;'>{:,.2f}</td>".format
+BREAKDOWN_QUANTITY_CELL = '<td style="text-align:right; padding:4px;">{:,.2f}</td>'.format
+METRIC_HEADER_CELL = "<td style='text-align:center;'>{}</td>".format
+
+# Metrics that are amounts of usage rather than money (no "$")
+QUANTITY_METRICS = {'UsageQuantity', 'NormalizedUsageAmount'}
+
+def value_cell(metric=None):
+    """Returns the cell template for values of metric (default REPORT_METRIC)."""
+    return QUANTITY_CELL if (metric or REPORT_METRIC) in QUANTITY_METRICS else COST_CELL
+
+def change_cell_html(value):
+    """Colour-coded Δ% <td> used by the summary and per-service tables."""
+    if value is None:
+        return EMPTY_CELL
+    elif value < -0.15:
+        return f"<td style='text-align:right; color:Navy; font-weight:bold;'>{value:.2%}</td>"
+    elif -0.15 <= value < -0.10:
+        return f"<td style='text-align:right; color:Blue; font-weight:bold;'>{value:.2%}</td>"
+    elif -0.10 <= value < -0.05:
+        return f"<td style='text-align:right; color:DodgerBlue; font-weight:bold;'>{value:.2%}</td>"
+    elif -0.05 <= value < -0.02:
+        return f"<td style='text-align:right; color:DeepSkyBlue; font-weight:bold;'>{value:.2%}</td>"
+    elif -0.02 <= value <= 0.02:
+        return f"<td style='text-align:right;'>{value:.2%}</td>"
+    elif 0.02 < value <= 0.05:
+        return f"<td style='text-align:right; color:Orange; font-weight:bold;'>{value:.2%}</td>"
+    elif 0.05 < value <= 0.10:
+        return f"<td style='text-align:right; color:DarkOrange; font-weight:bold;'>{value:.2%}</td>"
+    elif 0.10 < value <= 0.15:
+        return f"<td style='text-align:right; color:OrangeRed; font-weight:bold;'>{value:.2%}</td>"
+    elif value > 0.15:
+        return f"<td style='text-align:right; color:Red; font-weight:bold;'>{value:.2%}</td>"
+    else:
+        return f"<td style='text-align:right;'>{value:.2%}</td>"
+
+def change_span_html(value):
+    """Colour-coded Δ% <span> used inside the team comparison table."""
+    if value is None:
+        return ""
+    pct = f"{value:.2%}"
+    # Basic color coding example
+    if value > 0.15:
+        return f"<span style='color:Red; font-weight:bold;'>{pct}</span>"
+    elif value > 0.05:
+        return f"<span style='color:DarkOrange; font-weight:bold;'>{pct}</span>"
+    elif value > 0.02:
+        return f"<span style='color:Orange; font-weight:bold;'>{pct}</span>"
+    elif value >= -0.02:
+        return pct
+    elif value < -0.15:
+        return f"<span style='color:Navy; font-weight:bold;'>{pct}</span>"
+    else:
+        return f"<span>{pct}</span>"
+
+def get_summary_header_html():
+    """Returns the opening <table> tag and both summary header rows."""
+    cache_key = (tuple(displayListMonthly), tuple(accountDict.items()))
+    if cache_key in _summary_header_cache:
+        return _summary_header_cache[cache_key]
+
+    header_html = "<table border='1' style='border-collapse:collapse; font-family:Arial, sans-serif; font-size:12px;'>"
 
     # Header row 1
-    BODY_HTML += "<tr style='background-color:SteelBlue;'>"
-    BODY_HTML += "<td>&nbsp;</td>"
+    header_html += "<tr style='background-color:SteelBlue;'>"
+    header_html += "<td>&nbsp;</td>"
     for acct_id in displayListMonthly:
         if acct_id in accountDict:
-            BODY_HTML += f"<td colspan='2' style='text-align:center;'><b>{accountDict[acct_id]}</b></td>"
+            header_html += f"<td colspan='2' style='text-align:center;'><b>{accountDict[acct_id]}</b></td>"
         elif acct_id == 'monthTotal':
-            BODY_HTML += "<td colspan='2' style='text-align:center;'><b>Total</b></td>"
+            header_html += "<td colspan='2' style='text-align:center;'><b>Total</b></td>"
         elif acct_id == 'Others':
-            BODY_HTML += "<td colspan='2' style='text-align:center;'><b>Others</b></td>"
-    BODY_HTML += "</tr>"
+            header_html += "<td colspan='2' style='text-align:center;'><b>Others</b></td>"
+    header_html += "</tr>"
 
     # Header row 2
-    BODY_HTML += "<tr style='background-color:LightSteelBlue;'>"
-    BODY_HTML += "<td style='text-align:center;width:80px;'><b>Month</b></td>"
+    header_html += "<tr style='background-color:LightSteelBlue;'>"
+    header_html += "<td style='text-align:center;width:80px;'><b>Month</b></td>"
     for acct_id in displayListMonthly:
         if acct_id in accountDict:
-            BODY_HTML += f"<td style='text-align:center;width:95px;'>{acct_id}</td><td style='text-align:center;'>&Delta;%</td>"
+            header_html += f"<td style='text-align:center;width:95px;'>{acct_id}</td><td style='text-align:center;'>&Delta;%</td>"
         elif acct_id == 'monthTotal':
-            BODY_HTML += "<td style='text-align:center;width:95px;'>All</td><td style='text-align:center;'>&Delta;%</td>"
+            header_html += "<td style='text-align:center;width:95px;'>All</td><td style='text-align:center;'>&Delta;%</td>"
         elif acct_id == 'Others':
-            BODY_HTML += "<td style='text-align:center;width:95px;'>Others</td><td style='text-align:center;'>&Delta;%</td>"
-    BODY_HTML += "</tr>"
+            header_html += "<td style='text-align:center;width:95px;'>Others</td><td style='text-align:center;'>&Delta;%</td>"
+    header_html += "</tr>"
 
-    sorted_months = sorted(emailDisplayDict_input.keys())
-    i_row = 0
-    for month_str in sorted_months:
-        BODY_HTML += row_color(i_row)
-        BODY_HTML += f"<td style='text-align:center;'>{month_str}</td>"
+    _summary_header_cache[cache_key] = header_html
+    return header_html
 
+def iter_report_html(emailDisplayDict_input, metric=None):
+    """
+    Yields the summary table (header, one row per month, footnotes) as HTML
+    fragments. metric (default REPORT_METRIC) only picks the value format.
+    """
+    cell = value_cell(metric)
+    yield get_summary_header_html()
+
+    sorted_months = sorted(emailDisplayDict_input.keys())
+    estimated_months = [
+        month_str for month_str in sorted_months
+        if any(cost_obj.get('Estimated', False) for cost_obj in emailDisplayDict_input[month_str].values())
+    ]
+    empty = {}
+    for i_row, month_str in enumerate(sorted_months):
+        yield "<tr style='background-color:WhiteSmoke;'>" if (i_row % 2) == 0 else "<tr>"
+        yield SUMMARY_MONTH_CELL(f"{month_str}*" if month_str in estimated_months else month_str)
+
+        month_costs = emailDisplayDict_input[month_str]
         for acct_id in displayListMonthly:
-            cost_val = emailDisplayDict_input[month_str].get(acct_id, {}).get('Cost', 0.0)
-            pct_change = emailDisplayDict_input[month_str].get(acct_id, {}).get('percentDelta', None)
+            cost_obj = month_costs.get(acct_id, empty)
+            yield cell(cost_obj.get('Cost', 0.0))
+            yield change_cell_html(cost_obj.get('percentDelta', None))
+
+        yield "</tr>"
 
-            BODY_HTML += f"<td style='text-align:right; padding:4px;'>$ {cost_val:,.2f}</td>"
-            BODY_HTML += evaluate_change(pct_change)
+    yield "</table><br>"
+    yield f"<div style='font-size:12px; font-style:italic;'>Reporting Window: {MONTHLY_START_DATE} to {MONTHLY_END_DATE}</div>"
+    if estimated_months:
+        yield "<div style='font-size:12px; font-style:italic;'>* Estimated: Cost Explorer has not finalized these months yet.</div>"
 
-        BODY_HTML += "</tr>"
-        i_row += 1
+def create_report_html(emailDisplayDict_input, BODY_HTML, metric=None):
+    print("Generating summary HTML report...")
 
-    BODY_HTML += "</table><br>"
-    BODY_HTML += f"<div style='font-size:12px; font-style:italic;'>Reporting Window: {MONTHLY_START_DATE} to {MONTHLY_END_DATE}</div>"
+    BODY_HTML += ''.join(iter_report_html(emailDisplayDict_input, metric))
 
-    print("\n[DEBUG] create_report_html() HTML output:")
-    print(BODY_HTML, "\n")
+    debug_dump("create_report_html() HTML output", BODY_HTML)
 
     return BODY_HTML
 
+def iter_metric_comparison_html(metric_display_dicts):
+    """
+    Yields a side-by-side summary of several metrics: one row per month and,
+    for every displayed account, one column per metric.
+    metric_display_dicts: { metric: process_costchanges_for_display() result }
+    """
+    metrics = list(metric_display_dicts)
+    labels = {'monthTotal': 'Total', 'Others': 'Others'}
+
+    yield "<h2>AWS Monthly Cost Report - Metric Comparison</h2>"
+    yield "<table border='1' style='border-collapse:collapse; font-family:Arial, sans-serif; font-size:12px;'>"
+    yield "<tr style='background-color:SteelBlue;'><td>&nbsp;</td>"
+    for acct_id in displayListMonthly:
+        label = accountDict.get(acct_id) or labels.get(acct_id, acct_id)
+        yield f"<td colspan='{len(metrics)}' style='text-align:center;'><b>{label}</b></td>"
+    yield "</tr>"
+    yield "<tr style='background-color:LightSteelBlue;'><td style='text-align:center;width:80px;'><b>Month</b></td>"
+    yield ''.join(METRIC_HEADER_CELL(metric) for metric in metrics) * len(displayListMonthly)
+    yield "</tr>"
+
+    cells = [value_cell(metric) for metric in metrics]
+    empty = {}
+    months = sorted(set().union(*metric_display_dicts.values()))
+    for i_row, month_str in enumerate(months):
+        yield "<tr style='background-color:WhiteSmoke;'>" if (i_row % 2) == 0 else "<tr>"
+        yield SUMMARY_MONTH_CELL(month_str)
+        for acct_id in displayListMonthly:
+            for metric, cell in zip(metrics, cells):
+                cost_obj = metric_display_dicts[metric].get(month_str, empty).get(acct_id, empty)
+                yield cell(cost_obj.get('Cost', 0.0))
+        yield "</tr>"
+    yield "</table><br>"
+
+def create_metric_comparison_html(metric_display_dicts):
+    return ''.join(iter_metric_comparison_html(metric_display_dicts))
+
 # -----------------------------------------------------------------------------
 # 7) GET LINKED ACCOUNTS, GET COST DATA, RESTRUCTURE, ETC. (Unchanged)
 # -----------------------------------------------------------------------------
@@ -288,7 +1934,8 @@ def get_linked_accounts(account_list):
 
     while True:
         kwargs = {'NextPageToken': token} if token else {}
-        linked_accounts = cost_explorer.get_dimension_values(
+        linked_accounts = ce_request(
+            'get_dimension_values',
             TimePeriod={'Start': MONTHLY_START_DATE, 'End': MONTHLY_END_DATE},
             Dimension='LINKED_ACCOUNT',
             **kwargs
@@ -298,46 +1945,64 @@ def get_linked_accounts(account_list):
         if not token:
             break
 
-    active_accounts = [item['Value'] for item in results]
+    active_accounts = {item['Value'] for item in results}
     defined_accounts = [acct for acct in account_list if acct in active_accounts]
 
     print("Active accounts found:", active_accounts)
     print("Filtered/defined accounts:", defined_accounts)
 
-    print("\n[DEBUG] get_linked_accounts() return value:")
-    print(defined_accounts)
+    debug_dump("get_linked_accounts() return value", defined_accounts)
 
     return defined_accounts
 
+def plan_service_queries(account_numbers, query_filter, fetch=None):
+    """
+    Builds the (function, args) tasks for a (LINKED_ACCOUNT, SERVICE) grouped
+    query: one task per account chunk and sub-window. query_filter receives
+    the account chunk and returns the Filter for that chunk. fetch is the
+    task function (get_cost_and_usage_cached, or iter_cost_and_usage_cached
+    for iter_fetch_pages).
+    """
+    tasks = []
+    for chunk in plan_account_queries(account_numbers):
+        for window in plan_time_windows():
+            tasks.append((fetch or get_cost_and_usage_cached, ({
+                'TimePeriod': window,
+                'Granularity': CE_GRANULARITY,
+                'Metrics': CE_METRICS,
+                'GroupBy': [
+                    {'Type': 'DIMENSION', 'Key': 'LINKED_ACCOUNT'},
+                    {'Type': 'DIMENSION', 'Key': 'SERVICE'}
+                ],
+                'Filter': query_filter(chunk)
+            },)))
+    return tasks
+
 def get_cost_data(account_numbers):
     print("get_cost_data called with accounts:", account_numbers)
-    results = []
-    token = None
 
-    while True:
-        kwargs = {'NextPageToken': token} if token else {}
-        data = cost_explorer.get_cost_and_usage(
-            TimePeriod={'Start': MONTHLY_START_DATE, 'End': MONTHLY_END_DATE},
-            Granularity='MONTHLY',
-            Metrics=['UnblendedCost'],
-            GroupBy=[
-                {'Type': 'DIMENSION', 'Key': 'LINKED_ACCOUNT'},
-                {'Type': 'DIMENSION', 'Key': 'SERVICE'}
-            ],
-            Filter={'Dimensions': {'Key': 'LINKED_ACCOUNT', 'Values': account_numbers}},
-            **kwargs
-        )
-        results += data['ResultsByTime']
-        token = data.get('NextPageToken')
-        if not token:
-            break
+    tasks = plan_service_queries(account_numbers, account_filter)
+    results = merge_results_by_time(run_fetch_tasks(tasks))
 
     print("Completed get_cost_data.")
-    print("\n[DEBUG] get_cost_data() return value:")
-    print(results)
+    debug_dump("get_cost_data() return value", results)
 
     return results
 
+def account_filter(chunk):
+    return {'Dimensions': {'Key': 'LINKED_ACCOUNT', 'Values': chunk}}
+
+def iter_cost_data(account_numbers, deadline=None):
+    """
+    Streaming version of get_cost_data: yields ResultsByTime entries page by
+    page as they arrive (a period may repeat, once per page), for a single
+    pass consumer such as CostCube.add_results or restructure_cost_data.
+    Raises BudgetExceeded past deadline (see iter_fetch_pages).
+    """
+    tasks = plan_service_queries(account_numbers, account_filter, iter_cost_and_usage_cached)
+    for _, page in iter_fetch_pages(tasks, deadline):
+        yield from page
+
 # -----------------------------------------------------------------------------
 # 8) NEW: GET TAGGED COST DATA
 # -----------------------------------------------------------------------------
@@ -348,81 +2013,697 @@ def get_tagged_cost_data(account_numbers, tag_key, tag_value):
     with tag_key=tag_value. Grouped by (LINKED_ACCOUNT, SERVICE).
     """
     print(f"get_tagged_cost_data called for tag {tag_key}={tag_value}")
-    results = []
-    token = None
 
-    combined_filter = {
-        "And": [
-            {"Dimensions": {"Key": "LINKED_ACCOUNT", "Values": account_numbers}},
-            {"Tags": {"Key": tag_key, "Values": [tag_value]}}
-        ]
-    }
-
-    while True:
-        kwargs = {'NextPageToken': token} if token else {}
-        data = cost_explorer.get_cost_and_usage(
-            TimePeriod={'Start': MONTHLY_START_DATE, 'End': MONTHLY_END_DATE},
-            Granularity='MONTHLY',
-            Metrics=['UnblendedCost'],
-            GroupBy=[
-                {'Type': 'DIMENSION', 'Key': 'LINKED_ACCOUNT'},
-                {'Type': 'DIMENSION', 'Key': 'SERVICE'}
-            ],
-            Filter=combined_filter,
-            **kwargs
-        )
-        results += data['ResultsByTime']
-        token = data.get('NextPageToken')
-        if not token:
-            break
+    tasks = plan_service_queries(account_numbers, tagged_account_filter(tag_key, tag_value))
+    results = merge_results_by_time(run_fetch_tasks(tasks))
 
     print("Completed get_tagged_cost_data.")
-    print("\n[DEBUG] get_tagged_cost_data() return value:")
-    print(results)
+    debug_dump("get_tagged_cost_data() return value", results)
 
     return results
 
+def tagged_account_filter(tag_key, tag_value):
+    """Returns a query_filter for plan_service_queries restricted to tag_key=tag_value."""
+    def combined_filter(chunk):
+        return {
+            "And": [
+                {"Dimensions": {"Key": "LINKED_ACCOUNT", "Values": chunk}},
+                {"Tags": {"Key": tag_key, "Values": [tag_value]}}
+            ]
+        }
+    return combined_filter
+
+def iter_tagged_cost_data(account_numbers, tag_key, tag_value, deadline=None):
+    """Streaming version of get_tagged_cost_data (see iter_cost_data)."""
+    tasks = plan_service_queries(account_numbers, tagged_account_filter(tag_key, tag_value), iter_cost_and_usage_cached)
+    for _, page in iter_fetch_pages(tasks, deadline):
+        yield from page
+
+def get_team_cost_data(account_numbers, tag_key, deadline=None):
+    """
+    Fetches the per-service cost of every tag value in one pass: a single
+    GroupBy (TAG:tag_key, SERVICE) query per account, whatever the number of
+    teams. The groups are streamed page by page straight into cost cubes
+    and returned as
+    (overall_cube, team_cubes):
+      - overall_cube: per-service cost summed over all tag values, including
+        untagged resources (what get_cost_data returns)
+      - team_cubes: { tag_value: cube of that value's per-service cost }
+    Raises BudgetExceeded past deadline (see iter_fetch_pages).
+    """
+    print(f"get_team_cost_data called for tag key {tag_key}")
+
+    tasks = []
+    for chunk in plan_account_queries(account_numbers, chunk_size=1):
+        for window in plan_time_windows():
+            tasks.append((iter_cost_and_usage_cached, ({
+                'TimePeriod': window,
+                'Granularity': CE_GRANULARITY,
+                'Metrics': CE_METRICS,
+                'GroupBy': [
+                    {'Type': 'TAG', 'Key': tag_key},
+                    {'Type': 'DIMENSION', 'Key': 'SERVICE'}
+                ],
+                'Filter': {'Dimensions': {'Key': 'LINKED_ACCOUNT', 'Values': chunk}}
+            },)))
+    task_accounts = [args[0]['Filter']['Dimensions']['Values'][0] for fn, args in tasks]
+
+    overall_cube = CostCube(cube_periods(), CE_METRICS)
+    team_cubes = {}
+    # Pages are folded into the cubes as they arrive from any task
+    for index, page in iter_fetch_pages(tasks, deadline):
+        acct_id = task_accounts[index]
+        for time_period in page:
+            start_str = time_period['TimePeriod']['Start']
+            for group in time_period.get('Groups', []):
+                # Tag group keys come back as "<key>$<value>"; untagged is "<key>$"
+                tag_value = group['Keys'][0].split('$', 1)[-1]
+                service = group['Keys'][1]
+
+                overall_cube.add_metrics(acct_id, service, start_str, group['Metrics'])
+                if tag_value:
+                    if tag_value not in team_cubes:
+                        team_cubes[tag_value] = CostCube(cube_periods(), CE_METRICS)
+                    team_cubes[tag_value].add_metrics(acct_id, service, start_str, group['Metrics'])
+
+    team_cubes = {tag_value: team_cubes[tag_value] for tag_value in sorted(team_cubes)}
+    print(f"Completed get_team_cost_data. Tag values found: {list(team_cubes.keys())}")
+
+    return overall_cube, team_cubes
+
+# -----------------------------------------------------------------------------
+# 8b) LAZY DRILL-DOWN (PER-SERVICE DETAIL ONLY FOR ACCOUNTS THAT MOVED)
+# -----------------------------------------------------------------------------
+
+# With DRILL_DOWN, the summary query runs first and the grouped per-service
+# (and team) queries only cover accounts whose latest period moved by at
+# least DRILL_DOWN_PCT_THRESHOLD (a fraction) or DRILL_DOWN_ABS_THRESHOLD
+# (in the report metric's unit) against the DELTA_COMPARISON period.
+DRILL_DOWN = os.environ.get('DRILL_DOWN', 'false').lower() == 'true'
+DRILL_DOWN_PCT_THRESHOLD = float(os.environ.get('DRILL_DOWN_PCT_THRESHOLD', '0.1'))
+DRILL_DOWN_ABS_THRESHOLD = float(os.environ.get('DRILL_DOWN_ABS_THRESHOLD', '100'))
+# Also fetch a (SERVICE, USAGE_TYPE) breakdown for the accounts that moved
+DRILL_DOWN_USAGE_TYPES = os.environ.get('DRILL_DOWN_USAGE_TYPES', 'false').lower() == 'true'
+
+def moved_accounts(reportCostDict_input, pct_threshold=None, abs_threshold=None):
+    """
+    Returns the real accounts (not the 'monthTotal' / 'Others' rows) of a
+    process_costchanges_per_month dict whose latest period changed by at
+    least pct_threshold or abs_threshold (defaults:
+    DRILL_DOWN_PCT_THRESHOLD / DRILL_DOWN_ABS_THRESHOLD). Accounts without
+    a percent delta (new, or zero before) count by their absolute change.
+    """
+    pct_threshold = DRILL_DOWN_PCT_THRESHOLD if pct_threshold is None else pct_threshold
+    abs_threshold = DRILL_DOWN_ABS_THRESHOLD if abs_threshold is None else abs_threshold
+
+    summary_cube = CostCube.from_monthly_dict(reportCostDict_input)
+    if not summary_cube.periods:
+        return []
+    deltas = CostDeltas(summary_cube, DELTA_OFFSETS[DELTA_COMPARISON])
+    latest = max(summary_cube.periods)
+
+    moved = []
+    for acct_id in summary_cube.accounts:
+        if acct_id in ('monthTotal', 'Others'):
+            continue
+        pct = deltas.percent(acct_id, 'Total', latest)
+        absolute = deltas.absolute(acct_id, 'Total', latest) or 0.0
+        if (pct is not None and abs(pct) >= pct_threshold) or abs(absolute) >= abs_threshold:
+            moved.append(acct_id)
+    return moved
+
+def get_usage_type_cost_data(account_numbers, deadline=None):
+    """
+    Fetches a (SERVICE, USAGE_TYPE) breakdown with one query per account and
+    sub-window (Cost Explorer allows two GroupBy keys, so the account goes
+    in the filter). Returns a cost cube whose services are
+    "<service> / <usage type>". Raises BudgetExceeded past deadline.
+    """
+    print(f"get_usage_type_cost_data called for {len(account_numbers)} accounts")
+
+    tasks = []
+    for chunk in plan_account_queries(account_numbers, chunk_size=1):
+        for window in plan_time_windows():
+            tasks.append((iter_cost_and_usage_cached, ({
+                'TimePeriod': window,
+                'Granularity': CE_GRANULARITY,
+                'Metrics': CE_METRICS,
+                'GroupBy': [
+                    {'Type': 'DIMENSION', 'Key': 'SERVICE'},
+                    {'Type': 'DIMENSION', 'Key': 'USAGE_TYPE'}
+                ],
+                'Filter': account_filter(chunk)
+            },)))
+    task_accounts = [args[0]['Filter']['Dimensions']['Values'][0] for fn, args in tasks]
+
+    usage_cube = CostCube(cube_periods(), CE_METRICS)
+    for index, page in iter_fetch_pages(tasks, deadline):
+        acct_id = task_accounts[index]
+        for time_period in page:
+            start_str = time_period['TimePeriod']['Start']
+            for group in time_period.get('Groups', []):
+                service, usage_type = group['Keys']
+                usage_cube.add_metrics(acct_id, f"{service} / {usage_type}", start_str, group['Metrics'])
+
+    print("Completed get_usage_type_cost_data.")
+    return usage_cube
+
 # -----------------------------------------------------------------------------
 # 9) RESTRUCTURE COST DATA FOR PER-SERVICE
 # -----------------------------------------------------------------------------
 
 def restructure_cost_data(cost_data_dict, account_numbers):
+    """
+    cost_data_dict may be any iterable of ResultsByTime entries, including
+    the page stream from iter_cost_data; it is read in a single pass.
+    Service names and dates are interned, so every account shares one copy
+    of each string, and services are ordered by one global sort.
+    """
     print("restructure_cost_data called.")
-    display_cost_data_dict = {}
+    display_cost_data_dict = {acct: {} for acct in account_numbers}
+    all_services = {}
 
-    for acct in account_numbers:
-        display_cost_data_dict[acct] = {}
-
-    # Collect all service names
-    for time_period in cost_data_dict:
-        for group in time_period['Groups']:
-            acct_no = group['Keys'][0]
-            service_name = group['Keys'][1]
-            if acct_no in display_cost_data_dict:
-                display_cost_data_dict[acct_no][service_name] = {}
-
-    # Fill in the costs by month
+    # Collect service names and fill in the costs by month
     for time_period in cost_data_dict:
-        date = time_period['TimePeriod']['Start']
+        date = sys.intern(time_period['TimePeriod']['Start'])
         for group in time_period['Groups']:
-            acct_no = group['Keys'][0]
-            service_name = group['Keys'][1]
-            amount = float(group['Metrics']['UnblendedCost']['Amount'])
-            if acct_no in display_cost_data_dict and service_name in display_cost_data_dict[acct_no]:
-                display_cost_data_dict[acct_no][service_name][date] = amount
-
-    # Sort service names
+            keys = group['Keys']
+            services = display_cost_data_dict.get(keys[0])
+            if services is None:
+                continue
+            service_name = all_services.get(keys[1])
+            if service_name is None:
+                service_name = all_services[keys[1]] = sys.intern(keys[1])
+            monthly_data = services.get(service_name)
+            if monthly_data is None:
+                monthly_data = services[service_name] = {}
+            monthly_data[date] = float(group['Metrics'][REPORT_METRIC]['Amount'])
+
+    # Sort service names once; each account takes its services in that order
+    service_order = sorted(all_services)
     sorted_dict = {}
     for acct_no, services in display_cost_data_dict.items():
-        sorted_services = dict(sorted(services.items()))
-        sorted_dict[acct_no] = sorted_services
+        sorted_dict[acct_no] = {svc: services[svc] for svc in service_order if svc in services}
 
     print("Completed restructure_cost_data.")
-    print("\n[DEBUG] restructure_cost_data() return value:")
-    print(sorted_dict)
+    debug_dump("restructure_cost_data() return value", sorted_dict)
 
     return sorted_dict
 
+# -----------------------------------------------------------------------------
+# 9b) COLUMNAR COST CUBE
+# -----------------------------------------------------------------------------
+
+NAN_ROW = array('d', [nan])
+
+def sum_present(values):
+    """Sums the non-NaN values; NaN if there are none."""
+    total = nan
+    for v in values:
+        if v == v:
+            total = v if total != total else total + v
+    return total
+
+class CostCube:
+    """
+    Dense account x service x period cost store. The string axes are
+    dictionary-encoded (value list + index dict) and the costs live in one
+    flat array('d') per account, laid out [service][period], so a cell costs
+    8 bytes instead of a {'Cost': float} dict. 1,000 accounts x 250 services
+    x 36 months is about 72 MB of array data.
+
+    Cells that were never written hold NaN, which lets the views tell a
+    missing group from a real zero, exactly as the dict structures do.
+
+    A cube holds one metric. Built with several metrics, the extra ones are
+    planes: sibling cubes in self.planes that share the axes (and Estimated
+    flags) and only own their blocks. The cube itself is the plane of the
+    first metric, so code that knows nothing about metrics keeps working.
+    """
+    def __init__(self, periods=(), metrics=None):
+        metrics = list(metrics or ['UnblendedCost'])
+        self.metric = metrics[0]
+        self.periods = []
+        self.period_index = {}
+        self.accounts = []
+        self.account_index = {}
+        self.services = []
+        self.service_index = {}
+        self.blocks = []        # one array per account, index = service * len(periods) + period
+        self.estimated = []     # per-period Estimated flag
+        self.planes = {self.metric: self}
+        for metric in metrics[1:]:
+            plane = CostCube.__new__(CostCube)
+            plane.__dict__.update(self.__dict__)
+            plane.metric = metric
+            plane.blocks = []
+            self.planes[metric] = plane
+        for period in periods:
+            self.period_id(period)
+
+    def plane(self, metric):
+        """The cube of another metric fetched alongside this one."""
+        return self.planes[metric]
+
+    def period_id(self, period):
+        if period not in self.period_index:
+            old_stride = len(self.periods)
+            self.period_index[period] = old_stride
+            self.periods.append(period)
+            self.estimated.append(False)
+            # Re-lay every block of every plane out with the wider period stride
+            for plane in self.planes.values():
+                for a, block in enumerate(plane.blocks):
+                    widened = array('d')
+                    for s in range(len(block) // old_stride if old_stride else 0):
+                        widened.extend(block[s * old_stride:(s + 1) * old_stride])
+                        widened.append(nan)
+                    plane.blocks[a] = widened
+        return self.period_index[period]
+
+    def account_id(self, acct_id):
+        if acct_id not in self.account_index:
+            self.account_index[acct_id] = len(self.accounts)
+            self.accounts.append(acct_id)
+            for plane in self.planes.values():
+                plane.blocks.append(array('d'))
+        return self.account_index[acct_id]
+
+    def service_id(self, service):
+        if service not in self.service_index:
+            self.service_index[service] = len(self.services)
+            self.services.append(service)
+        return self.service_index[service]
+
+    def _block(self, a, s):
+        # Blocks grow lazily: an account only allocates up to the highest
+        # service it (or a view) has touched.
+        block = self.blocks[a]
+        needed = (s + 1) * len(self.periods)
+        if len(block) < needed:
+            block.extend(NAN_ROW * (needed - len(block)))
+        return block
+
+    def add(self, acct_id, service, period, amount):
+        """Adds amount to a cell (a NaN cell starts from zero)."""
+        self._add_cell(self.account_id(acct_id), self.service_id(service), self.period_id(period), amount)
+
+    def _add_cell(self, a, s, p, amount):
+        block = self._block(a, s)
+        i = s * len(self.periods) + p
+        current = block[i]
+        block[i] = amount if current != current else current + amount
+
+    def add_metrics(self, acct_id, service, period, metrics):
+        """
+        Adds a Cost Explorer Metrics dict ({metric: {'Amount': ...}}) to the
+        cell of every plane; metrics missing from the dict are skipped.
+        """
+        p = self.period_id(period)
+        a = self.account_id(acct_id)
+        s = self.service_id(service)
+        for metric, plane in self.planes.items():
+            value = metrics.get(metric)
+            if value is not None:
+                plane._add_cell(a, s, p, float(value['Amount']))
+
+    def get(self, acct_id, service, period):
+        """Returns the cell value, or None if it was never written."""
+        a = self.account_index.get(acct_id)
+        s = self.service_index.get(service)
+        p = self.period_index.get(period)
+        if a is None or s is None or p is None:
+            return None
+        block = self.blocks[a]
+        i = s * len(self.periods) + p
+        if i >= len(block) or block[i] != block[i]:
+            return None
+        return block[i]
+
+    def row(self, acct_id, service):
+        """Returns the period vector (with NaN for missing cells) for one account and service."""
+        a = self.account_index.get(acct_id)
+        s = self.service_index.get(service)
+        stride = len(self.periods)
+        if a is None or s is None or len(self.blocks[a]) < (s + 1) * stride:
+            return array('d', NAN_ROW * stride)
+        return self.blocks[a][s * stride:(s + 1) * stride]
+
+    def add_results(self, results_by_time, account=None, service=None):
+        """
+        Populates the cube from ResultsByTime entries in one pass. Grouped
+        entries are read as [LINKED_ACCOUNT, SERVICE] keys; ungrouped ones
+        (a single-account Total) are stored under `account` / `service`.
+        results_by_time may be a page stream such as iter_cost_data(). Every
+        plane is filled from the same pass.
+        """
+        for time_period in results_by_time:
+            start_str = time_period['TimePeriod']['Start']
+            p = self.period_id(start_str)
+            if time_period.get('Estimated', False):
+                self.estimated[p] = True
+            groups = time_period.get('Groups')
+            if groups:
+                for group in groups:
+                    self.add_metrics(group['Keys'][0], group['Keys'][1], start_str, group['Metrics'])
+            elif account is not None and self.metric in time_period.get('Total', {}):
+                self.add_metrics(account, service, start_str, time_period['Total'])
+        return self
+
+    def rollup(self, bucket, periods=()):
+        """
+        Returns a new cube whose periods are bucket(period) of this cube's
+        periods (e.g. days to months), with the cells that fall into the same
+        bucket summed, for every plane. Each account block is rolled up a
+        whole period column (every service) at a time through strided slices.
+        periods seeds the target periods, so empty buckets still appear.
+        """
+        metrics = [self.metric] + [m for m in self.planes if m != self.metric]
+        target = CostCube(periods, metrics)
+        sources = {}
+        for p, period in enumerate(self.periods):
+            q = target.period_id(bucket(period))
+            sources.setdefault(q, []).append(p)
+            if self.estimated[p]:
+                target.estimated[q] = True
+        # The axis objects are shared with the target's planes: fill them in place
+        target.services.extend(self.services)
+        target.service_index.update(self.service_index)
+
+        stride = len(self.periods)
+        target_stride = len(target.periods)
+        for a, acct_id in enumerate(self.accounts):
+            target.account_id(acct_id)
+            for metric in metrics:
+                block = self.planes[metric].blocks[a]
+                rows = len(block) // stride if stride else 0
+                rolled = array('d', NAN_ROW * (rows * target_stride))
+                for q, source_periods in sources.items():
+                    if len(source_periods) == 1:
+                        rolled[q::target_stride] = block[source_periods[0]::stride]
+                    else:
+                        columns = [block[p::stride] for p in source_periods]
+                        rolled[q::target_stride] = array('d', map(sum_present, zip(*columns)))
+                target.planes[metric].blocks[-1] = rolled
+        return target
+
+    @classmethod
+    def from_service_dict(cls, service_dict, acct_id):
+        """Builds a one-account cube from a { service : { date : amount } } dict."""
+        cube = cls()
+        for service, monthly_data in service_dict.items():
+            for date_str, amount in monthly_data.items():
+                cube.add(acct_id, service, date_str, amount)
+        return cube
+
+    @classmethod
+    def from_monthly_dict(cls, monthly_dict, service='Total'):
+        """Builds a cube from a { date : { account_id : {'Cost': ...} } } dict."""
+        cube = cls(sorted(monthly_dict))
+        for date_str, accounts in monthly_dict.items():
+            for acct_id, cost_obj in accounts.items():
+                cube.add(acct_id, service, date_str, cost_obj['Cost'])
+        return cube
+
+    def account_services(self, acct_id):
+        """Services with at least one written cell for the account."""
+        a = self.account_index.get(acct_id)
+        if a is None:
+            return []
+        block = self.blocks[a]
+        stride = len(self.periods)
+        return [
+            self.services[s] for s in range(len(block) // stride)
+            if any(v == v for v in block[s * stride:(s + 1) * stride])
+        ]
+
+    def merge(self, other):
+        """
+        Adds every written cell of other into this cube, plane by plane
+        (metrics this cube does not hold are ignored). Used to combine the
+        partial cubes of sharded runs.
+        """
+        for p, period in enumerate(other.periods):
+            if other.estimated[p]:
+                self.estimated[self.period_id(period)] = True
+        period_map = [self.period_id(period) for period in other.periods]
+        service_map = [self.service_id(service) for service in other.services]
+        stride = len(other.periods)
+        for b, acct_id in enumerate(other.accounts):
+            a = self.account_id(acct_id)
+            for metric, plane in self.planes.items():
+                source = other.planes.get(metric)
+                if source is None:
+                    continue
+                for i, value in enumerate(source.blocks[b]):
+                    if value == value:
+                        plane._add_cell(a, service_map[i // stride], period_map[i % stride], value)
+        return self
+
+    def to_partial(self):
+        """JSON-ready copy of the cube (NaN cells as None), read back by from_partial."""
+        return {
+            'metrics': list(self.planes),
+            'periods': self.periods,
+            'estimated': self.estimated,
+            'accounts': self.accounts,
+            'services': self.services,
+            'blocks': {
+                metric: [[None if v != v else v for v in block] for block in plane.blocks]
+                for metric, plane in self.planes.items()
+            }
+        }
+
+    @classmethod
+    def from_partial(cls, partial):
+        cube = cls(partial['periods'], partial['metrics'])
+        # The axes are shared with the planes: fill them in place
+        cube.estimated[:] = partial['estimated']
+        cube.services.extend(partial['services'])
+        cube.service_index.update((service, s) for s, service in enumerate(partial['services']))
+        cube.accounts.extend(partial['accounts'])
+        cube.account_index.update((acct_id, a) for a, acct_id in enumerate(partial['accounts']))
+        for metric, plane in cube.planes.items():
+            plane.blocks = [array('d', [nan if v is None else v for v in block])
+                            for block in partial['blocks'][metric]]
+        return cube
+
+    def nbytes(self):
+        """Bytes held by the cost arrays of every plane."""
+        return sum(block.itemsize * len(block) for plane in self.planes.values() for block in plane.blocks)
+
+    def to_service_dict(self, account_numbers):
+        """
+        View in the restructure_cost_data shape:
+          { account_number : { service_name : { date : amount, ... }, ... }, ... }
+        with services sorted by name.
+        """
+        period_order = sorted(range(len(self.periods)), key=lambda p: self.periods[p])
+        service_order = sorted(range(len(self.services)), key=lambda s: self.services[s])
+        stride = len(self.periods)
+
+        view = {}
+        for acct_id in account_numbers:
+            view[acct_id] = {}
+            a = self.account_index.get(acct_id)
+            if a is None:
+                continue
+            block = self.blocks[a]
+            for s in service_order:
+                base = s * stride
+                if base >= len(block):
+                    continue
+                cells = {
+                    self.periods[p]: block[base + p]
+                    for p in period_order if block[base + p] == block[base + p]
+                }
+                if cells:
+                    view[acct_id][self.services[s]] = cells
+        return view
+
+    def to_monthly_dict(self, periods=()):
+        """
+        View in the process_costchanges_per_month shape, with services summed
+        per account:
+          { date : { account_id : {'Cost', 'Estimated'}, ..., 'monthTotal': {...} } }
+        periods lists dates that must appear even if they hold no data.
+        """
+        stride = len(self.periods)
+        view = {period: {} for period in periods}
+        for p in sorted(range(stride), key=lambda p: self.periods[p]):
+            month = view.setdefault(self.periods[p], {})
+            for a, acct_id in enumerate(self.accounts):
+                block = self.blocks[a]
+                values = [block[i] for i in range(p, len(block), stride) if block[i] == block[i]]
+                if values:
+                    month[acct_id] = {'Cost': sum(values), 'Estimated': self.estimated[p]}
+
+        for date_str, month in view.items():
+            p = self.period_index.get(date_str)
+            month['monthTotal'] = {
+                'Cost': sum(cost_obj['Cost'] for cost_obj in month.values()),
+                'Estimated': self.estimated[p] if p is not None else False
+            }
+        return view
+
+# Report periods when CE_GRANULARITY is DAILY or HOURLY: MONTHLY (the usual
+# report) or WEEKLY (weeks starting Monday, the first clipped to the window)
+REPORT_ROLLUP = os.environ.get('REPORT_ROLLUP', 'MONTHLY').upper()
+
+def month_bucket(period):
+    """'2024-03-17' or '2024-03-17T05:00:00Z' -> '2024-03-01'."""
+    return period[:8] + '01'
+
+def week_bucket(period):
+    """Start date of the (Monday-based) week holding period, not before the window start."""
+    day = datetime.strptime(period[:10], '%Y-%m-%d')
+    monday = (day - timedelta(days=day.weekday())).strftime('%Y-%m-%d')
+    return max(monday, MONTHLY_START_DATE)
+
+def cube_periods():
+    """
+    Periods the cost cubes are built with: MONTHLY_COST_DATES, or every day
+    (hour) of the report window for DAILY (HOURLY) queries. Laying the
+    whole axis out up front spares CostCube.period_id from re-laying every
+    block each time a new period arrives.
+    """
+    if CE_GRANULARITY == 'MONTHLY':
+        return MONTHLY_COST_DATES
+    step, fmt = ((timedelta(hours=1), '%Y-%m-%dT%H:%M:%SZ') if CE_GRANULARITY == 'HOURLY'
+                 else (timedelta(days=1), '%Y-%m-%d'))
+    periods = []
+    moment = datetime.strptime(MONTHLY_START_DATE, '%Y-%m-%d')
+    end = datetime.strptime(MONTHLY_END_DATE, '%Y-%m-%d')
+    while moment < end:
+        periods.append(moment.strftime(fmt))
+        moment += step
+    return periods
+
+def report_periods():
+    """Periods the report shows: MONTHLY_COST_DATES, or the week starts for a WEEKLY roll-up."""
+    if CE_GRANULARITY == 'MONTHLY' or REPORT_ROLLUP != 'WEEKLY':
+        return MONTHLY_COST_DATES
+    weeks = []
+    day = datetime.strptime(MONTHLY_START_DATE, '%Y-%m-%d')
+    end = datetime.strptime(MONTHLY_END_DATE, '%Y-%m-%d')
+    while day < end:
+        week = week_bucket(day.strftime('%Y-%m-%d'))
+        if not weeks or weeks[-1] != week:
+            weeks.append(week)
+        day += timedelta(days=1)
+    return weeks
+
+def rollup_for_report(cube):
+    """Rolls a DAILY / HOURLY cube up to report_periods(); MONTHLY cubes are returned as is."""
+    if CE_GRANULARITY == 'MONTHLY':
+        return cube
+    bucket = week_bucket if REPORT_ROLLUP == 'WEEKLY' else month_bucket
+    return cube.rollup(bucket, report_periods())
+
+# -----------------------------------------------------------------------------
+# 9c) DELTA ENGINE (MoM / QoQ / YoY OVER THE COST CUBE)
+# -----------------------------------------------------------------------------
+
+# Comparison offsets, in periods, for the deltas shown in the report
+DELTA_OFFSETS = {'MoM': 1, 'QoQ': 3, 'YoY': 12}
+DELTA_COMPARISON = os.environ.get('DELTA_COMPARISON', 'MoM')
+
+class CostDeltas:
+    """
+    Percent and absolute change of every cell of a cost cube against the
+    period `offset` steps earlier (periods taken in date order). Computed once
+    per cube, a whole plane at a time: for each (period, earlier period) pair
+    the two strided slices of an account block, one value per service, are
+    combined in a single pass. Missing cells count as zero; percent deltas are
+    None when either side is zero or there is no earlier period.
+    """
+    def __init__(self, cube, offset=1):
+        self.cube = cube
+        self.offset = offset
+        stride = len(cube.periods)
+        order = sorted(range(stride), key=lambda p: cube.periods[p])
+        self.previous = {order[k]: order[k - offset] for k in range(offset, stride)}
+
+        self.percent_blocks = []
+        self.absolute_blocks = []
+        for block in cube.blocks:
+            pct = array('d', NAN_ROW * len(block))
+            absolute = array('d', NAN_ROW * len(block))
+            for p, q in self.previous.items():
+                curr = [0.0 if v != v else v for v in block[p::stride]]
+                prev = [0.0 if v != v else v for v in block[q::stride]]
+                absolute[p::stride] = array('d', [c - b for c, b in zip(curr, prev)])
+                pct[p::stride] = array('d', [
+                    (c / b) - 1 if b != 0 and c != 0 else nan
+                    for c, b in zip(curr, prev)
+                ])
+            self.percent_blocks.append(pct)
+            self.absolute_blocks.append(absolute)
+
+    def _index(self, acct_id, service, period):
+        a = self.cube.account_index.get(acct_id)
+        s = self.cube.service_index.get(service)
+        p = self.cube.period_index.get(period)
+        if a is None or s is None or p is None:
+            return None, None
+        return a, s * len(self.cube.periods) + p
+
+    def previous_period(self, period):
+        """Returns the period `period` is compared against, or None."""
+        q = self.previous.get(self.cube.period_index.get(period))
+        return None if q is None else self.cube.periods[q]
+
+    def percent(self, acct_id, service, period, positive_only=False):
+        """
+        Percent delta as a fraction, or None. With positive_only, a
+        non-positive cost on either side (credits, refunds) also gives None.
+        """
+        a, i = self._index(acct_id, service, period)
+        if a is None or i >= len(self.percent_blocks[a]):
+            return None
+        value = self.percent_blocks[a][i]
+        if value != value:
+            return None
+        if positive_only:
+            block = self.cube.blocks[a]
+            p = self.cube.period_index[period]
+            j = i - p + self.previous[p]
+            if not (block[i] > 0 and block[j] > 0):
+                return None
+        return value
+
+    def absolute(self, acct_id, service, period):
+        """Absolute delta; 0.0 for an account/service not in the cube, None without an earlier period."""
+        if self.previous_period(period) is None:
+            return None
+        a, i = self._index(acct_id, service, period)
+        if a is None or i >= len(self.absolute_blocks[a]):
+            return 0.0
+        return self.absolute_blocks[a][i]
+
+# -----------------------------------------------------------------------------
+# 9d) TOP-N SERVICES PER ACCOUNT
+# -----------------------------------------------------------------------------
+
+# Services shown per account in the team and breakdown tables (0 = all). The
+# rest are folded into one "Other services" row, the way the summary folds
+# accounts outside displayListMonthly into 'Others'.
+TOP_SERVICES = int(os.environ.get('TOP_SERVICES', '0'))
+# Ranking of the shown services: cost (latest period), abs_delta or pct_delta
+TOP_SERVICES_BY = os.environ.get('TOP_SERVICES_BY', 'cost')
+OTHER_SERVICES_LABEL = 'Other services'
+
+def select_top_services(scores, k):
+    """
+    scores: { service: score }. Returns (top, rest): the k services with the
+    highest scores (by heap selection, O(n log k)) and the set of all others.
+    With k <= 0 or at most k services everything is in top.
+    """
+    if k <= 0 or len(scores) <= k:
+        return list(scores), set()
+    top = heapq.nlargest(k, scores, key=scores.__getitem__)
+    return top, set(scores).difference(top)
+
 # -----------------------------------------------------------------------------
 # 10) MERGE TEAM + OVERALL, THEN GENERATE A SINGLE 5-COLUMN TABLE
 # -----------------------------------------------------------------------------
@@ -432,7 +2713,7 @@ def merge_team_data(overall_dict, team_dict):
     overall_dict and team_dict have structure:
       { service_name: { "2024-11-01": cost, "2024-12-01": cost } }
 
-    We'll assume exactly 2 months. We'll produce a dictionary:
+    Compares the latest month with the one before it. We'll produce a dictionary:
       { service_name: {
           "overallCurr": <float>,
           "overallDeltaPct": <float or None>,
@@ -441,53 +2722,95 @@ def merge_team_data(overall_dict, team_dict):
         }
       }
     """
-    all_services = set(overall_dict.keys()).union(team_dict.keys())
-    all_dates = set()
-    for svc in overall_dict:
-        all_dates.update(overall_dict[svc].keys())
-    for svc in team_dict:
-        all_dates.update(team_dict[svc].keys())
+    overall_cube = CostCube.from_service_dict(overall_dict, 'account')
+    team_cube = CostCube.from_service_dict(team_dict, 'account')
+    for period in overall_cube.periods + team_cube.periods:
+        overall_cube.period_id(period)
+        team_cube.period_id(period)
 
-    sorted_months = sorted(all_dates)
-    if len(sorted_months) < 2:
+    return merge_team_deltas('account', overall_cube, team_cube,
+                             CostDeltas(overall_cube), CostDeltas(team_cube))
+
+def merge_team_deltas(acct_id, overall_cube, team_cube, overall_deltas, team_deltas):
+    """
+    Builds merge_team_data's per-service dict for one account from the cost
+    cubes and their precomputed deltas, so the overall deltas are computed
+    once per run rather than once per team and account. The latest period is
+    compared with the one the deltas were computed against.
+    """
+    sorted_months = sorted(overall_cube.periods)
+    prev_m = overall_deltas.previous_period(sorted_months[-1]) if sorted_months else None
+    if prev_m is None:
         print("WARNING: Not enough months to compute deltas!")
         return {}
+    curr_m = sorted_months[-1]
 
-    prev_m = sorted_months[0]
-    curr_m = sorted_months[1]
+    all_services = set(overall_cube.account_services(acct_id)).union(team_cube.account_services(acct_id))
 
     final_info = {}
     for svc in all_services:
-        # overall cost
-        prev_overall = overall_dict.get(svc, {}).get(prev_m, 0.0)
-        curr_overall = overall_dict.get(svc, {}).get(curr_m, 0.0)
-
-        if prev_overall > 0 and curr_overall > 0:
-            overall_delta = (curr_overall / prev_overall) - 1
-        else:
-            overall_delta = None
-
-        # team cost
-        prev_team = team_dict.get(svc, {}).get(prev_m, 0.0)
-        curr_team = team_dict.get(svc, {}).get(curr_m, 0.0)
-
-        team_delta_dollar = curr_team - prev_team
-        if prev_team > 0 and curr_team > 0:
-            team_delta_pct = (curr_team / prev_team) - 1
-        else:
-            team_delta_pct = None
+        curr_overall = overall_cube.get(acct_id, svc, curr_m) or 0.0
 
         final_info[svc] = {
             "overallCurr": curr_overall,
-            "overallDeltaPct": overall_delta,
-            "teamDeltaPct": team_delta_pct,
-            "teamDeltaDollar": team_delta_dollar
+            "overallDeltaPct": overall_deltas.percent(acct_id, svc, curr_m, positive_only=True),
+            "teamDeltaPct": team_deltas.percent(acct_id, svc, curr_m, positive_only=True),
+            "teamDeltaDollar": team_deltas.absolute(acct_id, svc, curr_m)
         }
 
     return final_info
 
 
-def generate_html_table_with_team(final_info, acct_no):
+def team_service_scores(final_info, rank_by):
+    """Scores every row of final_info for select_top_services."""
+    if rank_by == 'abs_delta':
+        return {svc: abs(row["teamDeltaDollar"] or 0.0) for svc, row in final_info.items()}
+    if rank_by == 'pct_delta':
+        return {svc: abs(row["teamDeltaPct"] if row["teamDeltaPct"] is not None else row["overallDeltaPct"] or 0.0)
+                for svc, row in final_info.items()}
+    return {svc: row["overallCurr"] for svc, row in final_info.items()}
+
+def iter_html_table_with_team(final_info, acct_no, team_name=None, metric=None, top_n=None, rank_by=None):
+    """
+    Yields the team vs. overall table for one account as HTML fragments.
+    metric (default REPORT_METRIC) only picks the value format. Only the
+    top_n services (default TOP_SERVICES) ranked by rank_by (default
+    TOP_SERVICES_BY) get a row; the rest are summed into a last
+    "Other services" row, which has no Δ% since the rows only carry the
+    latest period.
+    """
+    cell = value_cell(metric)
+    top, rest = select_top_services(
+        team_service_scores(final_info, rank_by or TOP_SERVICES_BY),
+        TOP_SERVICES if top_n is None else top_n
+    )
+    yield TEAM_HEADING(f"Team {team_name}" if team_name else "Team", acct_no)
+
+    for svc in sorted(top):
+        row = final_info[svc]
+        overall_delta_pct = row["overallDeltaPct"]
+        team_delta_pct = row["teamDeltaPct"]
+
+        yield TEAM_SERVICE_CELL(svc)
+        yield cell(row["overallCurr"])
+        # Overall Δ% / Team Δ%
+        yield EMPTY_CELL if overall_delta_pct is None else TEAM_DELTA_CELL(change_span_html(overall_delta_pct))
+        yield EMPTY_CELL if team_delta_pct is None else TEAM_DELTA_CELL(change_span_html(team_delta_pct))
+        # Team Δ$
+        yield cell(row["teamDeltaDollar"])
+        yield "</tr>"
+
+    if rest:
+        yield TEAM_SERVICE_CELL(f"{OTHER_SERVICES_LABEL} ({len(rest)})")
+        yield cell(sum(final_info[svc]["overallCurr"] for svc in rest))
+        yield EMPTY_CELL
+        yield EMPTY_CELL
+        yield cell(sum(final_info[svc]["teamDeltaDollar"] or 0.0 for svc in rest))
+        yield "</tr>"
+
+    yield "</table>"
+
+def generate_html_table_with_team(final_info, acct_no, team_name=None, top_n=None, rank_by=None):
     """
     final_info: { service_name: {
         "overallCurr": float,
@@ -497,6 +2820,10 @@ def generate_html_table_with_team(final_info, acct_no):
       }
     }
 
+    team_name, if given, is shown in the table heading. Only the top_n
+    services by rank_by ('cost', 'abs_delta' or 'pct_delta') are listed;
+    see iter_html_table_with_team.
+
     Creates a 5-column table:
     - Service Name
     - Overall Cost
@@ -504,66 +2831,114 @@ def generate_html_table_with_team(final_info, acct_no):
     - Team Δ%
     - Team Δ$
     """
-    def evaluate_change(value):
-        if value is None:
-            return ""
-        pct = f"{value:.2%}"
-        # Basic color coding example
-        if value > 0.15:
-            return f"<span style='color:Red; font-weight:bold;'>{pct}</span>"
-        elif value > 0.05:
-            return f"<span style='color:DarkOrange; font-weight:bold;'>{pct}</span>"
-        elif value > 0.02:
-            return f"<span style='color:Orange; font-weight:bold;'>{pct}</span>"
-        elif value >= -0.02:
-            return pct
-        elif value < -0.15:
-            return f"<span style='color:Navy; font-weight:bold;'>{pct}</span>"
-        else:
-            return f"<span>{pct}</span>"
+    return ''.join(iter_html_table_with_team(final_info, acct_no, team_name, top_n=top_n, rank_by=rank_by))
 
-    html = f"""
-    <h3>Team vs. Overall Cost (Account {acct_no})</h3>
-    <table border="1" style="border-collapse: collapse; font-family: Arial, sans-serif;">
-      <tr style="background-color: SteelBlue; color: white;">
-        <th>Service Name</th>
-        <th>Overall Cost</th>
-        <th>Overall Δ%</th>
-        <th>Team Δ%</th>
-        <th>Team Δ$</th>
-      </tr>
-    """
-
-    for svc in sorted(final_info.keys()):
-        row = final_info[svc]
-        overall_curr = row["overallCurr"]
-        overall_delta_pct = row["overallDeltaPct"]
-        team_delta_pct = row["teamDeltaPct"]
-        team_delta_dollar = row["teamDeltaDollar"]
-
-        html += "<tr>"
-        html += f"<td style='padding:4px;'>{svc}</td>"
-        html += f"<td style='text-align:right; padding:4px;'>$ {overall_curr:,.2f}</td>"
-
-        # Overall Δ%
-        if overall_delta_pct is not None:
-            html += f"<td style='text-align:right; padding:4px;'>{evaluate_change(overall_delta_pct)}</td>"
-        else:
-            html += "<td>&nbsp;</td>"
-
-        # Team Δ%
-        if team_delta_pct is not None:
-            html += f"<td style='text-align:right; padding:4px;'>{evaluate_change(team_delta_pct)}</td>"
-        else:
-            html += "<td>&nbsp;</td>"
+# -----------------------------------------------------------------------------
+# 10b) GENERATE HTML TABLE FOR FULL PER-SERVICE BREAKDOWN (Optional)
+# -----------------------------------------------------------------------------
 
-        # Team Δ$
-        html += f"<td style='text-align:right; padding:4px;'>$ {team_delta_dollar:,.2f}</td>"
+# Adds the month-by-month per-service table (from the summary-only report)
+# below the team tables
+INCLUDE_SERVICE_BREAKDOWN = os.environ.get('INCLUDE_SERVICE_BREAKDOWN', 'false').lower() == 'true'
 
-        html += "</tr>"
+def breakdown_service_scores(acct_id, services, deltas, period, rank_by):
+    """Scores an account's services (latest period) for select_top_services."""
+    if rank_by == 'abs_delta':
+        return {svc: abs(deltas.absolute(acct_id, svc, period) or 0.0) for svc in services}
+    if rank_by == 'pct_delta':
+        return {svc: abs(deltas.percent(acct_id, svc, period) or 0.0) for svc in services}
+    return {svc: monthly_data.get(period, 0.0) for svc, monthly_data in services.items()}
 
-    html += "</table>"
-    return html
+def iter_html_table(cost_cube, display_cost_data_dict, deltas=None, compare_metrics=(), top_n=None, rank_by=None,
+                    heading="Per Service Breakdown"):
+    """
+    Yields the per-service breakdown table as HTML fragments, one per row.
+    Values are cost_cube's metric; compare_metrics adds, side by side, one
+    column per other plane of the cube with its value for the latest month.
+    Each account lists its top_n services (default TOP_SERVICES) ranked by
+    rank_by (default TOP_SERVICES_BY); the rest are summed per month into a
+    last "Other services" row.
+    """
+    top_n = TOP_SERVICES if top_n is None else top_n
+    rank_by = rank_by or TOP_SERVICES_BY
+    if deltas is None:
+        deltas = CostDeltas(cost_cube, DELTA_OFFSETS[DELTA_COMPARISON])
+    cell = BREAKDOWN_QUANTITY_CELL if cost_cube.metric in QUANTITY_METRICS else BREAKDOWN_COST_CELL
+    compare_planes = [
+        (cost_cube.plane(metric), BREAKDOWN_QUANTITY_CELL if metric in QUANTITY_METRICS else BREAKDOWN_COST_CELL)
+        for metric in compare_metrics
+    ]
+
+    sorted_months = sorted(cost_cube.periods)
+    # Each month has a cost column, except after the first month we also have a delta column
+    num_periods = len(sorted_months)
+    columns = (num_periods * 1) + (num_periods - 1) + len(compare_planes)
+
+    # The month subheader is identical for every account
+    month_header = '<tr style="background-color:LightSteelBlue;">'
+    month_header += '<td style="text-align:center; font-weight:bold;">Service Name</td>'
+    for idx, m in enumerate(sorted_months):
+        if idx > 0:
+            month_header += '<td style="text-align:center;">Δ%</td>'
+        month_header += BREAKDOWN_MONTH_HEADER(m)
+    for metric in compare_metrics:
+        month_header += BREAKDOWN_MONTH_HEADER(f"{metric} {sorted_months[-1]}")
+    month_header += '</tr>'
+
+    yield f"<h2>AWS Monthly Cost Report - {heading}</h2>"
+    yield '<table border="1" style="border-collapse:collapse; font-family:Arial,sans-serif;">'
+
+    for acct_id, services in display_cost_data_dict.items():
+        # Account-level header
+        yield BREAKDOWN_ACCOUNT_ROW(columns, accountDict.get(acct_id, acct_id), acct_id)
+        yield month_header
+
+        # One fragment per service row, in the dict's (alphabetical) order
+        rows, rest = services.items(), ()
+        if sorted_months and 0 < top_n < len(services):
+            top, rest = select_top_services(
+                breakdown_service_scores(acct_id, services, deltas, sorted_months[-1], rank_by), top_n
+            )
+            top = set(top)
+            rows = [(svc, monthly_data) for svc, monthly_data in services.items() if svc in top]
+        for i_row, (svc, monthly_data) in enumerate(rows):
+            cells = ["<tr style='background-color: WhiteSmoke;'>" if (i_row % 2) == 0 else "<tr>",
+                     BREAKDOWN_SERVICE_CELL(svc)]
+            for idx, m in enumerate(sorted_months):
+                if idx > 0:
+                    cells.append(change_cell_html(deltas.percent(acct_id, svc, m)))
+                cells.append(cell(monthly_data.get(m, 0.0)))
+            for plane, plane_cell in compare_planes:
+                cells.append(plane_cell(plane.get(acct_id, svc, sorted_months[-1]) or 0.0))
+            cells.append('</tr>')
+            yield ''.join(cells)
+
+        if rest:
+            totals = {m: sum(services[svc].get(m, 0.0) for svc in rest) for m in sorted_months}
+            cells = ["<tr style='background-color: WhiteSmoke;'>" if (len(rows) % 2) == 0 else "<tr>",
+                     BREAKDOWN_SERVICE_CELL(f"{OTHER_SERVICES_LABEL} ({len(rest)})")]
+            for idx, m in enumerate(sorted_months):
+                if idx > 0:
+                    prev = totals.get(deltas.previous_period(m), 0.0)
+                    cells.append(change_cell_html((totals[m] / prev) - 1 if prev and totals[m] else None))
+                cells.append(cell(totals[m]))
+            for plane, plane_cell in compare_planes:
+                cells.append(plane_cell(sum(plane.get(acct_id, svc, sorted_months[-1]) or 0.0 for svc in rest)))
+            cells.append('</tr>')
+            yield ''.join(cells)
+
+    yield '</table>'
+
+def generate_html_table(cost_cube, display_cost_data_dict, deltas=None, compare_metrics=(), top_n=None, rank_by=None):
+    """
+    Creates a detailed breakdown table by account, service, and monthly cost.
+    The Δ% columns come from deltas (a CostDeltas over cost_cube, built here
+    if not given) instead of being recomputed for every row. Pass
+    cost_cube.plane(metric) to render another metric, and compare_metrics
+    to show other metrics side by side. With top_n, each account shows its
+    top_n services by rank_by plus an "Other services" row.
+    """
+    return ''.join(iter_html_table(cost_cube, display_cost_data_dict, deltas, compare_metrics, top_n, rank_by))
 
 # -----------------------------------------------------------------------------
 # 11) SEND REPORT VIA SES (Unchanged)
@@ -580,9 +2955,11 @@ def send_report_email(BODY_HTML):
 
     print(f"SENDER={SENDER}, RECIPIENT={RECIPIENT}, REGION={AWS_REGION}")
 
-    client = boto3.client('ses', region_name=AWS_REGION)
+    client = get_ses_client(AWS_REGION)
 
+    started = time.perf_counter()
     try:
+        api_usage.charge('ses')
         response = client.send_email(
             Destination={'ToAddresses': [RECIPIENT]},
             Message={
@@ -594,58 +2971,453 @@ def send_report_email(BODY_HTML):
             },
             Source=SENDER
         )
+        api_usage.record('ses', response, size=len(BODY_HTML.encode('utf-8')) + len(BODY_TEXT) + len(SUBJECT))
         print("Email sent! Message ID:", response['MessageId'])
-    except ClientError as e:
+        return True
+    except client_error() as e:
         print("SES send_email Error:", e.response['Error']['Message'])
+        return False
+    finally:
+        run_metrics.observe(METRIC_NAMES['ses'], (time.perf_counter() - started) * 1000)
 
 # -----------------------------------------------------------------------------
-# 12) LAMBDA HANDLER
+# 11b) STREAM THE REPORT TO S3 (Optional)
 # -----------------------------------------------------------------------------
 
-def lambda_handler(event=None, context=None):
-    print("=== Starting Lambda Execution ===")
+# When REPORT_S3_BUCKET is set, the rendered report is also uploaded to
+# s3://REPORT_S3_BUCKET/REPORT_S3_KEY straight from the fragment stream.
+# REPORT_S3_KEY may contain {date} (the report window end date).
+REPORT_S3_BUCKET = os.environ.get('REPORT_S3_BUCKET', '')
+REPORT_S3_KEY = os.environ.get('REPORT_S3_KEY', 'cost-reports/{date}.html')
 
-    # 1) Summarize monthly cost per account (the top summary table)
-    mainCostDict = ce_get_costinfo_per_account(accountDict)
+class FragmentReader:
+    """
+    Read-only file object over an iterable of HTML fragments, so
+    upload_fileobj can consume the renderer output chunk by chunk without
+    the whole report ever being held as one string.
+    """
+    def __init__(self, fragments):
+        self.fragments = iter(fragments)
+        self.buffer = b''
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            fragment = next(self.fragments, None)
+            if fragment is None:
+                break
+            encoded = fragment.encode('utf-8')
+            chunks.append(encoded)
+            length += len(encoded)
+        data = b''.join(chunks)
+        if size < 0:
+            size = length
+        self.buffer = data[size:]
+        return data[:size]
+
+def keep_fragments(fragments, kept):
+    """Yields fragments, appending each one to kept as it goes."""
+    for fragment in fragments:
+        kept.append(fragment)
+        yield fragment
+
+def save_report_to_s3(fragments, bucket_name, object_key):
+    """Streams the report fragments to S3 as a text/html object."""
+    try:
+        get_s3_client().upload_fileobj(
+            FragmentReader(fragments), bucket_name, object_key,
+            ExtraArgs={'ContentType': 'text/html; charset=utf-8'}
+        )
+        print(f"Report saved to s3://{bucket_name}/{object_key}")
+    except client_error() as e:
+        print("S3 report upload error:", e.response['Error']['Message'])
+
+# -----------------------------------------------------------------------------
+# 12) REPORT STAGES: FETCH, THEN RENDER
+# -----------------------------------------------------------------------------
+
+def fetch_report_data(accounts, budget):
+    """
+    Fetch stage of a report run for accounts ({account_id: name}). Returns
+      { 'summary': ce_get_costinfo_per_account() result,
+        'account_numbers': accounts with per-service detail,
+        'cost_cube': overall per-service cube, None if the budget cut it,
+        'team_reports': [ (team name or None, team cube), ... ],
+        'usage_cube': usage type cube or None }
+    with every cube rolled up to the report periods.
+    """
+    # 1) Fetch the summary, per-service and team data concurrently.
+    #    Each stage fans its own queries out over the shared fetch pool.
+    account_numbers = list(accounts.keys())
+    summary_stages = [(run_in_api_stage, (SUMMARY_STAGE, ce_get_costinfo_per_account, accounts))]
+    detail_budget = budget
+    # With coalescing the summary comes last: its account totals are summed
+    # from the per-service pages instead of fetched (see QueryCoalescer).
+    # Under a deadline the detail stages stop SUMMARY_RESERVE_MS early, so a
+    # summary a cut leaves underivable is still fetched in time; with less
+    # time than that left, the summary is fetched alongside the detail.
+    derive_summary = CE_COALESCE and not DRILL_DOWN and (
+        budget.deadline is None or budget.remaining() > SUMMARY_RESERVE_MS / 1000)
+    if derive_summary:
+        summary_stages = []
+        detail_budget = budget.held_back(SUMMARY_RESERVE_MS / 1000)
+    if DRILL_DOWN:
+        # The cheap summary comes first; only the accounts that moved get
+        # the grouped per-service queries
+        mainCostDict = run_in_api_stage(SUMMARY_STAGE, ce_get_costinfo_per_account, accounts)
+        account_numbers = moved_accounts(process_costchanges_per_month(mainCostDict))
+        print(f"Drill-down: per-service detail for {len(account_numbers)} of {len(accounts)} accounts")
+        summary_stages = []
+
+    if TEAM_GROUPBY_TAG:
+        # One GroupBy TAG + SERVICE pass yields the overall and every team's data
+        fetched = run_fetch_stages(summary_stages + [
+            (detail_budget.run, ('Team and per-service tables', get_team_cost_data,
+                                 account_numbers, TEAM_TAG_KEY, detail_budget.deadline)),
+        ])
+        if summary_stages:
+            mainCostDict = fetched.pop(0)
+        cost_cube, team_cubes = fetched.pop(0) or (None, {})
+        details_complete = cost_cube is not None
+        team_reports = [
+            (tag_value, team_cubes.get(tag_value) or CostCube(cube_periods(), CE_METRICS))
+            for tag_value in (TEAM_TAG_VALUES or team_cubes)
+        ] if cost_cube is not None else []
+    else:
+        # The per-service pages stream straight into the cubes
+        fetched = run_fetch_stages(summary_stages + [
+            (detail_budget.run, ('Team and per-service tables', CostCube(cube_periods(), CE_METRICS).add_results,
+                                 iter_cost_data(account_numbers, detail_budget.deadline))),
+            (detail_budget.run, ('Team tables', CostCube(cube_periods(), CE_METRICS).add_results,
+                                 iter_tagged_cost_data(account_numbers, TEAM_TAG_KEY, TEAM_TAG_VALUE,
+                                                       detail_budget.deadline))),
+        ])
+        if summary_stages:
+            mainCostDict = fetched.pop(0)
+        cost_cube, team_cube = fetched.pop(0), fetched.pop(0)
+        details_complete = cost_cube is not None and team_cube is not None
+        team_reports = [(None, team_cube)] if cost_cube is not None and team_cube is not None else []
+    if derive_summary:
+        # Totals are only derived when every detail stage ran to its end;
+        # after a cut (time or request budget) the summary is fetched
+        ce_coalescer.derive_totals = details_complete
+        mainCostDict = run_in_api_stage(SUMMARY_STAGE, ce_get_costinfo_per_account, accounts)
+
+    # Lowest priority: the usage type detail, fetched once the rest is in
+    usage_cube = None
+    if DRILL_DOWN and DRILL_DOWN_USAGE_TYPES:
+        usage_cube = budget.run('Usage type breakdown', get_usage_type_cost_data, account_numbers, budget.deadline)
+
+    # DAILY / HOURLY cubes are rolled up locally to the report periods
+    return {
+        'summary': mainCostDict,
+        'account_numbers': account_numbers,
+        'cost_cube': rollup_for_report(cost_cube) if cost_cube is not None else None,
+        'team_reports': [(team_name, rollup_for_report(team_cube)) for team_name, team_cube in team_reports],
+        'usage_cube': rollup_for_report(usage_cube) if usage_cube is not None else None,
+    }
+
+def render_report(data, budget):
+    """
+    Render stage: builds the summary from data (see fetch_report_data) and
+    returns a function that yields the whole report as HTML fragments. The
+    optional sections go in priority order while the budget lasts.
+    """
+    mainCostDict = data['summary']
+    account_numbers = data['account_numbers']
+    cost_cube = data['cost_cube']
+    team_reports = data['team_reports']
+    usage_cube = data['usage_cube']
+
+    # Sections are rendered in priority order while time remains
+    render_breakdown = INCLUDE_SERVICE_BREAKDOWN and cost_cube is not None
+    if team_reports and not budget.available('Team tables'):
+        team_reports = []
+    if render_breakdown and not budget.available('Per-service breakdown'):
+        render_breakdown = False
+    if usage_cube is not None and not budget.available('Usage type breakdown'):
+        usage_cube = None
+    if cost_cube is None:
+        cost_cube = CostCube(MONTHLY_COST_DATES, CE_METRICS)
+
+    # 2) Summarize monthly cost per account (the top summary table)
     mainMonthlyDict = process_costchanges_per_month(mainCostDict)
     mainDisplayDict = process_costchanges_for_display(mainMonthlyDict)
     finalDisplayDict = process_percentchanges_per_month(mainDisplayDict)
 
-    # 2) Build the summary HTML (the table that looks like your screenshot)
+    # 3) Build the summary HTML (the table that looks like your screenshot)
     summary_html = create_report_html(finalDisplayDict, BODY_HTML)
 
-    # 3) Gather the "per-service" overall cost (like your existing breakdown)
-    account_numbers = list(accountDict.keys())
-    cost_data_Dict = get_cost_data(account_numbers)
-    display_cost_data_Dict = restructure_cost_data(cost_data_Dict, account_numbers)
+    # 3b) Every fetched metric side by side (the data came with the same requests)
+    other_metrics = [metric for metric in CE_METRICS if metric != REPORT_METRIC]
+    if other_metrics:
+        summary_html += create_metric_comparison_html({
+            metric: process_costchanges_for_display(process_costchanges_per_month(mainCostDict, metric))
+            for metric in CE_METRICS
+        })
 
-    # 4) Also gather the "per-service" cost for the team (tag filter)
-    team_data_Dict = get_tagged_cost_data(account_numbers, TEAM_TAG_KEY, TEAM_TAG_VALUE)
-    display_team_data_Dict = restructure_cost_data(team_data_Dict, account_numbers)
+    # 4) View the "per-service" overall cost in the {acct: {service: {month: cost}}} shape
+    display_cost_data_Dict = cost_cube.to_service_dict(account_numbers)
 
-    # 5) For each account, merge the overall + team cost into a single dict,
-    #    then generate a combined HTML table with 5 columns:
+    # 5) For each team and account, merge the overall + team cost into a
+    #    single dict, then generate a combined HTML table with 5 columns:
     #      (Service, Overall Cost, Overall Δ%, Team Δ%, Team Δ$)
-    breakdown_html = ""
-    for acct_id in display_cost_data_Dict:
-        overall_dict = display_cost_data_Dict[acct_id]   # {service: {month: cost}}
-        team_dict = display_team_data_Dict.get(acct_id, {})
-        final_info = merge_team_data(overall_dict, team_dict)
+    #    Deltas are computed once per cube and shared by every table.
+    comparison_offset = DELTA_OFFSETS[DELTA_COMPARISON]
+    overall_deltas = CostDeltas(cost_cube, comparison_offset)
+    team_deltas = [
+        (team_name, team_cube, CostDeltas(team_cube, comparison_offset))
+        for team_name, team_cube in team_reports
+    ]
+
+    def report_fragments():
+        yield summary_html
+        yield '<br><br>'
+        yield skipped_sections_html(budget.skipped)
+        if DRILL_DOWN:
+            yield (f"<p>Per-service detail is shown for the {len(account_numbers)} of {len(accountDict)} accounts "
+                   f"whose {DELTA_COMPARISON} change was at least {DRILL_DOWN_PCT_THRESHOLD:.0%} "
+                   f"or {DRILL_DOWN_ABS_THRESHOLD:,.2f}.</p>")
+        for team_name, team_cube, deltas in team_deltas:
+            for acct_id in display_cost_data_Dict:
+                final_info = merge_team_deltas(acct_id, cost_cube, team_cube, overall_deltas, deltas)
+
+                # Create the table for this account
+                yield from iter_html_table_with_team(final_info, acct_id, team_name)
+                yield "<br><br>"
+
+        if render_breakdown:
+            yield from iter_html_table(cost_cube, display_cost_data_Dict, overall_deltas, other_metrics)
+        if usage_cube is not None:
+            yield from iter_html_table(usage_cube, usage_cube.to_service_dict(account_numbers),
+                                       heading="Usage Type Breakdown")
+        if REPORT_API_USAGE:
+            yield api_usage_html(api_usage)
+
+    return report_fragments
 
-        # Create the table for this account
-        table_html = generate_html_table_with_team(final_info, acct_id)
-        breakdown_html += table_html
-        breakdown_html += "<br><br>"
+# -----------------------------------------------------------------------------
+# 12b) SHARDED RUNS (MAP-REDUCE OVER ACCOUNTS)
+# -----------------------------------------------------------------------------
+
+# With more than SHARD_SIZE accounts, the invocation becomes a coordinator:
+# it splits accountDict into shards of SHARD_SIZE accounts, each shard is
+# fetched by a worker that stores its partial aggregates (summary responses
+# and cost cubes) in the shard store, and the coordinator merges the
+# partials and renders the report. Workers are Lambda invocations of
+# SHARD_FUNCTION_NAME (default: this function), or with
+# SHARD_EXECUTOR=process, local processes (for offline runs and tests).
+# Lambda workers need the S3 store (SHARD_BUCKET). Tag values need no
+# sharding of their own: every GroupBy TAG query already covers all of them.
+SHARD_SIZE = int(os.environ.get('SHARD_SIZE', '0'))
+SHARD_EXECUTOR = os.environ.get('SHARD_EXECUTOR', 'lambda')
+SHARD_FUNCTION_NAME = os.environ.get('SHARD_FUNCTION_NAME', '')
+SHARD_WORKERS = int(os.environ.get('SHARD_WORKERS', '0'))
+SHARD_DIR = os.environ.get('SHARD_DIR', '/tmp/report-shards')
+SHARD_BUCKET = os.environ.get('SHARD_BUCKET', '')
+SHARD_PREFIX = os.environ.get('SHARD_PREFIX', 'report-shards/')
+
+def get_shard_store():
+    """Partials go to S3 if SHARD_BUCKET is set (workers run elsewhere), else to SHARD_DIR."""
+    if SHARD_BUCKET:
+        return CostResponseCache('', get_s3_client(), SHARD_BUCKET, SHARD_PREFIX)
+    return CostResponseCache(SHARD_DIR)
+
+def plan_report_shards(run_id, accounts, shard_size=None):
+    """
+    Splits accounts ({account_id: name}) into shard descriptions, keeping
+    their order. Each shard gets an equal share of CE_REQUEST_BUDGET.
+    """
+    shard_size = SHARD_SIZE if shard_size is None else shard_size
+    chunks = plan_account_queries(accounts, shard_size)
+    request_budget = -(-CE_REQUEST_BUDGET // len(chunks)) if chunks else 0
+    return [
+        {'run_id': run_id, 'index': index, 'accounts': {acct_id: accounts[acct_id] for acct_id in chunk},
+         'request_budget': request_budget}
+        for index, chunk in enumerate(chunks)
+    ]
+
+def run_report_shard(shard, budget=None):
+    """
+    Worker side: fetches one shard and stores its partial aggregates.
+    Returns the handler response with the key of the stored partial.
+    """
+    budget = budget or TimeBudget()
+    # A process worker runs several shards; their queries never overlap
+    reset_ce_coalescer()
+    reset_api_usage(shard.get('request_budget'))
+    print(f"Shard {shard['index']}: {len(shard['accounts'])} accounts")
+    data = fetch_report_data(shard['accounts'], budget)
+    partial = {
+        'index': shard['index'],
+        'summary': data['summary'],
+        'account_numbers': data['account_numbers'],
+        'cost_cube': data['cost_cube'].to_partial() if data['cost_cube'] is not None else None,
+        'team_reports': [[team_name, team_cube.to_partial()] for team_name, team_cube in data['team_reports']],
+        'usage_cube': data['usage_cube'].to_partial() if data['usage_cube'] is not None else None,
+        'skipped': budget.skipped,
+        'api_usage': api_usage.to_partial(),
+    }
+    key = f"{shard['run_id']}-shard-{shard['index']}"
+    get_shard_store().put(key, partial)
+    return {'statusCode': 200, 'partial_key': key}
+
+def _start_shard_process():
+    # A forked worker inherits the parent's fetch pool object but not its
+    # threads: start a fresh pool on first use
+    global _fetch_pool
+    _fetch_pool = None
 
-    # 6) Combine summary + new breakdown
-    combined_html = summary_html + '<br><br>' + breakdown_html
-    print("=== Final Combined HTML ===\n", combined_html[:1000], "... (truncated)\n")
+def invoke_report_shards(shards, event, context=None):
+    """
+    Runs every shard on a worker (see SHARD_EXECUTOR) and returns the keys of
+    their stored partials in shard order. A failed shard fails the run.
+    """
+    if SHARD_EXECUTOR == 'process':
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        # fork keeps this process' configuration (and any injected clients)
+        with ProcessPoolExecutor(max_workers=SHARD_WORKERS or min(len(shards), os.cpu_count() or 1),
+                                 mp_context=multiprocessing.get_context('fork'),
+                                 initializer=_start_shard_process) as shard_pool:
+            responses = list(shard_pool.map(run_report_shard, shards))
+        return [response['partial_key'] for response in responses]
+
+    if not SHARD_BUCKET:
+        raise ValueError("SHARD_BUCKET is required for Lambda shard workers")
+    function_name = SHARD_FUNCTION_NAME or getattr(context, 'invoked_function_arn', '')
+
+    def invoke(shard):
+        payload = dict(event, shard=shard)
+        response = get_lambda_client().invoke(
+            FunctionName=function_name, InvocationType='RequestResponse',
+            Payload=json.dumps(payload).encode('utf-8')
+        )
+        result = json.loads(response['Payload'].read())
+        if response.get('FunctionError') or 'partial_key' not in result:
+            raise RuntimeError(f"Shard {shard['index']} failed: {result}")
+        return result['partial_key']
 
-    # 7) Send the email via SES
-    send_report_email(combined_html)
+    # Invocations block until the shard is done: one thread per shard
+    with ThreadPoolExecutor(max_workers=len(shards), thread_name_prefix='report-shard') as shard_pool:
+        return list(shard_pool.map(invoke, shards))
 
+def reduce_report_shards(partial_keys, budget):
+    """
+    Reducer: merges the stored partials, in shard order, into the data dict
+    fetch_report_data would have returned for all accounts at once.
+    """
+    store = get_shard_store()
+    mainCostDict = {}
+    account_numbers = []
+    cost_cube = None
+    team_cubes = {}
+    usage_cube = None
+    for key in partial_keys:
+        partial = store.get(key)
+        mainCostDict.update(partial['summary'])
+        api_usage.merge(partial['api_usage'])
+        budget.skipped += [(f"{section} (shard {partial['index']})", reason) for section, reason in partial['skipped']]
+        if partial['cost_cube'] is None:
+            continue
+        account_numbers += partial['account_numbers']
+        cost_cube = (cost_cube or CostCube(MONTHLY_COST_DATES, CE_METRICS)).merge(
+            CostCube.from_partial(partial['cost_cube']))
+        for team_name, team_partial in partial['team_reports']:
+            if team_name not in team_cubes:
+                team_cubes[team_name] = CostCube(MONTHLY_COST_DATES, CE_METRICS)
+            team_cubes[team_name].merge(CostCube.from_partial(team_partial))
+        if partial['usage_cube'] is not None:
+            usage_cube = (usage_cube or CostCube(MONTHLY_COST_DATES, CE_METRICS)).merge(
+                CostCube.from_partial(partial['usage_cube']))
+
+    # Same team order as an unsharded run
+    team_names = list(team_cubes)
+    if TEAM_GROUPBY_TAG:
+        team_names = TEAM_TAG_VALUES or sorted(team_names)
+    return {
+        'summary': mainCostDict,
+        'account_numbers': account_numbers,
+        'cost_cube': rollup_for_report(cost_cube) if cost_cube is not None else None,
+        'team_reports': [(team_name, rollup_for_report(team_cubes[team_name])) for team_name in team_names
+                         if team_name in team_cubes],
+        'usage_cube': rollup_for_report(usage_cube) if usage_cube is not None else None,
+    }
+
+# -----------------------------------------------------------------------------
+# 13) LAMBDA HANDLER
+# -----------------------------------------------------------------------------
+
+def emit_handler_metrics(metrics, budget, started):
+    """Adds the run totals and the whole invocation's time, then emits the metrics."""
+    count_run_totals(metrics, budget)
+    with metrics.lock:
+        metrics.timers['Total'] = (time.perf_counter() - started) * 1000
+    metrics.emit()
+
+def lambda_handler(event=None, context=None):
+    event = event or {}
+    print("=== Starting Lambda Execution ===")
+    started = time.perf_counter()
+    init_report_window()
+    reset_ce_retry_stats()
+    reset_ce_coalescer()
+    reset_api_usage()
+    metrics = reset_run_metrics()
+    if ACCOUNT_SOURCE == 'organizations':
+        use_account_directory(metrics.time('AccountDiscovery', get_account_directory))
+    run_id = checkpoint_run_id(event, context)
+    checkpoint = start_checkpoint(run_id)
+    # The summary is always fetched in full; everything else is cut short or
+    # left out once the time before the Lambda deadline runs low
+    budget = TimeBudget(context)
+
+    if 'shard' in event:
+        # Worker invocation of a sharded run
+        response = metrics.time('ShardFetch', run_report_shard, event['shard'], budget)
+        emit_handler_metrics(metrics, budget, started)
+        return response
+
+    if SHARD_SIZE and len(accountDict) > SHARD_SIZE:
+        run_id = run_id or f"report-{time.strftime('%Y%m%dT%H%M%S')}-{random.getrandbits(32):08x}"
+        # Lambda workers checkpoint under the coordinator's run id
+        event = dict(event, run_id=run_id) if checkpoint is not None else event
+        shards = plan_report_shards(run_id, accountDict)
+        print(f"Sharded run {run_id}: {len(accountDict)} accounts in {len(shards)} shards")
+        partial_keys = metrics.time('Fetch', invoke_report_shards, shards, event, context)
+        data = metrics.time('Reduce', reduce_report_shards, partial_keys, budget)
+        # Merged: the partials are no longer needed (a failed merge keeps them)
+        get_shard_store().delete_prefix(f"{run_id}-shard-")
+    else:
+        data = metrics.time('Fetch', fetch_report_data, accountDict, budget)
+    report_fragments = metrics.time('Render', render_report, data, budget)
+
+    # 6) Combine summary + new breakdown in one rendering pass. The S3 upload
+    #    streams the fragments and keeps each one for the email body, which
+    #    SES needs in one payload; what the upload left unread (after an
+    #    error) is rendered when the body is assembled.
+    fragments = report_fragments()
+    rendered = []
+    if REPORT_S3_BUCKET:
+        metrics.time('S3Upload', save_report_to_s3, keep_fragments(fragments, rendered), REPORT_S3_BUCKET,
+                     REPORT_S3_KEY.format(date=MONTHLY_END_DATE))
+    combined_html = metrics.time('Assemble', ''.join, itertools.chain(rendered, fragments))
+    debug_dump("Final combined HTML (first 1000 characters)", combined_html[:1000])
+
+    # 7) Send the email via SES; a run whose email failed keeps its checkpoint
+    if metrics.time('Email', run_in_api_stage, 'Email', send_report_email, combined_html) and checkpoint is not None:
+        checkpoint.complete()
+
+    print(f"Cost Explorer requests: {ce_retry_stats['requests']}, retries: {ce_retry_stats['retries']} "
+          f"({ce_retry_stats['throttles']} throttled), backoff: {ce_retry_stats['backoff_seconds']:.1f}s, "
+          f"pages resumed from checkpoint: {ce_retry_stats['resumed_pages']}")
+    print(f"Cost Explorer queries served without a call: {ce_coalescer.stats['derived']} derived from other queries")
+    api_usage.log()
+    emit_handler_metrics(metrics, budget, started)
     print("=== Completed Lambda Execution ===")
     return {
         'statusCode': 200,
-        'body': 'Monthly Cost Report Sent!'
+        'body': 'Monthly Cost Report Sent!',
+        'apiUsage': api_usage.to_partial(),
     }
@@ -0,0 +1,15 @@
+"""
+Level-gated debug dumps shared by the scripts in this directory.
+
+Return values are printed only with LOG_LEVEL=DEBUG; otherwise they are
+never formatted.
+"""
+import os
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+
+def debug_dump(label, value):
+    """Prints value under a [DEBUG] label when LOG_LEVEL is DEBUG."""
+    if LOG_LEVEL == 'DEBUG':
+        print(f"\n[DEBUG] {label}:")
+        print(value)
@@ -3,6 +3,8 @@ import os
 from datetime import datetime, timedelta
 from botocore.exceptions import ClientError
 
+from debug_log import debug_dump
+
 # -----------------------------------------------------------------------------
 # 1) GLOBAL CONSTANTS AND SETUP
 # -----------------------------------------------------------------------------
@@ -91,8 +93,7 @@ def ce_get_costinfo_per_account(accountDict_input):
 
     print("Completed ce_get_costinfo_per_account. accountCostDict keys:", list(accountCostDict.keys()))
 
-    print("\n[DEBUG] ce_get_costinfo_per_account() return value:")
-    print(accountCostDict)
+    debug_dump("ce_get_costinfo_per_account() return value", accountCostDict)
 
     return accountCostDict
 
@@ -123,8 +124,7 @@ def process_costchanges_per_month(accountCostDict_input):
 
     print("Completed process_costchanges_per_month. Keys in reportCostDict:", list(reportCostDict.keys()))
 
-    print("\n[DEBUG] process_costchanges_per_month() return value:")
-    print(reportCostDict)
+    debug_dump("process_costchanges_per_month() return value", reportCostDict)
 
     return reportCostDict
 
@@ -149,8 +149,7 @@ def process_costchanges_for_display(reportCostDict_input):
 
     print("Completed process_costchanges_for_display.")
 
-    print("\n[DEBUG] process_costchanges_for_display() return value:")
-    print(displayReportCostDict)
+    debug_dump("process_costchanges_for_display() return value", displayReportCostDict)
 
     return displayReportCostDict
 
@@ -184,8 +183,7 @@ def process_percentchanges_per_month(reportCostDict_input):
 
     print("Completed process_percentchanges_per_month.")
 
-    print("\n[DEBUG] process_percentchanges_per_month() return value:")
-    print(reportCostDict_input)
+    debug_dump("process_percentchanges_per_month() return value", reportCostDict_input)
 
     return reportCostDict_input
 
@@ -268,8 +266,7 @@ def create_report_html(emailDisplayDict_input, BODY_HTML):
     BODY_HTML += "</table><br>"
     BODY_HTML += f"<div style='font-size:12px; font-style:italic;'>Reporting Window: {MONTHLY_START_DATE} to {MONTHLY_END_DATE}</div>"
 
-    print("\n[DEBUG] create_report_html() HTML output:")
-    print(BODY_HTML, "\n")
+    debug_dump("create_report_html() HTML output", BODY_HTML)
 
     return BODY_HTML
 
@@ -300,8 +297,7 @@ def get_linked_accounts(account_list):
     print("Active accounts found:", active_accounts)
     print("Filtered/defined accounts:", defined_accounts)
 
-    print("\n[DEBUG] get_linked_accounts() return value:")
-    print(defined_accounts)
+    debug_dump("get_linked_accounts() return value", defined_accounts)
 
     return defined_accounts
 
@@ -329,8 +325,7 @@ def get_cost_data(account_numbers):
             break
 
     print("Completed get_cost_data.")
-    print("\n[DEBUG] get_cost_data() return value:")
-    print(results)
+    debug_dump("get_cost_data() return value", results)
 
     return results
 
@@ -373,8 +368,7 @@ def get_tagged_cost_data(account_numbers, tag_key, tag_value):
             break
 
     print("Completed get_tagged_cost_data.")
-    print("\n[DEBUG] get_tagged_cost_data() return value:")
-    print(results)
+    debug_dump("get_tagged_cost_data() return value", results)
 
     return results
 
@@ -414,8 +408,7 @@ def restructure_cost_data(cost_data_dict, account_numbers):
         sorted_dict[acct_no] = sorted_services
 
     print("Completed restructure_cost_data.")
-    print("\n[DEBUG] restructure_cost_data() return value:")
-    print(sorted_dict)
+    debug_dump("restructure_cost_data() return value", sorted_dict)
 
     return sorted_dict
 
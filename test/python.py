@@ -1,3 +1,5 @@
+from debug_log import debug_dump
+
 def get_cost_data_for_tag(account_numbers, tag_key, tag_value):
     """
     Similar to get_cost_data, but filters only resources with a given tag_key=tag_value.
@@ -48,8 +50,7 @@ def get_cost_data_for_tag(account_numbers, tag_key, tag_value):
             break
 
     print("Completed get_cost_data_for_tag.")
-    print("\n[DEBUG] get_cost_data_for_tag() return value:")
-    print(results)
+    debug_dump("get_cost_data_for_tag() return value", results)
 
     return results
 
@@ -3,6 +3,8 @@ import os
 from datetime import datetime, timedelta
 from botocore.exceptions import ClientError
 
+from debug_log import debug_dump
+
 # -----------------------------------------------------------------------------
 # 1) GLOBAL CONSTANTS AND SETUP
 # -----------------------------------------------------------------------------
@@ -88,8 +90,7 @@ def ce_get_costinfo_per_account(accountDict_input):
     print("Completed ce_get_costinfo_per_account. accountCostDict keys:", list(accountCostDict.keys()))
 
     # **Print the result** just before returning
-    print("\n[DEBUG] ce_get_costinfo_per_account() return value:")
-    print(accountCostDict)
+    debug_dump("ce_get_costinfo_per_account() return value", accountCostDict)
 
     return accountCostDict
 
@@ -121,8 +122,7 @@ def process_costchanges_per_month(accountCostDict_input):
     print("Completed process_costchanges_per_month. Keys in reportCostDict:", list(reportCostDict.keys()))
 
     # Print before returning
-    print("\n[DEBUG] process_costchanges_per_month() return value:")
-    print(reportCostDict)
+    debug_dump("process_costchanges_per_month() return value", reportCostDict)
 
     return reportCostDict
 
@@ -148,8 +148,7 @@ def process_costchanges_for_display(reportCostDict_input):
     print("Completed process_costchanges_for_display.")
 
     # Print before returning
-    print("\n[DEBUG] process_costchanges_for_display() return value:")
-    print(displayReportCostDict)
+    debug_dump("process_costchanges_for_display() return value", displayReportCostDict)
 
     return displayReportCostDict
 
@@ -184,8 +183,7 @@ def process_percentchanges_per_month(reportCostDict_input):
     print("Completed process_percentchanges_per_month.")
 
     # Print before returning
-    print("\n[DEBUG] process_percentchanges_per_month() return value:")
-    print(reportCostDict_input)
+    debug_dump("process_percentchanges_per_month() return value", reportCostDict_input)
 
     return reportCostDict_input
 
@@ -269,8 +267,7 @@ def create_report_html(emailDisplayDict_input, BODY_HTML):
     BODY_HTML += f"<div style='font-size:12px; font-style:italic;'>Reporting Window: {MONTHLY_START_DATE} to {MONTHLY_END_DATE}</div>"
 
     # Print before returning
-    print("\n[DEBUG] create_report_html() HTML output (truncated to 500 chars):")
-    print(BODY_HTML, "...\n")
+    debug_dump("create_report_html() HTML output", BODY_HTML)
 
     return BODY_HTML
 
@@ -306,8 +303,7 @@ def get_linked_accounts(account_list):
     print("Filtered/defined accounts:", defined_accounts)
 
     # Print before returning
-    print("\n[DEBUG] get_linked_accounts() return value:")
-    print(defined_accounts)
+    debug_dump("get_linked_accounts() return value", defined_accounts)
 
     return defined_accounts
 
@@ -345,8 +341,7 @@ def get_cost_data(account_numbers):
     print("Completed get_cost_data.")
 
     # Print before returning
-    print("\n[DEBUG] get_cost_data() return value:")
-    print(results)
+    debug_dump("get_cost_data() return value", results)
 
     return results
 
@@ -389,8 +384,7 @@ def restructure_cost_data(cost_data_dict, account_numbers):
     print("Completed restructure_cost_data.")
 
     # Print before returning
-    print("\n[DEBUG] restructure_cost_data() return value:")
-    print(sorted_dict)
+    debug_dump("restructure_cost_data() return value", sorted_dict)
 
     return sorted_dict
 
@@ -475,8 +469,7 @@ def generate_html_table(cost_data_dict, display_cost_data_dict):
     print("Completed generate_html_table.")
 
     # Print before returning
-    print("\n[DEBUG] generate_html_table() HTML output (truncated to 500 chars):")
-    print(emailHTML, "...\n")
+    debug_dump("generate_html_table() HTML output", emailHTML)
 
     return emailHTML
 